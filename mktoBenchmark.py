@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+mktoBenchmark.py: Measuring throughput of mktoExportActivities.py against mktoMockServer.py
+Usage: mktoBenchmark.py <options> [-- <options of mktoExportActivities.py>]
+
+Options:
+  -h                                this help
+  -i --instance <instance>          URL of running mktoMockServer.py. default: start a mock server in this process
+  -c --since <date>                 Since Date time passed to the export. default: --start of the mock server
+  -f --change-data-field <fields>   Same as mktoExportActivities.py. 'Lead Score' is always tracked
+  -w --add-webvisit-activity        Same as mktoExportActivities.py
+  -m --add-mail-activity            Same as mktoExportActivities.py
+  --max-calls <num>                 Max number of API calls in 20 seconds used by the export. default: 1000000
+  --skip-stages                     Skip measuring time per stage
+  --save <filename>                 Save results as JSON, used as baseline of later runs
+  --baseline <filename>             Compare results with JSON saved by --save
+  (options of mktoMockServer.py such as -n, --latency and --token-ttl are also accepted)
+
+Example:
+  python mktoBenchmark.py -n 200000 -m -w --save baseline.json
+  python mktoBenchmark.py -n 200000 -m -w --baseline baseline.json -- --workers 4 --until 2015-09-01
+
+The export is run as a separate process, so rows/sec, requests, bytes and peak RSS are those of
+the command line tool. Time per stage is measured in this process with the sequential path
+(fetch, transform and write one page after another).
+"""
+
+import sys, os
+import argparse
+import csv
+import json
+import pytz
+import resource
+import subprocess
+import tempfile
+import time
+import urllib2
+
+import mktoExportActivities as mkto
+import mktoMockServer
+
+
+# -------
+# Return number of requests and bytes of responses served by mock server
+#
+#    instance: url of mock server
+#
+def getMockRequests(instance):
+    stats = json.load(urllib2.urlopen(instance + '/mock/stats.json'))
+    requests = sum(count for path, count in stats ['requests'].iteritems() if not path.startswith('/mock/'))
+    return requests, stats ['bytes']
+
+
+# -------
+# Run mktoExportActivities.py as a separate process and return its results
+#
+#    instance: url of mock server
+#    export_args: options passed to mktoExportActivities.py
+#
+def runExport(instance, export_args):
+    fd, output = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mktoExportActivities.py')
+    command = [sys.executable, script, '-i', instance, '-d', 'benchmark', '-s', 'benchmark', '-o', output] + export_args
+    try:
+        requests, sent_bytes = getMockRequests(instance)
+        start = time.time()
+        subprocess.check_call(command)
+        elapsed = time.time() - start
+        end_requests, end_bytes = getMockRequests(instance)
+        requests = end_requests - requests
+        sent_bytes = end_bytes - sent_bytes
+        with open(output, 'rb') as f:
+            rows = max(sum(1 for line in csv.reader(f)) - 1, 0)
+    finally:
+        os.remove(output)
+
+    # ru_maxrss is kilobytes on Linux and bytes on Mac OS X
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+    return {'rows': rows,
+            'seconds': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed > 0 else 0.0,
+            'requests': requests,
+            'bytes': sent_bytes,
+            'peak_rss_kb': peak_rss}
+
+
+# -------
+# Run the sequential export path in this process and return seconds spent in each stage
+#
+#    instance: url of mock server
+#    args: parsed options of this benchmark
+#
+def measureStages(instance, args):
+    rate_limiter = mkto.RateLimiter(max_calls=args.max_calls, max_concurrent=10)
+    mktoClient = mkto.MarketoClient(instance, 'client_credentials', 'benchmark', 'benchmark', None, rate_limiter)
+    # tracking fields of the export: Lead Score and -f fields
+    tracking_fields = ["Lead Score"]
+    if args.change_data_fields:
+        tracking_fields.extend(args.change_data_fields.split(','))
+    transformer = mkto.ActivityTransformer(tracking_fields, args.mail_activity, args.web_activity, pytz.timezone('Asia/Tokyo'))
+    stages = {'fetch': 0.0, 'transform': 0.0, 'write': 0.0}
+    rows = 0
+
+    with open(os.devnull, 'wb') as output:
+        # same writer as csv output of the export
+        writer = csv.writer(output, delimiter=',')
+        writer.writerow(transformer.getHeader())
+
+        start = time.time()
+        token = mktoClient.getPagingToken(args.since)
+        pages = mkto.iterActivityPages(mktoClient, token, transformer.getActivityTypeIds())
+        while True:
+            stage_start = time.time()
+            raw_data = next(pages, None)
+            stages ['fetch'] += time.time() - stage_start
+            if raw_data is None:
+                break
+
+            stage_start = time.time()
+            csv_rows = transformer.transformPage(raw_data.get('result', []))
+            stages ['transform'] += time.time() - stage_start
+
+            stage_start = time.time()
+            writer.writerows(csv_rows)
+            stages ['write'] += time.time() - stage_start
+            rows += len(csv_rows)
+        elapsed = time.time() - start
+    mktoClient.close()
+
+    stages ['rows'] = rows
+    stages ['seconds'] = elapsed
+    return stages
+
+
+def printResults(results, baseline):
+    def change(section, key):
+        if baseline is None or not baseline.get(section, {}).get(key):
+            return ''
+        return '  (%+.1f%%)' % ((results [section][key] / float(baseline [section][key]) - 1.0) * 100)
+
+    export = results ['export']
+    print "Export: " + ' '.join(results ['export_args'])
+    print "  rows:         %d" % export ['rows']
+    print "  seconds:      %.2f%s" % (export ['seconds'], change('export', 'seconds'))
+    print "  rows/sec:     %.1f%s" % (export ['rows_per_sec'], change('export', 'rows_per_sec'))
+    print "  requests:     %d%s" % (export ['requests'], change('export', 'requests'))
+    if export.has_key('bytes'):
+        print "  bytes:        %d%s" % (export ['bytes'], change('export', 'bytes'))
+    print "  peak RSS:     %d KB%s" % (export ['peak_rss_kb'], change('export', 'peak_rss_kb'))
+    if results.has_key('stages'):
+        stages = results ['stages']
+        print "Stages (sequential, %d rows in %.2f sec):" % (stages ['rows'], stages ['seconds'])
+        for stage in ('fetch', 'transform', 'write'):
+            print "  %-13s %.2f sec%s" % (stage + ':', stages [stage], change('stages', stage))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of mktoExportActivities.py with mktoMockServer.py')
+    mktoMockServer.addMockServerArguments(parser, port=0)
+    parser.add_argument(
+        '-i', '--instance',
+        type = str,
+        dest = 'instance',
+        required = False,
+        help = 'URL of running mktoMockServer.py. default: start a mock server in this process'
+	)
+    parser.add_argument(
+        '-c', '--since',
+        type = str,
+        dest = 'since',
+        required = False,
+        help = 'Since Date time passed to the export. default: --start of the mock server'
+	)
+    parser.add_argument(
+        '-f', '--change-data-field',
+        type = str,
+        dest = 'change_data_fields',
+        default = '',
+        help = "Same as mktoExportActivities.py. 'Lead Score' is always tracked"
+	)
+    parser.add_argument(
+        '-w', '--add-webvisit-activity',
+        action = 'store_true',
+        dest = 'web_activity',
+        default = False,
+        help = 'Same as mktoExportActivities.py'
+	)
+    parser.add_argument(
+        '-m', '--add-mail-activity',
+        action = 'store_true',
+        dest = 'mail_activity',
+        default = False,
+        help = 'Same as mktoExportActivities.py'
+	)
+    parser.add_argument(
+        '--max-calls',
+        type = int,
+        dest = 'max_calls',
+        default = 1000000,
+        help = 'Max number of API calls in 20 seconds used by the export. default: 1000000'
+	)
+    parser.add_argument(
+        '--skip-stages',
+        action = 'store_true',
+        dest = 'skip_stages',
+        default = False,
+        help = 'Skip measuring time per stage'
+	)
+    parser.add_argument(
+        '--save',
+        type = str,
+        dest = 'save',
+        required = False,
+        help = 'Save results as JSON, used as baseline of later runs'
+	)
+    parser.add_argument(
+        '--baseline',
+        type = str,
+        dest = 'baseline',
+        required = False,
+        help = 'Compare results with JSON saved by --save'
+	)
+    parser.add_argument(
+        'export_args',
+        nargs = argparse.REMAINDER,
+        help = 'Options of mktoExportActivities.py after --'
+	)
+    args = parser.parse_args()
+
+    extra_args = args.export_args
+    if extra_args and extra_args [0] == '--':
+        extra_args = extra_args [1:]
+    if args.since is None:
+        args.since = args.start
+
+    server = None
+    instance = args.instance
+    if instance is None:
+        server = mktoMockServer.createMockServer(args)
+        server.start()
+        instance = server.getInstanceUrl()
+
+    export_args = ['-c', args.since, '--max-calls', str(args.max_calls)]
+    if args.change_data_fields:
+        export_args.extend(['-f', args.change_data_fields])
+    if args.mail_activity:
+        export_args.append('-m')
+    if args.web_activity:
+        export_args.append('-w')
+    export_args += extra_args
+
+    try:
+        results = {'export_args': export_args,
+                   'export': runExport(instance, export_args)}
+        if not args.skip_stages:
+            results ['stages'] = measureStages(instance, args)
+    finally:
+        if server is not None:
+            server.stop()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    printResults(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
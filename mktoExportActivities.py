@@ -11,36 +11,537 @@ Options:
   -d --id <client id>               Marketo LaunchPoint Client Id: eg. 3d96eaef-f611-42a0-967f-00aeeee7e0ea
   -s --secret <client secret>       Marketo LaunchPoint Client Secret: eg. i8s6RRq1LhPlMyATEKfLWl1255bwzrF
   -c --since <date>                 Since Date time for calling Get Paging Token: eg. 2015-01-31
+  -u --until <date>                 Until Date time (exclusive) for stopping export: eg. 2015-02-28
   -l --listid                       ListId to filter leads (You can find the ID from URL like #ST443A1, 443 is list id)
   -g --debug                        Pring debugging information
   -j --not-use-jst                  Change TimeZone for Activity Date field. Default is JST.
   -f --change-data-field <fields>   Specify comma separated 'UI' fields name such as 'Behavior Score' for extracting from 'Data Value Changed' activities. default fields: 'Lead Score'
   -w --add-webvisit-activity        Adding Web Visit activity. It might be a cause of slowdown.
   -m --add-mail-activity            Adding mail open/click activity. It might be a cause of slowdown.
-    
+  --workers <num>                   Number of time windows fetched at the same time. requires --until. default: 1
+  --shard-by <day|week>             Size of time windows used by --workers. default: day
+  --async                           Fetch time windows of --workers by non-blocking requests on one thread
+  --max-calls <num>                 Max number of API calls in 20 seconds. default: 100
+  --max-concurrent <num>            Max number of API calls at the same time. default: 10
+  --daily-quota <num>               Max number of API calls used by this export. default: unlimited
+  --max-retries <num>               Max number of retries of transient errors such as 604, 5xx and timeouts. default: 8
+  --timeout <sec>                   Seconds until a request without response is retried. default: 300
+  --breaker-threshold <num>         Number of errors in a row which pause all requests. default: 5
+  --breaker-cooldown <sec>          Seconds all requests are paused by --breaker-threshold errors. It doubles up to 300 while errors continue. default: 30
+  --checkpoint <filename>           Checkpoint file name for resuming export with --resume
+  --checkpoint-interval <num>       Number of pages between checkpoints. default: 1000
+  --checkpoint-seconds <sec>        Seconds between checkpoints, whichever of --checkpoint-interval comes first. default: 300
+  --resume <filename>               Resume export from checkpoint file written by --checkpoint
+  --sync-state <filename>           State file for incremental sync. Only new activities since the last run are appended to output
+  --follow                          Keep polling new activities every --follow-interval seconds
+  --follow-interval <sec>           Seconds between polling with --follow. default: 300
+  --prefetch <num>                  Number of pages fetched and transformed ahead of writing. 0 disables it. default: 2
+  --transform-processes <num>       Number of processes transforming activities, partitioned by Lead Id. default: 1
+  --bulk                            Export activities by Bulk Extract jobs instead of paging Get Lead Activities
+  --bulk-window-days <num>          Number of days exported by one Bulk Extract job. default: 31
+  --bulk-poll-interval <sec>        First interval of polling Bulk Extract job status. default: 5
+  --lead-state-memory <MB>          Megabytes of memory for latest field values of leads. More leads are kept in a temporary SQLite file. 0 means unlimited. default: 1024
+  --seed-lead-values                Fill fields of leads appearing without New Lead activity with their current values, looked up by 300 leads in a call.
+  --lead-changes                    Fetch Change Data Value activities of --change-data-field fields only, by Get Lead Changes
+  --dedup-index <filename>          File of activity ids written so far. Activities in it are not written again, and written activities are added to it
+  --sort                            Write activities in order of Activity Date and id. Activities beyond --sort-buffer are sorted in temporary files
+  --sort-buffer <num>               Number of activities sorted in memory by --sort and each job of --bulk. default: 100000
+  --token-index <filename>          File of paging tokens at the start of each day, added while paging. Exports starting on a day in it skip Get Paging Token
+  --archive <directory>             Directory where raw pages of activities are archived as compressed NDJSON, which can be transformed again by mktoReplayActivities.py
+  --archive-compress <gzip|zstd>    Compression of --archive. zstd requires zstandard. default: gzip
+  --activity-types <ids>            Comma separated ids of other activity types to be exported, such as 2,6. Their primary attribute and attributes are added as columns
+  --activity-types-cache <filename> File caching result of Get Activity Types. default: ~/.mktoActivityTypes.json
+  --activity-types-ttl <sec>        Seconds until cached activity types are fetched again. default: 86400
+  --tz <timezone>                   TimeZone of Activity Date field such as America/New_York. -j keeps UTC. default: Asia/Tokyo
+  --columnar                        Convert Activity Date of each page at once with numpy. It requires numpy.
+  --format <csv|parquet>            Output format. parquet requires pyarrow and --output. default: csv
+  --partition-by <date,type>        Comma separated date and/or type. Parquet files are written into directories such as activity_date=2015-04-09/activity_type_id=12 under --output
+  --row-group-size <num>            Number of rows in a Parquet row group. default: 100000
+  --compress <gzip|zstd>            Compress csv output on background threads. zstd requires zstandard.
+  --rotate-rows <num>               Number of rows in a chunk file of csv output. default: unlimited
+  --rotate-size <MB>                Megabytes of csv (before compression) in a chunk file. default: unlimited
+  --compress-threads <num>          Number of chunk files compressed at the same time. default: 2
+  --fast-json                       Decode responses with ujson. It requires ujson.
+  --debug-sample <num>              Print every <num>th page of activities with --debug. default: 1
+  --stats-interval <sec>            Print a JSON line of requests, latency, waits, stage times and rows/sec to stderr every <sec> and at the end. default: 0 (off)
+  --prometheus-file <filename>      Write the same metrics as Prometheus textfile every --stats-interval (or 15) seconds and at the end
+  --profile <filename>              Profile the run and write the results into <filename>
+  --profiler <sample|cprofile>      sample: sampling stacks of all threads, written as collapsed stacks. cprofile: cProfile of the main thread, written as pstats. default: sample
+
 Mail bug reports and suggestion to : Yukio Y <unknot304 AT gmail.com>
 
 Please refer Market REST API documents: http://docs.marketo.com
 Search article with "Create a Custom Service for Use with ReST API"
 """
 
-import sys, os, errno  
+import sys, os, errno
 import argparse
 import csv
-import getpass    
+import getpass
 
 import time
 import json
 import httplib2
 import logging
 import pytz
-from datetime import datetime
+import threading
+import Queue
+import collections
+import itertools
+import functools
+import base64
+import zlib
+import urllib
+import urllib2
+import httplib
+import socket
+import random
+import sqlite3
+import tempfile
+import hashlib
+import cStringIO
+import heapq
+import bisect
+import array
+import struct
+import cPickle
+import marshal
+import multiprocessing
+import traceback
+import atexit
+import cProfile
+import pstats
+import select
+import ssl
+import types
+import urlparse
+from datetime import datetime, timedelta
+
+# numpy is optional, it is used only by --columnar
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# pyarrow is optional, it is used only by --format parquet
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# zstandard is optional, it is used only by --compress zstd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ujson is optional, it is used only by --fast-json
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
- 
 # Reference:
 # Marketo REST API: http://developers.marketo.com/documentation/rest/
 
 
+# -------
+# Raised when Marketo REST API returns an error which can not be recovered
+#
+#    code: REST API Error Code such as "603"
+#    message: error message returned by REST API
+#
+class MarketoError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, code, message)
+        self.code = code
+        self.message = message
+
+
+# -------
+# Client side rate limiter shared by all threads calling Marketo REST API
+#
+#    max_calls: number of calls allowed in period. Marketo allows 100 calls in 20 seconds
+#    period: length of sliding window in seconds
+#    max_concurrent: number of calls in flight at the same time. Marketo allows 10
+#    daily_quota: number of calls this limiter may issue in total, None means unlimited
+#
+# A call is counted from acquire() until period seconds after release(). Marketo counts
+# a call when the request arrives, which is always before we see the response, so our
+# window never ends earlier than the one on the server and 606 is not returned.
+#
+class RateLimiter:
+    def __init__(self, max_calls=100, period=20.0, max_concurrent=10, daily_quota=None):
+        self.max_calls = max_calls
+        self.period = period
+        self.max_concurrent = max_concurrent
+        self.daily_quota = daily_quota
+
+        self.condition = threading.Condition()
+        self.finished_times = collections.deque()
+        self.running = 0
+        self.calls = 0
+
+    # block until a call is allowed. MarketoError "607" is raised if daily_quota is used up
+    def acquire(self):
+        with self.condition:
+            while True:
+                acquired, wait = self._tryAcquire()
+                if acquired:
+                    return
+                self.condition.wait(wait)
+
+    # acquire a call without blocking, for callers which can not wait on condition such as
+    # EventLoop. return 0 if acquired, or seconds to wait before trying again
+    def tryAcquire(self, poll_interval=0.05):
+        with self.condition:
+            acquired, wait = self._tryAcquire()
+        if acquired:
+            return 0
+        if wait is None:
+            # released calls are not notified to callers of this method
+            return poll_interval
+        return max(wait, 0.001)
+
+    # return (True, None) if a call is acquired, or (False, seconds to wait). None means waiting
+    # for release(). called with condition held
+    def _tryAcquire(self):
+        if self.daily_quota is not None and self.calls >= self.daily_quota:
+            raise MarketoError("607", "Daily quota '" + str(self.daily_quota) + "' of this export has been used up")
+
+        now = time.time()
+        while self.finished_times and self.finished_times [0] <= now - self.period:
+            self.finished_times.popleft()
+
+        wait = None
+        if len(self.finished_times) + self.running >= self.max_calls:
+            if self.finished_times:
+                wait = self.finished_times [0] + self.period - now
+        elif self.running < self.max_concurrent:
+            self.running += 1
+            self.calls += 1
+            return True, None
+        return False, wait
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.finished_times.append(time.time())
+            self.condition.notify_all()
+
+
+# -------
+# Classifying errors of REST API and transport, and waiting time before retrying them
+#
+#    max_retries: number of retries of a transient error such as 604, 5xx and socket errors
+#    max_rate_retries: number of retries of rate limit errors (606 and 615)
+#    max_token_retries: number of retries after refreshing access token (601 and 602)
+#    base_wait/max_wait: first and max seconds of exponential backoff
+#
+# errors are retryable ('token', 'rate' and 'transient'), 'quota' (daily quota is used up,
+# export can be resumed tomorrow) or 'fatal'. backoff doubles on each retry, and a random
+# half of it is taken off, so threads failing together do not retry together.
+#
+class RetryPolicy:
+    token_codes = ('601', '602')
+    rate_codes = ('606', '615')
+    transient_codes = ('604', '608', '611', '713', '1029', 'timeout', 'connection', 'invalid response')
+    quota_codes = ('607',)
+
+    def __init__(self, max_retries=8, max_rate_retries=20, max_token_retries=3, base_wait=1.0, max_wait=60.0):
+        self.limits = {'transient': max_retries, 'rate': max_rate_retries, 'token': max_token_retries}
+        self.base_wait = base_wait
+        self.max_wait = max_wait
+
+    def classify(self, code):
+        if code in self.token_codes:
+            return 'token'
+        if code in self.rate_codes:
+            return 'rate'
+        if code in self.quota_codes:
+            return 'quota'
+        if code in self.transient_codes or code.startswith('HTTP 5'):
+            return 'transient'
+        return 'fatal'
+
+    # number of retries allowed for kind of error. 0 means the error is raised
+    def getLimit(self, kind):
+        return self.limits.get(kind, 0)
+
+    # return (kind, seconds to wait) of the next retry of error, or raise MarketoError if it
+    # can not be retried any more. attempts counts retries of each kind for a request
+    def nextRetry(self, code, message, attempts):
+        kind = self.classify(code)
+        attempt = attempts.get(kind, 0)
+        if attempt >= self.getLimit(kind):
+            if attempt:
+                message = message + ' (retried ' + str(attempt) + ' times)'
+            raise MarketoError(code, message)
+        attempts [kind] = attempt + 1
+        return kind, self.getWait(kind, attempt)
+
+    # seconds to wait before retry of attempt (0 for the first retry)
+    def getWait(self, kind, attempt):
+        if kind == 'token':
+            return 0.0
+        wait = min(self.max_wait, self.base_wait * (2 ** attempt))
+        if kind == 'rate':
+            # Marketo counts calls in 20 seconds
+            wait = max(wait, 2.0)
+        return wait * random.uniform(0.5, 1.0)
+
+
+# -------
+# Pausing all threads while Marketo instance looks degraded
+#
+#    threshold: number of retryable errors in a row which opens the breaker
+#    cooldown: seconds all requests are paused after the breaker is opened
+#    max_cooldown: cooldown doubles each time the breaker is opened again without a success
+#
+# instead of each thread backing off on its own, the first request after cooldown probes
+# the instance. a success closes the breaker, a failure opens it again.
+#
+class CircuitBreaker:
+    def __init__(self, threshold=5, cooldown=30.0, max_cooldown=300.0):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.condition = threading.Condition()
+        self.failures = 0
+        self.cooldown = cooldown
+        self.open_until = 0
+        self.opened = 0
+
+    # block while the breaker is open, and return seconds waited
+    def wait(self):
+        waited = 0.0
+        with self.condition:
+            while True:
+                remaining = self.open_until - time.time()
+                if remaining <= 0:
+                    return waited
+                self.condition.wait(remaining)
+                waited += remaining
+
+    def recordSuccess(self):
+        with self.condition:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+
+    # return True if this failure opened the breaker
+    def recordFailure(self):
+        with self.condition:
+            self.failures += 1
+            now = time.time()
+            if self.failures < self.threshold or now < self.open_until:
+                return False
+            self.open_until = now + self.cooldown
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.opened += 1
+            return True
+
+
+# encode query string of REST API. parameters of None are omitted
+def encodeQuery(params):
+    query = []
+    for name, value in params:
+        if value is None:
+            continue
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        query.append((name, value))
+    return urllib.urlencode(query)
+
+# return (None, decoded json) of successful response of REST API, or (code, message) of error
+def checkRestResponse(status, reason, content, json_decoder):
+    if status >= 400:
+        return 'HTTP ' + str(status), reason
+    try:
+        data = json_decoder(content)
+    except ValueError:
+        # such as html of proxy or truncated body
+        return 'invalid response', content [:100]
+    if data.get('success', True) == False:
+        errors = data.get('errors') or [{'code': 'unknown', 'message': 'no errors in response'}]
+        return str(errors [0] ['code']), errors [0] ['message']
+    return None, data
+
+
+# -------
+# Pool of keep-alive http connections shared by all threads calling Marketo REST API
+#
+#    size: max number of idle connections kept in the pool. it should be the number of
+#          threads calling the API at the same time
+#    timeout: socket timeout in seconds. None means no timeout
+#
+# httplib2.Http is not thread safe, so a request takes a connection from the pool and puts
+# it back after the response has been read. if the pool is empty, a new one is opened.
+# responses compressed with gzip are decoded by httplib2.
+#
+class HttpTransport:
+    def __init__(self, size=10, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.pool = Queue.LifoQueue(size)
+        self.opened = 0
+
+    # return response headers and body
+    def request(self, url, method='GET', body='', headers=None):
+        try:
+            http_client = self.pool.get_nowait()
+        except Queue.Empty:
+            http_client = httplib2.Http(timeout=self.timeout)
+            self.opened += 1
+        # connection broken by an exception is not put back
+        response, content = http_client.request(url, method, body, headers)
+        try:
+            self.pool.put_nowait(http_client)
+        except Queue.Full:
+            self._closeClient(http_client)
+        return response, content
+
+    def _closeClient(self, http_client):
+        for connection in http_client.connections.values():
+            connection.close()
+
+    # close idle connections
+    def close(self):
+        while True:
+            try:
+                self._closeClient(self.pool.get_nowait())
+            except Queue.Empty:
+                break
+
+
+# -------
+# Counters and latency histograms of an export, shared by clients and the export loop
+#
+#    buckets: upper bounds of latency histograms in seconds
+#
+# Requests are counted by endpoint (path of REST API) and result, which is "success" or the
+# error code such as "606", "HTTP 503" and "timeout". Seconds are added up by stage, such as
+# waiting for rate limit or access token, decoding json, transforming and writing. Rows are
+# counted by activity type id. All the methods are thread safe.
+#
+class ExportMetrics:
+    default_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = {}
+        self.seconds = {}
+        self.rows = {}
+
+    # count a request of endpoint which took seconds. code is None if it is successful.
+    # seconds waiting for rate limit and decoding the response are added up too
+    def observeRequest(self, endpoint, seconds, code=None, rate_limit_wait=0.0, decode=0.0):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.seconds ['rate_limit_wait'] = self.seconds.get('rate_limit_wait', 0.0) + rate_limit_wait
+            self.seconds ['decode'] = self.seconds.get('decode', 0.0) + decode
+            stats = self.requests.get(endpoint)
+            if stats is None:
+                stats = self.requests [endpoint] = {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(self.buckets) + 1), 'results': {}}
+            stats ['count'] += 1
+            stats ['sum'] += seconds
+            stats ['buckets'][index] += 1
+            result = code or 'success'
+            stats ['results'][result] = stats ['results'].get(result, 0) + 1
+
+    def addTime(self, stage, seconds):
+        with self.lock:
+            self.seconds [stage] = self.seconds.get(stage, 0.0) + seconds
+
+    # count rows (ActivityRecords or csv rows) by activity type id
+    def addRows(self, rows):
+        counts = {}
+        for row in rows:
+            activityTypeId = row [2]
+            counts [activityTypeId] = counts.get(activityTypeId, 0) + 1
+        with self.lock:
+            for activityTypeId, count in counts.iteritems():
+                self.rows [activityTypeId] = self.rows.get(activityTypeId, 0) + count
+
+    # upper bound of the bucket where quantile of requests falls
+    def _getQuantile(self, buckets, count, quantile):
+        rank = quantile * count
+        total = 0
+        for index, bucket_count in enumerate(buckets):
+            total += bucket_count
+            if total >= rank:
+                return self.buckets [min(index, len(self.buckets) - 1)]
+        return self.buckets [-1]
+
+    # dict of current values, written as a JSON stats line
+    def getSnapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.started_at
+            rows = sum(self.rows.values())
+            snapshot = {'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                        'elapsed': elapsed,
+                        'rows': rows,
+                        'rows_per_sec': rows / elapsed if elapsed > 0 else 0.0,
+                        'rows_by_type': {},
+                        'requests': {},
+                        'seconds': dict(self.seconds)}
+            for activityTypeId, count in self.rows.iteritems():
+                snapshot ['rows_by_type'][str(activityTypeId)] = {'rows': count, 'rows_per_sec': count / elapsed if elapsed > 0 else 0.0}
+            for endpoint, stats in self.requests.iteritems():
+                count = stats ['count']
+                snapshot ['requests'][endpoint] = {'count': count,
+                                                   'errors': count - stats ['results'].get('success', 0),
+                                                   'results': dict(stats ['results']),
+                                                   'mean': stats ['sum'] / count,
+                                                   'p50': self._getQuantile(stats ['buckets'], count, 0.5),
+                                                   'p95': self._getQuantile(stats ['buckets'], count, 0.95),
+                                                   'p99': self._getQuantile(stats ['buckets'], count, 0.99)}
+            return snapshot
+
+    # current values in Prometheus text format, for textfile collector of node_exporter
+    def formatPrometheus(self, prefix='mkto_export'):
+        def label(value):
+            return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+        lines = []
+        with self.lock:
+            lines.append('# HELP ' + prefix + '_requests_total Requests of REST API by endpoint and result')
+            lines.append('# TYPE ' + prefix + '_requests_total counter')
+            for endpoint in sorted(self.requests):
+                for result, count in sorted(self.requests [endpoint]['results'].iteritems()):
+                    lines.append(prefix + '_requests_total{endpoint=' + label(endpoint) + ',result=' + label(result) + '} ' + str(count))
+
+            lines.append('# HELP ' + prefix + '_request_duration_seconds Latency of requests of REST API by endpoint')
+            lines.append('# TYPE ' + prefix + '_request_duration_seconds histogram')
+            for endpoint in sorted(self.requests):
+                stats = self.requests [endpoint]
+                total = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), stats ['buckets']):
+                    total += bucket_count
+                    lines.append(prefix + '_request_duration_seconds_bucket{endpoint=' + label(endpoint) + ',le=' + label(bound) + '} ' + str(total))
+                lines.append(prefix + '_request_duration_seconds_sum{endpoint=' + label(endpoint) + '} ' + repr(stats ['sum']))
+                lines.append(prefix + '_request_duration_seconds_count{endpoint=' + label(endpoint) + '} ' + str(stats ['count']))
+
+            lines.append('# HELP ' + prefix + '_stage_seconds_total Seconds spent by stage of the export')
+            lines.append('# TYPE ' + prefix + '_stage_seconds_total counter')
+            for stage, seconds in sorted(self.seconds.iteritems()):
+                lines.append(prefix + '_stage_seconds_total{stage=' + label(stage) + '} ' + repr(seconds))
+
+            lines.append('# HELP ' + prefix + '_rows_total Rows exported by activity type id')
+            lines.append('# TYPE ' + prefix + '_rows_total counter')
+            for activityTypeId, count in sorted(self.rows.iteritems()):
+                lines.append(prefix + '_rows_total{activity_type_id=' + label(activityTypeId) + '} ' + str(count))
+
+            lines.append('# HELP ' + prefix + '_elapsed_seconds Seconds since the export started')
+            lines.append('# TYPE ' + prefix + '_elapsed_seconds gauge')
+            lines.append(prefix + '_elapsed_seconds ' + repr(time.time() - self.started_at))
+        return '\n'.join(lines) + '\n'
+
+
 # -------
 # Base class for all the rest service
 #
@@ -48,647 +549,4665 @@ from datetime import datetime
 #    grant_type: client_credentials
 #    client_id: eg. 3d96eaef-f611-42a0-967f-002fasdweeea
 #    client_secret: eg. i8s6RRq1LhPlMyATEKfLW2300CMbwzrF
+#    rate_limiter: RateLimiter shared by all requests, default limiter is used if None
+#    transport: HttpTransport sending requests, default transport is used if None
+#    json_decoder: function decoding response body such as ujson.loads. default: json.loads
+#    retry_policy: RetryPolicy for errors of requests, default policy is used if None
+#    circuit_breaker: CircuitBreaker shared by all requests, default breaker is used if None
+#
+# Access token is refreshed by a background timer refresh_margin seconds (at most half of its
+# lifetime) before it expires.
+# If a request finds the token (almost) expired, it waits for a single refresh shared by all
+# threads, instead of sending a request which is rejected with 602.
+#
+# get*Raw methods return successful responses only. Retryable errors are retried by
+# _request, and others are raised as MarketoError. Connection errors are not retried until
+# the instance has responded once, so a wrong host fails at once. Retries are counted by error code
+# in getRetryStats(). Requests and time waiting for rate limit, access token and retries
+# are counted in metrics (ExportMetrics).
 #
 class MarketoClient:
-    def __init__(self, mkto_instance, grant_type, client_id, client_secret, list_id):
-        self.identity_url = mkto_instance + '/identity'
+    refresh_margin = 60.0
+    def __init__(self, mkto_instance, grant_type, client_id, client_secret, list_id, rate_limiter=None, transport=None, json_decoder=None,
+                 retry_policy=None, circuit_breaker=None, metrics=None):
         self.endpoint_url = mkto_instance
-        self.access_token_url = self.identity_url + '/oauth/token?grant_type=' + grant_type + '&client_id=' + client_id + '&client_secret=' + client_secret
+        self.token_params = [('grant_type', grant_type), ('client_id', client_id), ('client_secret', client_secret)]
 
         self.request_headers = {'Accept': 'application/json',
+                                'Accept-Encoding': 'gzip',
                                 'Content-Type': 'application/json; charset=UTF-8'
                                 }
-        self.http_client = httplib2.Http()
+        self.thread_local = threading.local()
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
+        if transport is None:
+            transport = HttpTransport()
+        self.transport = transport
+        if json_decoder is None:
+            json_decoder = json.loads
+        self.json_decoder = json_decoder
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker
+        if metrics is None:
+            metrics = ExportMetrics()
+        self.metrics = metrics
+        self.retry_lock = threading.Lock()
+        self.retry_stats = {}
         self.debug = False
+        self.debug_sample = 1
+        self.debug_pages = itertools.count()
         self.list_id = list_id
+        # True after the first response of the instance
+        self.connected = False
+
+        # access token lifecycle
+        self.token_condition = threading.Condition()
+        self.token_refreshing = False
+        self.token_timer = None
+        self.closed = False
+        self.access_token = None
+        self.token_expires_at = 0
+        self.expired_token_time = None
+        self.token_refreshes = 0
+        self.proactive_refreshes = 0
+        self.reactive_refreshes = 0
+        self.avoided_602 = 0
 
         # send request
-        response, content = self.http_client.request(self.access_token_url, 'GET', '', self.request_headers)
-        data = json.loads(content)
-        self.access_token = data ['access_token']
+        self._refreshAccessToken(None, False)
         # print >> sys.stderr, "Access Token: " + self.access_token
-        # print >> sys.stderr, "Access Token Expired in", data ['expires_in']
 
 
+    # send request by transport, and return decoded json of successful response
+    # every request waits for rate_limiter, so we don't exceed rate limit of Marketo
+    def _request(self, path, params=(), method='GET', body='', authenticate=True):
+        attempts = {}
+        while True:
+            self._waitCircuitBreaker()
+            url = self._getUrl(path, params, authenticate)
+            response = None
+            wait_start = time.time()
+            self.rate_limiter.acquire()
+            request_start = time.time()
+            try:
+                response, content = self.transport.request(url, method, body, self.request_headers)
+            except socket.timeout, e:
+                code, message = 'timeout', str(e)
+            except (socket.error, httplib.HTTPException, httplib2.HttpLib2Error), e:
+                code, message = 'connection', str(e) or e.__class__.__name__
+            finally:
+                self.rate_limiter.release()
+            request_end = time.time()
+
+            if response is not None:
+                self.connected = True
+                code, message = checkRestResponse(response.status, response.reason, content, self.json_decoder)
+            self.metrics.observeRequest(path, request_end - request_start, code, request_start - wait_start, time.time() - request_end)
+            if code is None:
+                self.circuit_breaker.recordSuccess()
+                return message
+            self._retryOrRaise(code, message, attempts)
+
+    # sleep before retrying error, or raise MarketoError if it is not retryable.
+    # attempts counts retries of each kind of error for a request
+    def _retryOrRaise(self, code, message, attempts):
+        if code == 'connection' and not self.connected:
+            # wrong host name or port. it is not worth retrying with backoff and circuit breaker
+            raise MarketoError(code, message)
+        kind, wait = self.retry_policy.nextRetry(code, message, attempts)
+        if kind == 'token':
+            if self.debug:
+                print >> sys.stderr, "Access Token has been expired. Now updating..."
+            wait_start = time.time()
+            self.updateAccessToken()
+            self.metrics.addTime('token_wait', time.time() - wait_start)
+        else:
+            if self.circuit_breaker.recordFailure():
+                print >> sys.stderr, "Too many errors. Requests are paused for " + str(int(self.circuit_breaker.open_until - time.time())) + " sec..."
+            if self.debug:
+                print >> sys.stderr, "Error " + code + " (" + message + "). Retrying in %.1f sec..." % wait
+            time.sleep(wait)
+            self.metrics.addTime('retry_wait', wait)
+        self._recordRetry(code, wait)
+
+    def _waitCircuitBreaker(self):
+        waited = self.circuit_breaker.wait()
+        if waited:
+            self._recordRetry('circuit breaker', waited)
+            self.metrics.addTime('retry_wait', waited)
+
+    def _recordRetry(self, code, wait, retries=1):
+        with self.retry_lock:
+            stats = self.retry_stats.setdefault(code, {'retries': 0, 'seconds': 0.0})
+            stats ['retries'] += retries
+            stats ['seconds'] += wait
+
+    # number of retries and seconds waited for each error code
+    def getRetryStats(self):
+        with self.retry_lock:
+            return dict((code, dict(stats)) for code, stats in self.retry_stats.iteritems())
+
+    # url of REST API with access token and query parameters
+    def _getUrl(self, path, params=(), authenticate=True):
+        query = []
+        if authenticate:
+            query.append(('access_token', self._getAccessToken()))
+        return self.endpoint_url + path + '?' + encodeQuery(query + list(params))
+
+    # return access token for next request. if it has been expired (or will expire
+    # in a second), wait for the refresh instead of getting 602
+    def _getAccessToken(self):
+        with self.token_condition:
+            access_token = self.access_token
+            expired = time.time() >= self.token_expires_at - 1.0
+            if expired or (self.expired_token_time is not None and time.time() >= self.expired_token_time):
+                # this request would have been rejected with the old token
+                self.avoided_602 += 1
+                self.expired_token_time = None
+        if expired:
+            wait_start = time.time()
+            self._refreshAccessToken(access_token, False)
+            self.metrics.addTime('token_wait', time.time() - wait_start)
+            with self.token_condition:
+                access_token = self.access_token
+        self.thread_local.access_token = access_token
+        return access_token
+
+    # refresh access token unless other thread has already replaced stale_token.
+    # concurrent callers wait for the refresh in flight instead of starting their own
+    def _refreshAccessToken(self, stale_token, proactive):
+        with self.token_condition:
+            while self.token_refreshing:
+                self.token_condition.wait()
+            if self.access_token != stale_token:
+                return
+            self.token_refreshing = True
+
+        try:
+            while True:
+                data = self._request('/identity/oauth/token', self.token_params, authenticate=False)
+                access_token = data ['access_token']
+                expires_in = data ['expires_in']
+                # Marketo returns the same token until it expires. if it is about to expire,
+                # wait for a new one
+                if stale_token is None or access_token != stale_token or expires_in >= 2:
+                    break
+                time.sleep(expires_in + 1.0)
+        except:
+            with self.token_condition:
+                self.token_refreshing = False
+                self.token_condition.notify_all()
+            raise
+
+        with self.token_condition:
+            old_expires_at = self.token_expires_at
+            self.access_token = access_token
+            self.token_expires_at = time.time() + expires_in
+            if stale_token is not None:
+                self.token_refreshes += 1
+                if proactive:
+                    self.proactive_refreshes += 1
+                    if access_token != stale_token and time.time() < old_expires_at:
+                        self.expired_token_time = old_expires_at
+                else:
+                    self.reactive_refreshes += 1
+            self.token_refreshing = False
+            self.token_condition.notify_all()
+
+            if self.debug:
+                print >> sys.stderr, "Access Token Expired in", expires_in
+
+            # refresh_margin seconds (or half of the lifetime of a short lived token) before
+            # expiration. if we got the same token which expires soon, refresh again just after
+            # expiration
+            if access_token != stale_token:
+                delay = expires_in - min(self.refresh_margin, expires_in / 2.0)
+            else:
+                delay = expires_in + 1.0
+            if self.token_timer is not None:
+                self.token_timer.cancel()
+            if self.closed:
+                return
+            self.token_timer = threading.Timer(delay, self._refreshInBackground, [access_token])
+            self.token_timer.daemon = True
+            self.token_timer.start()
+
+    def _refreshInBackground(self, stale_token):
+        try:
+            self._refreshAccessToken(stale_token, True)
+        except Exception, e:
+            # request path refreshes it when the token expires
+            if self.debug:
+                print >> sys.stderr, "Failed to refresh Access Token: ", e
+
+    # counters of access token refreshes
+    def getTokenStats(self):
+        with self.token_condition:
+            return {'refreshes': self.token_refreshes,
+                    'proactive_refreshes': self.proactive_refreshes,
+                    'reactive_refreshes': self.reactive_refreshes,
+                    'avoided_602': self.avoided_602}
+
+    # stop background refresh of access token and close idle connections
+    def close(self):
+        with self.token_condition:
+            self.closed = True
+            token_timer = self.token_timer
+            self.token_timer = None
+        if token_timer is not None and token_timer is not threading.current_thread():
+            token_timer.cancel()
+            token_timer.join()
+        self.transport.close()
+
     # get lead by id
     def getLeadRaw(self, id, fields):
-        leads_url = self.endpoint_url + '/rest/v1/lead/' + id + '.json?access_token=' + self.access_token
-        leads_url = leads_url + '&files=' + fields
-        response, content = self.http_client.request(leads_url, 'GET', '', self.request_headers)
-        data = json.loads(content)
+        data = self._request('/rest/v1/lead/' + id + '.json', [('fields', fields)])
         # print >> sys.stderr, data
         return data
 
     # get leads by filter
     def getLeadsRaw(self, filter_type, filter_values, fields):
-        leads_url = self.endpoint_url + '/rest/v1/leads.json?access_token=' + self.access_token
-        leads_url = leads_url + '&filterType=' + filter_type + '&filterValues=' + filter_values + '&fields=' + fields
-        response, content = self.http_client.request(leads_url, 'GET', '', self.request_headers)
-        data = json.loads(content)
+        data = self._request('/rest/v1/leads.json', [('filterType', filter_type), ('filterValues', filter_values), ('fields', fields)])
         # print >> sys.stderr, data
         return data
 
     # get Paging Token, since may be formatted as "2015-04-10"
     def getPagingToken(self, since):
-        leads_url = self.endpoint_url + '/rest/v1/activities/pagingtoken.json?access_token=' + self.access_token
-        leads_url = leads_url + '&sinceDatetime=' + since
-        response, content = self.http_client.request(leads_url, 'GET', '', self.request_headers)
-        data = json.loads(content)
+        data = self._request('/rest/v1/activities/pagingtoken.json', [('sinceDatetime', since)])
         pageToken = data ['nextPageToken']
         # print >> sys.stderr, data
         return pageToken
 
     # get lead changes
     def getLeadChangesRaw(self, token, fields):
-        leads_url = self.endpoint_url + '/rest/v1/activities/leadchanges.json?access_token=' + self.access_token
-        leads_url = leads_url + '&nextPageToken=' + token + '&fields=' + fields
-        response, content = self.http_client.request(leads_url, 'GET', '', self.request_headers)
-        data = json.loads(content)
+        data = self._request('/rest/v1/activities/leadchanges.json', [('nextPageToken', token), ('fields', fields), ('listId', self.list_id or None)])
         # print >> sys.stderr, data
         return data
 
     # get lead activities. activity_type_ids may take Click Link in Email(11), Web Visit(1) and Click Link on a page(3)
     def getLeadActivitiesRaw(self, token, activity_type_ids):
-        leads_url = self.endpoint_url + '/rest/v1/activities.json?access_token=' + self.access_token
-        #leads_url = leads_url + '&nextPageToken=' + token + '&activityTypeIds=1&activityTypeIds=11&activityTypeIds=3'
-        leads_url = leads_url + '&nextPageToken=' + token + '&activityTypeIds=' + activity_type_ids
-        if self.list_id:
-            leads_url = leads_url + '&listId=' + self.list_id
-        response, content = self.http_client.request(leads_url, 'GET', '', self.request_headers)
-        data = json.loads(content)
+        data = self._request('/rest/v1/activities.json', [('nextPageToken', token), ('activityTypeIds', activity_type_ids), ('listId', self.list_id or None)])
         # print >> sys.stderr, data
         return data
 
     # get activity Types
     def getActivityTypesRaw(self):
-        leads_url = self.endpoint_url + '/rest/v1/activities/types.json?access_token=' + self.access_token
-        response, content = self.http_client.request(leads_url, 'GET', '', self.request_headers)
-        data = json.loads(content)
+        data = self._request('/rest/v1/activities/types.json')
+        # print >> sys.stderr, data
+        return data
+
+    # describe lead fields, displayName is 'UI' field name and rest.name is used by REST API
+    def getLeadFieldsRaw(self):
+        data = self._request('/rest/v1/leads/describe.json')
+        # print >> sys.stderr, data
+        return data
+
+    # create bulk activity export job. start_at/end_at may be formatted as "2015-04-10T00:00:00Z"
+    def createActivityExportJobRaw(self, start_at, end_at, activity_type_ids):
+        body = {'format': 'CSV',
+                'filter': {'createdAt': {'startAt': start_at, 'endAt': end_at},
+                           'activityTypeIds': [int(id) for id in activity_type_ids.split(',')]}}
+        data = self._request('/bulk/v1/activities/export/create.json', method='POST', body=json.dumps(body))
+        # print >> sys.stderr, data
+        return data
+
+    # put bulk activity export job into the queue of Marketo
+    def enqueueActivityExportJobRaw(self, export_id):
+        data = self._request('/bulk/v1/activities/export/' + export_id + '/enqueue.json', method='POST')
+        # print >> sys.stderr, data
+        return data
+
+    # get status of bulk activity export job
+    def getActivityExportJobStatusRaw(self, export_id):
+        data = self._request('/bulk/v1/activities/export/' + export_id + '/status.json')
         # print >> sys.stderr, data
         return data
-        
+
+    # open csv file of completed bulk activity export job. httplib2 reads whole body into memory,
+    # so file is opened by urllib2 and caller reads it line by line
+    def openActivityExportFile(self, export_id):
+        attempts = {}
+        while True:
+            self._waitCircuitBreaker()
+            export_url = self._getUrl('/bulk/v1/activities/export/' + export_id + '/file.json')
+            self.rate_limiter.acquire()
+            try:
+                response = urllib2.urlopen(urllib2.Request(export_url, headers={'Accept': 'text/csv'}), timeout=self.transport.timeout)
+                self.circuit_breaker.recordSuccess()
+                return response
+            except urllib2.HTTPError, e:
+                code, message = 'HTTP ' + str(e.code), str(e.reason)
+            except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+                code, message = 'connection', str(e)
+            finally:
+                self.rate_limiter.release()
+            self._retryOrRaise(code, message, attempts)
+
+    # called when access token used by this thread has been rejected with 602
     def updateAccessToken(self):
-        response, content = self.http_client.request(self.access_token_url, 'GET', '', self.request_headers)
-        data = json.loads(content)
-        self.access_token = data ['access_token']
+        stale_token = getattr(self.thread_local, 'access_token', self.access_token)
+        self._refreshAccessToken(stale_token, False)
         # print >> sys.stderr, self.access_token
-        print >> sys.stderr, "Access Token Expired in", data ['expires_in']
         # timestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d %H:%M:%S')
 
-    def enableDebug(self):
+    # print requests and every sample-th page of activities
+    def enableDebug(self, sample=1):
         httplib2.debuglevel = 1
         self.debug = True
+        self.debug_sample = sample
 
-if __name__ == "__main__": 
-    parser = argparse.ArgumentParser(description='Extract Lead Activities via Marketo API')
-    parser.add_argument(
-        '-i', '--instance',
-        type = str,
-        dest = 'mkto_instance',
-        required = True,
-        help = 'Marketo REST API Instance URL such as https://123-XYZ-456.mktorest.com'
-	)
-    parser.add_argument(
-        '-d', '--id',
-        type = str,
-        dest = 'mkto_client_id',
-        required = True,
-        help = 'Marketo LaunchPoint Client Id: eg. 3d96eaef-f611-42a0-967f-00aeeee7e0ea'
-	)
-    parser.add_argument(
-        '-s', '--secret',
-        type = str,
-        dest = 'mkto_client_secret',
-        required = True,
-        help = 'Marketo LaunchPoint Client Secret: eg. i8s6RRq1LhPlMyATEKfLWl1255bwzrF'
-	)
-    parser.add_argument(
-        '-l', '--listid',
-        type = str,
-        dest = 'mkto_list_id',
-        required = False,
-        help = 'List Id: eg. 443 (please extract it from URL on Marketo)'
-	)
-    parser.add_argument(
-        '-o', '--output',
-        type = str,
-        dest = 'output_file',
-        required = False,
-        help = 'Output file name'
-	)
-    parser.add_argument(
-        '-c', '--since',
-        type = str,
-        dest = 'mkto_date',
-        required = True,
-        help = 'sinceDate time for calling Get Paging Token: eg. 2015-01-31'
-	)
-    parser.add_argument(
-        '-g', '--debug',
-        action='store_true',
-        dest = 'debug',
-        default = False,
-        required = False,
-        help = 'Pring debugging information'
-	)
-    parser.add_argument(
-        '-j', '--not-use-jst',
-        action='store_true',
-        dest = 'not_jst',
-        default = False,
-        required = False,
-        help = 'Change TimeZone for Activity Date field. Default is JST.'
-	)
-    parser.add_argument(
-        '-f', '--change-data-fields',
-        type = str,
-        dest = 'change_data_fields',
-        required = False,
-        help = 'Specify comma separated "UI" fields name such as "Behavior Score" for extracting from "Data Value Changed" activities. default fields: "Lead Score"'
-	)
-    parser.add_argument(
-        '-m', '--add-mail-activity',
-        action = 'store_true',
-        dest = 'mail_activity',
-        default = False,
-        required = False,
-        help = 'Adding mail open/click activity. It might be a cause of slowdown.'
-	)
-    parser.add_argument(
-        '-w', '--add-webvisit-activity',
-        action = 'store_true',
-        dest = 'web_activity',
-        default = False,
-        required = False,
-        help = 'Adding Web Visit activity. It might be a cause of slowdown.'
-	)
-    
-    args = parser.parse_args()
+    # True if the next page is printed in debug mode. pages are counted by all threads
+    def isDebugPage(self):
+        return self.debug and next(self.debug_pages) % self.debug_sample == 0
 
-    # initiate file handler, selecting file output or stdout according to command arguments
-    if args.output_file:
-        fh = open(args.output_file, 'w')
-    else:
-        fh = sys.stdout
-    mywriter = csv.writer(fh, delimiter = ',')
 
+# -------
+# Latest values of tracking fields for each lead
+#
+#    fields: 'UI' fields name. the same field may be given more than once
+#    memory_limit: approximate bytes of leads kept in memory. None means unlimited
+#    spill_dir: directory of SQLite file used after memory_limit is exceeded. default: temp directory
+#
+# each lead is one list of values (None means the value is not known yet). leads in memory
+# are kept in two generations, recent leads and older leads. when recent leads fill half of
+# memory_limit, older leads are written into SQLite and recent leads become older leads, so
+# only leads which have not appeared for a while leave memory. an older lead appearing again
+# is moved back into recent leads, and a spilled lead is read back from SQLite. ids of spilled
+# leads are kept in ActivityIdIndex, so leads never spilled (such as new leads) are not looked
+# up in SQLite.
+#
+class LeadStateStore:
+    # approximate bytes of one lead in memory except values: dict entry, int key and list
+    row_overhead = 160
+    # number of leads in a record of snapshot
+    record_leads = 10000
+    snapshot_prefix = 'rows:'
 
-    # prepairing activityTypeName
-    # Currently, this script supports the following activityType for extracting activity.
-    activityTypeNameDict = {1:'Visit Webpage', 3:'Click Link', 10:'Open Email', 11:'Click Email', 12:'New Lead', 13:'Change Data Value'}
-    default_activity_id = "12,13"
+    def __init__(self, fields, memory_limit=None, spill_dir=None):
+        self.fields = fields
+        self.columns = []
+        for field in fields:
+            if field not in self.columns:
+                self.columns.append(field)
+        self.positions = [self.columns.index(field) for field in fields]
+        self.identity = self.positions == range(len(self.columns))
+        self.empty_values = [None] * len(fields)
 
-    # preparing csv headers according to command arguments. if user set -w option, we add "page" and "link"
-    default_header = ["Activity Id", "Activity Date", "Activity Type Id", "Activity Type Name", "Lead Id"]
+        # recent leads and older leads
+        self.rows = {}
+        self.old_rows = {}
+        self.max_rows = None
+        if memory_limit:
+            self.max_rows = max(memory_limit // (self.row_overhead + 8 * len(self.columns)) // 2, 1)
+        self.spill_dir = spill_dir
+        self.spill_path = None
+        self.connection = None
+        self.spilled = None
+        self.spills = 0
+        self.lead_count = 0
+        # leads changed since the last snapshot, if trackChanges() is called
+        self.changed = None
 
-    tracking_fields = ["Lead Score"]
-    default_header.extend(tracking_fields)
+    def _openSpillFile(self):
+        fd, self.spill_path = tempfile.mkstemp(prefix='mktoLeadState', suffix='.sqlite', dir=self.spill_dir)
+        os.close(fd)
+        # values are utf-8 encoded str, and the file is thrown away at the end
+        self.connection = sqlite3.connect(self.spill_path, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        columns = ', '.join('v%d' % i for i in range(len(self.columns)))
+        self.connection.execute('CREATE TABLE lead_state (lead_id INTEGER PRIMARY KEY, ' + columns + ')')
+        self.select_sql = 'SELECT ' + columns + ' FROM lead_state WHERE lead_id = ?'
+        self.replace_sql = 'INSERT OR REPLACE INTO lead_state VALUES (?' + ', ?' * len(self.columns) + ')'
 
-    if args.change_data_fields:
-        change_data_fields =  args.change_data_fields.split(",")
-        for field in change_data_fields:
-            tracking_fields.append(field)
-            default_header.append(field)
+    # move older leads into SQLite, and make recent leads older
+    def _spill(self):
+        if self.old_rows:
+            if self.connection is None:
+                self._openSpillFile()
+                self.spilled = ActivityIdIndex()
+            self.connection.executemany(self.replace_sql, ((leadId,) + tuple(row) for leadId, row in self.old_rows.iteritems()))
+            self.connection.commit()
+            for leadId in self.old_rows:
+                self.spilled.add(leadId)
+            self.spills += 1
+        self.old_rows = self.rows
+        self.rows = {}
 
-    if args.mail_activity:
-        default_header.extend(["Mail","Link in Mail"])
-        default_activity_id = default_activity_id + ",10,11"
+    def _getRow(self, leadId):
+        row = self.rows.get(leadId)
+        if row is not None:
+            return row
+        row = self.old_rows.pop(leadId, None)
+        if row is None:
+            if self.spilled is None or leadId not in self.spilled:
+                return None
+            row = list(self.connection.execute(self.select_sql, (leadId,)).fetchone())
+        self._addRow(leadId, row)
+        return row
 
-    if args.web_activity:
-        default_header.extend(["Web Page","Link on Page","Query Parameters"])
-        default_activity_id = default_activity_id + ",1,3"
+    def _addRow(self, leadId, row):
+        if self.max_rows is not None and len(self.rows) >= self.max_rows:
+            self._spill()
+        self.rows [leadId] = row
 
-    # write header to fh
-    mywriter.writerow(default_header)
+    def hasLead(self, leadId):
+        return self._getRow(leadId) is not None
 
+    # values of fields for leadId in order of fields. returned list must not be modified
+    def getValues(self, leadId):
+        row = self._getRow(leadId)
+        if row is None:
+            return self.empty_values
+        if self.identity:
+            return row
+        return [row [position] for position in self.positions]
 
-    # initiate dictionalies for storing latest leadStatus, lifecycleStatus and specified fields through command argument for each leads
-    last_custom_fields = {}
-    for field in tracking_fields:
-        last_custom_fields[field] = {}
+    def setValue(self, leadId, field, value):
+        if isinstance(value, str):
+            # the same scores and statuses appear again and again, so share them
+            value = intern(value)
+        row = self._getRow(leadId)
+        if row is None:
+            row = [None] * len(self.columns)
+            self._addRow(leadId, row)
+            self.lead_count += 1
+        row [self.columns.index(field)] = value
+        if self.changed is not None:
+            self.changed.add(leadId)
 
-    
-    #
-    # initiate Marketo ReST API
-    mktoClient = MarketoClient(args.mkto_instance, 'client_credentials', args.mkto_client_id, args.mkto_client_secret, args.mkto_list_id)
-    
-    # enable debug information
-    if args.debug:
-        mktoClient.enableDebug()
+    # set all values of leadId, used for new leads
+    def resetValues(self, leadId, value):
+        row = self._getRow(leadId)
+        if row is None:
+            self._addRow(leadId, [value] * len(self.columns))
+            self.lead_count += 1
+        else:
+            row [:] = [value] * len(self.columns)
+        if self.changed is not None:
+            self.changed.add(leadId)
 
+    def __len__(self):
+        return self.lead_count
 
-    # get value change activities
-    token = mktoClient.getPagingToken(args.mkto_date)
-    moreResult=True
-    while moreResult:
-        raw_data = mktoClient.getLeadActivitiesRaw(token, default_activity_id)
-        if args.debug:
-            print >> sys.stderr, "Activity: " + json.dumps(raw_data, indent=4)
-        success = raw_data ['success']
-        if success == False:
-            errors = raw_data ['errors']
-            error_code = errors [0] ['code']
-            error_message = errors[0] ['message']
-            if error_code == "602":
-                if args.debug:
-                    print >> sys.stderr, "Access Token has been expired. Now updating..."
-                mktoClient.updateAccessToken()
-                continue
-            elif error_code == "606":
-                if args.debug:
-                    print >> sys.stderr, "Max rate limit '100' exceeded with in '20' secs..."
-		time.sleep(2.0)
-		continue
-            else:
-                print >> sys.stderr, "Error:"
-                print >> sys.stderr, "REST API Error Code: ", error_code
-                print >> sys.stderr, "Message: ", error_message
-                if fh is not sys.stdout:
-                    fh.close()
-                sys.exit(1)
+    # iterate (leadId, values of columns) of all leads in memory and SQLite. leads must not be
+    # changed until it is finished
+    def iterRows(self):
+        if self.connection is not None:
+            for record in self.connection.execute('SELECT * FROM lead_state'):
+                if not self.rows.has_key(record [0]) and not self.old_rows.has_key(record [0]):
+                    yield record [0], record [1:]
+        for leadId, row in self.old_rows.iteritems():
+            yield leadId, row
+        for leadId, row in self.rows.iteritems():
+            yield leadId, row
 
-        token = raw_data ['nextPageToken']
-        moreResult = raw_data ['moreResult']
+    # values of leadId without moving it into recent leads. None if it is not known
+    def _peekRow(self, leadId):
+        row = self.rows.get(leadId)
+        if row is None:
+            row = self.old_rows.get(leadId)
+        if row is None and self.spilled is not None and leadId in self.spilled:
+            row = self.connection.execute(self.select_sql, (leadId,)).fetchone()
+        return row
 
-        if args.debug:
-            print >> sys.stderr, "Activity: " + json.dumps(raw_data, indent=4)
+    # write (leadId, values) into f as records of snapshot: length (4 bytes) and zlib compressed
+    # json list of [leadId, values of columns...]. return bytes written
+    def _writeRecords(self, f, rows):
+        size = 0
+        chunk = []
+        for leadId, row in rows:
+            chunk.append([leadId] + list(row))
+            if len(chunk) >= self.record_leads:
+                size += self._writeRecord(f, chunk)
+                chunk = []
+        if chunk:
+            size += self._writeRecord(f, chunk)
+        return size
 
-        #check if there is result field
-        if raw_data.has_key('result') == False and moreResult != True:
-                print >> sys.stderr, "Error:"
-                print >> sys.stderr, "There is no specific activities."
-                if fh is not sys.stdout:
-                    fh.close()
-                sys.exit(1)
+    def _writeRecord(self, f, chunk):
+        data = zlib.compress(json.dumps(chunk, separators=(',', ':')))
+        f.write(struct.pack('<I', len(data)))
+        f.write(data)
+        return 4 + len(data)
 
-        #check empty results
-        if raw_data.has_key('result') == False:
-            continue
+    # record changed leads from now on, for writeChanges()
+    def trackChanges(self):
+        self.changed = set()
 
-        raw_data_result = raw_data ['result']
-        for result in raw_data_result:
-            csv_row = []
-            # id
-            csv_row.append(result ['id'])
-
-            # activityDate
-            # convert datetime (CST) to JST
-            activityDate = unicode(result ['activityDate']).encode('utf-8')
-            activityDate = activityDate.replace("T", " ")
-            activityDate = activityDate.replace("Z", "")
-            if args.not_jst == False: # use JST
-                jstActivityDate = datetime.strptime(activityDate, '%Y-%m-%d %H:%M:%S')
-                jstActivityDate = pytz.utc.localize(jstActivityDate)
-                jstActivityDate = jstActivityDate.astimezone(pytz.timezone('Asia/Tokyo'))
-                activityDate = jstActivityDate.strftime('%Y-%m-%d %H:%M:%S')
-            csv_row.append(activityDate)
-
-            # activityTypeId
-            activityTypeId = result ['activityTypeId']
-            csv_row.append(activityTypeId)
-
-            # activityTypeName
-            csv_row.append(activityTypeNameDict[activityTypeId])
-            
-            # leadId
-            leadId = result ['leadId']
-            csv_row.append(leadId)
-
-            # 12:Created
-            # leadScore, lifecycleStatus and other custom fields is empty, because of lead is just created.
-            #
-            # JSON results example:
-            # 
-            # {
-            #   "id": 303290,
-            #   "leadId": 101093,
-            #   "activityDate": "2015-04-09T05:34:40Z",
-            #   "activityTypeId": 12,
-            #   "primaryAttributeValueId": 101093,
-            #   "attributes": [
-            #     {
-            #       "name": "Created Date",
-            #       "value": "2015-04-09"
-            #     },
-            #     {
-            #       "name": "Form Name",
-            #       "value": "YY_Program.YY_Form"
-            #     },
-            #     {
-            #       "name": "Source Type",
-            #       "value": "Web form fillout"
-            #     }
-            #   ]
-            # }
-            if  activityTypeId == 12:
-                for field in tracking_fields:
-                    csv_row.append("")
-                    # is this correct... Lead Score should be integer but it will be initialized as ""
-                    last_custom_fields [field][leadId] = ""
+    # write all leads into f in one pass, as records read by loadSnapshot(). changed leads are
+    # cleared. return bytes written
+    def writeSnapshot(self, f):
+        if self.changed is not None:
+            self.changed = set()
+        return self._writeRecords(f, self.iterRows())
 
-                # adding empty field value for mail related column
-                if args.mail_activity:
-                    csv_row.append("")
-                    csv_row.append("")
+    # write leads changed since the last writeChanges() or writeSnapshot() into f, as records
+    # read by loadSnapshot(). return bytes written
+    def writeChanges(self, f):
+        changed = self.changed
+        self.changed = set()
+        return self._writeRecords(f, ((leadId, self._peekRow(leadId)) for leadId in sorted(changed)))
 
-                # adding empty field value for web related column
-                if args.web_activity:
-                    csv_row.append("")
-                    csv_row.append("")
+    # set values of leads in records written by writeSnapshot() or writeChanges(), reading size
+    # bytes of f. None reads until the end
+    def loadSnapshot(self, f, size=None):
+        while size is None or size > 0:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            length, = struct.unpack('<I', header)
+            for record in json.loads(zlib.decompress(f.read(length))):
+                values = [intern(value.encode('utf-8')) if isinstance(value, unicode) else value for value in record [1:]]
+                row = self._getRow(record [0])
+                if row is None:
+                    self._addRow(record [0], values)
+                    self.lead_count += 1
+                else:
+                    row [:] = values
+                if self.changed is not None:
+                    self.changed.add(record [0])
+            if size is not None:
+                size -= 4 + length
 
-                # write row into csv 
-                mywriter.writerow(csv_row)
-                continue
+    # snapshot of all leads as a string, such as for checkpoint of the library
+    def getSnapshot(self):
+        buffer = cStringIO.StringIO()
+        self.writeSnapshot(buffer)
+        return self.snapshot_prefix + base64.b64encode(buffer.getvalue())
 
-            # 
-            # 13: Change Data Value
-            # Lead Score and other standard/custom fields are updated!
-            #
-            # JSON results example:
-            # {
-            #  "id": 303306,
-            #  "leadId": 101093,
-            #  "activityDate": "2015-04-09T09:51:00Z",
-            #  "activityTypeId": 13,
-            #  "primaryAttributeValueId": 641,
-            #  "primaryAttributeValue": "YY_Field_1",
-            #  "attributes": [
-            #   {
-            #     "name": "New Value",
-            #     "value": "marketo"
-            #   },
-            #   {
-            #     "name": "Old Value",
-            #     "value": "coverity"
-            #   },
-            #   {
-            #     "name": "Reason",
-            #     "value": "Form fill-out, URL: http://yy.marketo.com/lp/yy.html"
-            #   },
-            #   {
-            #     "name": "Source",
-            #     "value": "Web form fillout"
-            #   }
-            #  ]
-            # }
-            if  activityTypeId == 13:
-                activity_field = unicode(result ['primaryAttributeValue']).encode('utf-8')
-                if activity_field in tracking_fields:
-                    for field in tracking_fields:
-                        if field == activity_field:
-                            attributes = result ['attributes']
-                            for attribute in attributes:
-                                if attribute ['name'] == "New Value":
-                                    value = unicode(attribute ['value']).encode('utf-8')
-                                    csv_row.append(value)
-                                    # store current value
-                                    last_custom_fields [field][leadId] = value
-                                    break
-                        else:
-                            # if it is not matched, adding latest value or empty
-                            csv_row.append(last_custom_fields [field].get(leadId))
-                else:
-                    # this activity is not related to tracking_fields, so we skip this activity without writerow
-                    continue
+    # restore values from snapshot returned by getSnapshot. snapshots of earlier versions,
+    # zlib compressed json of {field: {leadId: value}}, are also accepted
+    def setSnapshot(self, snapshot):
+        if snapshot.startswith(self.snapshot_prefix):
+            self.loadSnapshot(cStringIO.StringIO(base64.b64decode(snapshot [len(self.snapshot_prefix):])))
+            return
+        values = json.loads(zlib.decompress(base64.b64decode(snapshot)))
+        for field in self.columns:
+            for leadId, value in values.get(field.decode('utf-8'), {}).iteritems():
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                self.setValue(int(leadId), field, value)
 
-                # adding empty field value for mail related column
-                if args.mail_activity:
-                    csv_row.append("")
-                    csv_row.append("")
+    # remove SQLite file
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            os.remove(self.spill_path)
 
-                # adding empty field value for web related column
-                if args.web_activity:
-                    csv_row.append("")
-                    csv_row.append("")
 
-                # write row into csv 
-                mywriter.writerow(csv_row)
-                continue
+# -------
+# Seeding lead state with current field values of leads which appear without "New Lead" activity
+#
+#    mktoClient: MarketoClient
+#    lead_state: LeadStateStore of ActivityTransformer
+#    api_fields: {'UI' field name: REST API field name} of fields to be seeded
+#    cache_size: number of leads kept in LRU cache of looked up values
+#
+# unseen leads of a page are looked up together by Get Multiple Leads by Filter Type, up to
+# batch_size leads in a call. leads which are not returned (deleted leads) are cached too, so
+# no lead is looked up twice.
+#
+class LeadValueSeeder:
+    batch_size = 300
 
-            # 
-            # 10: Open Mail
-            # JSON results example:
-            # {
-            #  "id": 303306,
-            #  "leadId": 101093,
-            #  "activityDate": "2015-04-09T09:51:00Z",
-            #  "activityTypeId": 10,
-            #  "primaryAttributeValueId": 5,
-            #  "primaryAttributeValue": "RestAPITester.01_Mail",
-            #  "attributes": [
-            #   {
-            #     "name": "Device",
-            #     "value": "unknown"
-            #   },
-            #   {
-            #     "name": "Is Mobile Device",
-            #     "value": false
-            #   },
-            #   {
-            #     "name": "Platform",
-            #     "value": "unknown"
-            #   },
-            #   {
-            #     "name": "User Agent",
-            #     "value": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_2) AppleWebKit/600.3.18 (KHTML, like Gecko)"
-            #   }
-            #  ]
-            # }
-            if  activityTypeId == 10:
-                for field in tracking_fields:
-                    csv_row.append(last_custom_fields [field].get(leadId))
-
-                # Mail
-                mail =  unicode(result ['primaryAttributeValue']).encode('utf-8')
-                csv_row.append(mail)
-                # Click in Mail
-                csv_row.append("")
+    def __init__(self, mktoClient, lead_state, api_fields, cache_size=100000):
+        self.mktoClient = mktoClient
+        self.lead_state = lead_state
+        self.api_fields = api_fields
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.calls = 0
+        self.seeded = 0
 
-                # adding empty field value for web related column
-                if args.web_activity:
-                    csv_row.append("")
-                    csv_row.append("")
+    # values of leads in the cache, None if the lead was not found
+    def _getCached(self, leadId):
+        values = self.cache.pop(leadId)
+        self.cache [leadId] = values
+        return values
 
-                # write row into csv 
-                mywriter.writerow(csv_row)
-                continue
-                
-            # 
-            # 11: Click in Mail
-            # JSON results example:
-            # {
-            #  "id": 303306,
-            #  "leadId": 101093,
-            #  "activityDate": "2015-04-09T09:51:00Z",
-            #  "activityTypeId": 10,
-            #  "primaryAttributeValueId": 5,
-            #  "primaryAttributeValue": "RestAPITester.01_Mail",
-            #  "attributes": [
-            #   {
-            #     "name": "Device",
-            #     "value": "unknown"
-            #   },
-            #   {
-            #     "name": "Is Mobile Device",
-            #     "value": false
-            #   },
-            #   {
-            #     "name": "Link",
-            #     "value": "http://unknot304.blogspot.jp/2015/02/munchkin-tag.html"
-            #   },
-            #   {
-            #     "name": "Platform",
-            #     "value": "unknown"
-            #   },
-            #   {
-            #     "name": "User Agent",
-            #     "value": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_2) AppleWebKit/600.3.18 (KHTML, like Gecko)"
-            #   }
-            #  ]
-            # }
-            if  activityTypeId == 11:
-                for field in tracking_fields:
-                    csv_row.append(last_custom_fields [field].get(leadId))
-
-                # Mail
-                mail =  unicode(result ['primaryAttributeValue']).encode('utf-8')
-                csv_row.append(mail)
-
-                attributes = result ['attributes']
-                # Click in Mail
-                for attribute in attributes:
-                    if attribute ['name'] == "Link":
-                        value = unicode(attribute ['value']).encode('utf-8')
-                        csv_row.append(value)
-                        break
+    def _setCached(self, leadId, values):
+        self.cache [leadId] = values
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(False)
 
-                # adding empty field value for web related column
-                if args.web_activity:
-                    csv_row.append("")
-                    csv_row.append("")
+    def _seed(self, leadId, values):
+        if values is None:
+            return
+        for field, value in values.iteritems():
+            self.lead_state.setValue(leadId, field, value)
+        self.seeded += 1
 
-                # write row into csv 
-                mywriter.writerow(csv_row)
-                continue
-                
-            # 
-            # 1: Web Visit
-            # JSON results example:
-            # {
-            #  "id": 303306,
-            #  "leadId": 101093,
-            #  "activityDate": "2015-04-09T09:51:00Z",
-            #  "activityTypeId": 10,
-            #  "primaryAttributeValueId": 14,
-            #  "primaryAttributeValue": "unknot304.jp/",
-            #  "attributes": [
-            #   {
-            #     "name": "Client IP Address",
-            #     "value": "202.212.192.233"
-            #   },
-            #   {
-            #     "name": "Query Parameters",
-            #     "value": ""
-            #   },
-            #   {
-            #     "name": "Referrer URL",
-            #     "value": ""
-            #   },
-            #   {
-            #     "name": "User Agent",
-            #     "value": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_2) AppleWebKit/600.3.18 (KHTML, like Gecko)"
-            #   }
-            #  ]
-            # }
-            if  activityTypeId == 1:
-                for field in tracking_fields:
-                    csv_row.append(last_custom_fields [field].get(leadId))
-
-                # adding empty field value for mail related column
-                if args.mail_activity:
-                    csv_row.append("")
-                    csv_row.append("")
+    def _lookup(self, leadIds):
+        fields = ['id'] + self.api_fields.values()
+        raw_data = self.mktoClient.getLeadsRaw('id', ','.join(str(leadId) for leadId in leadIds), ','.join(fields))
+        self.calls += 1
+        found = {}
+        for lead in raw_data.get('result', []):
+            values = {}
+            for field, api_field in self.api_fields.iteritems():
+                value = lead.get(api_field)
+                if isinstance(value, bool):
+                    value = str(value).lower()
+                elif value is not None:
+                    value = unicode(value).encode('utf-8')
+                values [field] = value
+            found [lead ['id']] = values
+        for leadId in leadIds:
+            values = found.get(leadId)
+            self._setCached(leadId, values)
+            self._seed(leadId, values)
 
-                if args.web_activity:
-                    # Web
-                    web =  unicode(result ['primaryAttributeValue']).encode('utf-8')
-                    csv_row.append(web)
-                    # Link on Web
-                    csv_row.append("")
-                    # Query Parameter
-                    web_attributes = result ['attributes']
-                    for web_attribute in web_attributes:
-                        if web_attribute ['name'] == "Query Parameters":
-                            qparam = unicode(web_attribute ['value']).encode('utf-8')
-                            csv_row.append(qparam)
-                            break
-
-                # write row into csv 
-                mywriter.writerow(csv_row)
+    # seed leads of activities, which must be called before activities are transformed
+    def seedActivities(self, activities):
+        unseen = []
+        checked = set()
+        for result in activities:
+            leadId = result ['leadId']
+            if leadId in checked:
                 continue
-                
-            # 
-            # 3: Click on Web
-            # JSON results example:
-            # {
-            #  "id": 303306,
-            #  "leadId": 101093,
-            #  "activityDate": "2015-04-09T09:51:00Z",
-            #  "activityTypeId": 10,
-            #  "primaryAttributeValueId": 10,
-            #  "primaryAttributeValue": "na-ab09.marketo.com/lp/user/01_PDF__DL.html",
-            #  "attributes": [
-            #   {
-            #     "name": "Client IP Address",
-            #     "value": "202.212.192.233"
-            #   },
-            #   {
-            #     "name": "Query Parameters",
-            #     "value": ""
-            #   },
-            #   {
-            #     "name": "Referrer URL",
-            #     "value": ""
-            #   },
-            #   {
-            #     "name": "User Agent",
-            #     "value": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_2) AppleWebKit/600.3.18 (KHTML, like Gecko)"
-            #   }
-            #   {
-            #     "name": "Webpage ID",
-            #     "value": 7
-            #   }
-            #  ]
-            # }
-            if  activityTypeId == 3:
-                for field in tracking_fields:
-                    csv_row.append(last_custom_fields [field].get(leadId))
-
-                # adding empty field value for mail related column
-                if args.mail_activity:
-                    csv_row.append("")
+            checked.add(leadId)
+            # values of new leads are empty
+            if result ['activityTypeId'] == 12 or self.lead_state.hasLead(leadId):
+                continue
+            if leadId in self.cache:
+                self._seed(leadId, self._getCached(leadId))
+                continue
+            unseen.append(leadId)
+
+        for start in range(0, len(unseen), self.batch_size):
+            self._lookup(unseen [start:start + self.batch_size])
+
+
+# return {'UI' field name: REST API field name} of fields, using Describe Lead. fields not
+# found are left out
+def getLeadApiFields(mktoClient, fields):
+    raw_data = mktoClient.getLeadFieldsRaw()
+    api_names = {}
+    for lead_field in raw_data.get('result', []):
+        if lead_field.has_key('rest'):
+            api_names [unicode(lead_field ['displayName']).encode('utf-8')] = lead_field ['rest']['name']
+
+    api_fields = {}
+    for field in fields:
+        if api_names.has_key(field.strip()):
+            api_fields [field] = api_names [field.strip()]
+    return api_fields
+
+
+# -------
+# Precompiled conversion of one activity type into the columns after tracking fields
+#
+#    name: Activity Type Name
+#    columns: list of (kind, attribute name). kind is 'empty', 'primary' (primaryAttributeValue)
+#             or 'attribute'
+#    pad_missing: adding "" for missing attribute. otherwise the column is left out, like
+#                 earlier versions of this script
+#
+# position of each attribute in result ['attributes'] is learned from the first activity
+# and checked on following activities, so attributes are not searched on each row.
+#
+class ActivityExtractor:
+    def __init__(self, name, columns, pad_missing=False):
+        self.name = name
+        self.columns = columns
+        self.pad_missing = pad_missing
+        self.positions = {}
+
+    def _findAttribute(self, attributes, name):
+        position = self.positions.get(name)
+        if position is not None and position < len(attributes) and attributes [position]['name'] == name:
+            return attributes [position]
+        for position, attribute in enumerate(attributes):
+            if attribute ['name'] == name:
+                self.positions [name] = position
+                return attribute
+        return None
+
+    # append columns of result into csv_row
+    def extract(self, result, csv_row):
+        for kind, name in self.columns:
+            if kind == 'empty':
+                csv_row.append("")
+            elif kind == 'primary':
+                csv_row.append(unicode(result.get('primaryAttributeValue', '')).encode('utf-8'))
+            else:
+                attribute = self._findAttribute(result.get('attributes', []), name)
+                if attribute is not None:
+                    csv_row.append(unicode(attribute ['value']).encode('utf-8'))
+                elif self.pad_missing:
                     csv_row.append("")
 
-                if args.web_activity:
-                    # Web
-                    csv_row.append("")
-                    # Link on Web
-                    link =  unicode(result ['primaryAttributeValue']).encode('utf-8')
-                    csv_row.append(link)
-                    # Query Parameter
-                    web_attributes = result ['attributes']
-                    for web_attribute in web_attributes:
-                        if web_attribute ['name'] == "Query Parameters":
-                            qparam = unicode(web_attribute ['value']).encode('utf-8')
-                            csv_row.append(qparam)
-                            break
-
-                # write row into csv 
-                mywriter.writerow(csv_row)
+
+# -------
+# Converting Activity Date (UTC) such as "2015-04-09T05:34:40Z" into "2015-04-09 14:34:40" of timezone
+#
+#    timezone: pytz timezone. None keeps UTC
+#
+# convert() converts one date, and convertColumn() converts a list of dates at once with numpy.
+# offsets of timezone are taken from the transition table of pytz, so both give the same result.
+#
+class ActivityDateConverter:
+    epoch = datetime(1970, 1, 1)
+
+    def __init__(self, timezone):
+        if timezone is not None and timezone.zone == 'UTC':
+            timezone = None
+        self.timezone = timezone
+        self.transitions = None
+        self.offsets = None
+
+    def convert(self, activityDate):
+        activityDate = unicode(activityDate).encode('utf-8')
+        activityDate = activityDate.replace("T", " ")
+        activityDate = activityDate.replace("Z", "")
+        if self.timezone is None:
+            return activityDate
+        if len(activityDate) == 19:
+            utcDate = datetime(int(activityDate [0:4]), int(activityDate [5:7]), int(activityDate [8:10]),
+                               int(activityDate [11:13]), int(activityDate [14:16]), int(activityDate [17:19]))
+        else:
+            utcDate = datetime.strptime(activityDate, '%Y-%m-%d %H:%M:%S')
+        localDate = self.timezone.fromutc(utcDate.replace(tzinfo=self.timezone))
+        return '%04d-%02d-%02d %02d:%02d:%02d' % (localDate.year, localDate.month, localDate.day, localDate.hour, localDate.minute, localDate.second)
+
+    # transition table of timezone as numpy arrays: (utc seconds of transitions, offset seconds)
+    def _getTransitions(self):
+        if self.transitions is None:
+            timezone = self.timezone
+            if hasattr(timezone, '_utc_transition_times'):
+                transitions = [int((transition - self.epoch).total_seconds()) for transition in timezone._utc_transition_times]
+                offsets = [int(info [0].total_seconds()) for info in timezone._transition_info]
+            else:
+                transitions = [int((datetime(1, 1, 1) - self.epoch).total_seconds())]
+                offsets = [int(timezone.utcoffset(None).total_seconds())]
+            self.transitions = numpy.array(transitions, dtype='int64')
+            self.offsets = numpy.array(offsets, dtype='int64')
+        return self.transitions, self.offsets
+
+    def convertColumn(self, activityDates):
+        activityDates = [unicode(activityDate).encode('utf-8').replace("T", " ").replace("Z", "") for activityDate in activityDates]
+        if self.timezone is None or not activityDates:
+            return activityDates
+        seconds = numpy.array(activityDates, dtype='datetime64[s]').astype('int64')
+        transitions, offsets = self._getTransitions()
+        index = numpy.maximum(numpy.searchsorted(transitions, seconds, side='right') - 1, 0)
+        localDates = (seconds + offsets [index]).astype('datetime64[s]')
+        return numpy.char.replace(numpy.datetime_as_string(localDates, unit='s'), 'T', ' ').tolist()
+
+
+# -------
+# Activity converted by ActivityTransformer, holding the columns of getHeader() in order
+#
+# It is a list, so it is written by sinks as it is, and does not have __dict__ for each
+# activity. Other columns are looked up by name with asDict(header).
+#
+# Attributes are typed: id, activityTypeId and leadId are int, and activityDate is a naive
+# datetime in the time zone of ActivityTransformer (UTC if it has no time zone). Columns keep
+# the values written into csv.
+#
+class ActivityRecord(list):
+    __slots__ = ()
+
+    @property
+    def id(self):
+        return int(self [0])
+
+    @property
+    def activityDate(self):
+        return datetime.strptime(self [1], '%Y-%m-%d %H:%M:%S')
+
+    @property
+    def activityTypeId(self):
+        return int(self [2])
+
+    @property
+    def activityTypeName(self):
+        return self [3]
+
+    @property
+    def leadId(self):
+        return int(self [4])
+
+    # values of tracking fields, which are the columns after Lead Id
+    def getFieldValues(self, count):
+        return self [5:5 + count]
+
+    def asDict(self, header):
+        return dict(zip(header, self))
+
+
+# -------
+# Converting lead activities into csv rows
+#
+#    tracking_fields: 'UI' fields name extracted from 'Data Value Changed' activities
+#    mail_activity: adding "Mail" and "Link in Mail" columns
+#    web_activity: adding "Web Page", "Link on Page" and "Query Parameters" columns
+#    timezone: pytz timezone Activity Date is converted into, such as JST. None keeps UTC
+#    lead_state: LeadStateStore for tracking_fields. default: store without memory limit
+#    activity_types: metadata of other activity types to be exported, returned by Get Activity Types.
+#                    "Primary Attribute Value" and attributes of them are added as columns
+#    columnar: converting Activity Date of a page at once by numpy in transformPage()
+#    pad_missing: every row has all the columns of header. earlier versions of this script leave
+#                 out columns of missing attributes, which is kept for csv
+#
+# rows must be given in order of activity date, because latest value of tracking_fields
+# for each leads is carried forward into following activities of the lead.
+#
+class ActivityTransformer:
+    # prepairing activityTypeName
+    # Currently, this script supports the following activityType for extracting activity.
+    activityTypeNameDict = {1:'Visit Webpage', 3:'Click Link', 10:'Open Email', 11:'Click Email', 12:'New Lead', 13:'Change Data Value'}
+
+    # columns of supported activity types after tracking fields: (mail columns, web columns)
+    #   10: Open Mail      -> Mail
+    #   11: Click in Mail  -> Mail, Link in Mail
+    #   1:  Web Visit      -> Web Page, Query Parameters
+    #   3:  Click on Web   -> Link on Page, Query Parameters
+    activityColumns = {
+        12: ([('empty', None), ('empty', None)], [('empty', None), ('empty', None)]),
+        13: ([('empty', None), ('empty', None)], [('empty', None), ('empty', None)]),
+        10: ([('primary', None), ('empty', None)], [('empty', None), ('empty', None)]),
+        11: ([('primary', None), ('attribute', 'Link')], [('empty', None), ('empty', None)]),
+        1: ([('empty', None), ('empty', None)], [('primary', None), ('empty', None), ('attribute', 'Query Parameters')]),
+        3: ([('empty', None), ('empty', None)], [('empty', None), ('primary', None), ('attribute', 'Query Parameters')]),
+    }
+
+    def __init__(self, tracking_fields, mail_activity, web_activity, timezone, lead_state=None, activity_types=None, columnar=False, pad_missing=False):
+        self.tracking_fields = tracking_fields
+        self.mail_activity = mail_activity
+        self.web_activity = web_activity
+        self.date_converter = ActivityDateConverter(timezone)
+        self.columnar = columnar
+        self.pad_missing = pad_missing
+
+        # store for latest values of specified fields through command argument for each leads
+        if lead_state is None:
+            lead_state = LeadStateStore(tracking_fields)
+        self.lead_state = lead_state
+
+        # activity types exported with their own extractors
+        self.type_ids = [12, 13]
+        if mail_activity:
+            self.type_ids.extend([10, 11])
+        if web_activity:
+            self.type_ids.extend([1, 3])
+        self.other_types = [activity_type for activity_type in (activity_types or []) if activity_type ['id'] not in self.type_ids]
+        self.attribute_names = []
+        for activity_type in self.other_types:
+            for attribute in activity_type.get('attributes', []):
+                name = unicode(attribute ['name']).encode('utf-8')
+                if name not in self.attribute_names:
+                    self.attribute_names.append(name)
+        self.extractors = self._buildExtractors()
+
+    def _buildExtractors(self):
+        extractors = {}
+        pad_missing = self.pad_missing or len(self.other_types) > 0
+        other_columns = [('primary', None)] + [('attribute', name) for name in self.attribute_names]
+        for activityTypeId in self.type_ids:
+            mail_columns, web_columns = self.activityColumns [activityTypeId]
+            columns = []
+            if self.mail_activity:
+                columns.extend(mail_columns)
+            if self.web_activity:
+                columns.extend(web_columns)
+                if pad_missing:
+                    # rows of other types have all of the web columns
+                    columns.extend([('empty', None)] * (3 - len(web_columns)))
+            if self.other_types:
+                columns.extend([('empty', None)] * len(other_columns))
+            extractors [activityTypeId] = ActivityExtractor(self.activityTypeNameDict [activityTypeId], columns, pad_missing)
+
+        for activity_type in self.other_types:
+            columns = []
+            if self.mail_activity:
+                columns.extend([('empty', None)] * 2)
+            if self.web_activity:
+                columns.extend([('empty', None)] * 3)
+            columns.extend(other_columns)
+            name = unicode(activity_type ['name']).encode('utf-8')
+            extractors [activity_type ['id']] = ActivityExtractor(name, columns, True)
+        return extractors
+
+    # preparing csv headers according to command arguments. if user set -w option, we add "page" and "link"
+    def getHeader(self):
+        default_header = ["Activity Id", "Activity Date", "Activity Type Id", "Activity Type Name", "Lead Id"]
+        default_header.extend(self.tracking_fields)
+        if self.mail_activity:
+            default_header.extend(["Mail","Link in Mail"])
+        if self.web_activity:
+            default_header.extend(["Web Page","Link on Page","Query Parameters"])
+        if self.other_types:
+            default_header.append("Primary Attribute Value")
+            default_header.extend(self.attribute_names)
+        return default_header
+
+    # comma separated activity type ids for calling Get Lead Activities
+    def getActivityTypeIds(self):
+        default_activity_id = "12,13"
+        if self.mail_activity:
+            default_activity_id = default_activity_id + ",10,11"
+        if self.web_activity:
+            default_activity_id = default_activity_id + ",1,3"
+        for activity_type in self.other_types:
+            default_activity_id = default_activity_id + "," + str(activity_type ['id'])
+        return default_activity_id
+
+    # compact snapshot of lead state for checkpoint
+    def getLeadState(self):
+        return self.lead_state.getSnapshot()
+
+    # restore lead state from snapshot returned by getLeadState
+    def setLeadState(self, state):
+        self.lead_state.setSnapshot(state)
+
+    def close(self):
+        self.lead_state.close()
+
+    # convert activities of a page into ActivityRecords. skipped activities are not included
+    def transformPage(self, results):
+        return list(self.iterRecords(results))
+
+    # convert activities of a page into a list of ActivityRecords, having None for each skipped activity
+    def transformResults(self, results):
+        if not self.columnar:
+            return [self.transform(result) for result in results]
+        activityDates = self.date_converter.convertColumn([result ['activityDate'] for result in results])
+        return [self.transform(result, activityDate) for result, activityDate in zip(results, activityDates)]
+
+    # yields ActivityRecords of activities one by one. lead state is updated as they are yielded
+    def iterRecords(self, results):
+        activityDates = None
+        if self.columnar:
+            activityDates = self.date_converter.convertColumn([result ['activityDate'] for result in results])
+
+        for index, result in enumerate(results):
+            csv_row = self.transform(result, activityDates [index] if activityDates is not None else None)
+            if csv_row is not None:
+                yield csv_row
+
+    # convert one activity into ActivityRecord. None is returned if the activity should be skipped.
+    # activityDate is given if it has been converted by transformPage
+    def transform(self, result, activityDate=None):
+        # activityTypeId
+        activityTypeId = result ['activityTypeId']
+        extractor = self.extractors.get(activityTypeId)
+        if extractor is None:
+            return None
+
+        tracking_fields = self.tracking_fields
+        lead_state = self.lead_state
+
+        csv_row = ActivityRecord()
+        # id
+        csv_row.append(result ['id'])
+
+        # activityDate
+        # convert datetime (UTC) to JST or --tz
+        if activityDate is None:
+            activityDate = self.date_converter.convert(result ['activityDate'])
+        csv_row.append(activityDate)
+
+        csv_row.append(activityTypeId)
+
+        # activityTypeName
+        csv_row.append(extractor.name)
+
+        # leadId
+        leadId = result ['leadId']
+        csv_row.append(leadId)
+
+        # 12:Created
+        # leadScore, lifecycleStatus and other custom fields is empty, because of lead is just created.
+        #
+        # JSON results example:
+        #
+        # {
+        #   "id": 303290,
+        #   "leadId": 101093,
+        #   "activityDate": "2015-04-09T05:34:40Z",
+        #   "activityTypeId": 12,
+        #   "primaryAttributeValueId": 101093,
+        #   "attributes": [
+        #     {
+        #       "name": "Created Date",
+        #       "value": "2015-04-09"
+        #     },
+        #     {
+        #       "name": "Form Name",
+        #       "value": "YY_Program.YY_Form"
+        #     },
+        #     {
+        #       "name": "Source Type",
+        #       "value": "Web form fillout"
+        #     }
+        #   ]
+        # }
+        if  activityTypeId == 12:
+            for field in tracking_fields:
+                csv_row.append("")
+            # is this correct... Lead Score should be integer but it will be initialized as ""
+            lead_state.resetValues(leadId, "")
+
+        #
+        # 13: Change Data Value
+        # Lead Score and other standard/custom fields are updated!
+        #
+        # JSON results example:
+        # {
+        #  "id": 303306,
+        #  "leadId": 101093,
+        #  "activityDate": "2015-04-09T09:51:00Z",
+        #  "activityTypeId": 13,
+        #  "primaryAttributeValueId": 641,
+        #  "primaryAttributeValue": "YY_Field_1",
+        #  "attributes": [
+        #   {
+        #     "name": "New Value",
+        #     "value": "marketo"
+        #   },
+        #   {
+        #     "name": "Old Value",
+        #     "value": "coverity"
+        #   },
+        #   {
+        #     "name": "Reason",
+        #     "value": "Form fill-out, URL: http://yy.marketo.com/lp/yy.html"
+        #   },
+        #   {
+        #     "name": "Source",
+        #     "value": "Web form fillout"
+        #   }
+        #  ]
+        # }
+        elif  activityTypeId == 13:
+            activity_field = unicode(result ['primaryAttributeValue']).encode('utf-8')
+            if activity_field in tracking_fields:
+                lead_values = lead_state.getValues(leadId)
+                for index, field in enumerate(tracking_fields):
+                    if field == activity_field:
+                        attributes = result ['attributes']
+                        for attribute in attributes:
+                            if attribute ['name'] == "New Value":
+                                value = unicode(attribute ['value']).encode('utf-8')
+                                csv_row.append(value)
+                                # store current value
+                                lead_state.setValue(leadId, field, value)
+                                break
+                        else:
+                            if self.pad_missing:
+                                csv_row.append(None)
+                    else:
+                        # if it is not matched, adding latest value or empty
+                        csv_row.append(lead_values [index])
+            else:
+                # this activity is not related to tracking_fields, so we skip this activity without writerow
+                return None
+
+        else:
+            # other activities carry latest values of tracking fields
+            csv_row.extend(lead_state.getValues(leadId))
+
+        # mail, web and attribute columns according to activity type
+        extractor.extract(result, csv_row)
+        return csv_row
+
+
+# -------
+# Return metadata of activity types returned by Get Activity Types. It is cached in cache_file
+# for ttl seconds, because activity types are rarely changed
+#
+def loadActivityTypes(mktoClient, cache_file, ttl):
+    if cache_file and os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < ttl:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache.get('instance') == mktoClient.endpoint_url:
+            return cache ['result']
+
+    raw_data = mktoClient.getActivityTypesRaw()
+    result = raw_data.get('result', [])
+    if cache_file:
+        # written atomically in the same way as checkpoint
+        saveCheckpoint(cache_file, {'instance': mktoClient.endpoint_url, 'result': result})
+    return result
+
+
+# -------
+# Writing rows into csv file handler
+#
+#    fh: file handler or stdout. it is closed by close() unless it is stdout
+#
+class CsvSink:
+    def __init__(self, fh):
+        self.fh = fh
+        self.writer = csv.writer(fh, delimiter = ',')
+
+    def writeHeader(self, header):
+        self.writer.writerow(header)
+
+    def writeRows(self, rows):
+        self.writer.writerows(rows)
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        if self.fh is not sys.stdout:
+            self.fh.close()
+
+
+# -------
+# Writing a chunk file on a background thread, compressed with gzip or zstd
+#
+#    path: chunk file name
+#    compression: 'gzip', 'zstd' or None
+#
+# data given to write() is compressed and written by the thread. sha256 and size of the
+# written file are available after join().
+#
+class ChunkFileWriter:
+    queue_size = 8
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.compression = compression
+        self.queue = Queue.Queue(self.queue_size)
+        self.error = None
+        self.sha256 = None
+        self.size = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            if self.compression == 'gzip':
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            elif self.compression == 'zstd':
+                compressor = zstandard.ZstdCompressor().compressobj()
+            else:
+                compressor = None
+            checksum = hashlib.sha256()
+            with open(self.path, 'wb') as f:
+                while True:
+                    data = self.queue.get()
+                    if data is None:
+                        break
+                    if compressor is not None:
+                        data = compressor.compress(data)
+                    f.write(data)
+                    checksum.update(data)
+                    self.size += len(data)
+                if compressor is not None:
+                    data = compressor.flush()
+                    f.write(data)
+                    checksum.update(data)
+                    self.size += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.sha256 = checksum.hexdigest()
+        except BaseException:
+            self.error = sys.exc_info()
+            # keep reading, so write() is not blocked forever
+            while self.queue.get() is not None:
+                pass
+
+    def write(self, data):
+        self.queue.put(data)
+
+    # no more data. the file is completed in background
+    def finish(self):
+        self.queue.put(None)
+
+    def isFinished(self):
+        return not self.thread.is_alive()
+
+    def join(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error [0], self.error [1], self.error [2]
+
+
+# -------
+# Writing csv rows into compressed and rotated chunk files with a manifest
+#
+#    path: output file name. with rotation, chunk number is added such as activities.00001.csv.gz
+#    compression: 'gzip', 'zstd' or None
+#    max_rows: number of rows in a chunk. None means unlimited
+#    max_bytes: size of csv in a chunk before compression. None means unlimited
+#    max_pending: number of chunks compressed at the same time
+#
+# each chunk has the header, so it can be loaded by itself. <path>.manifest.json lists rows,
+# range of activity id, size and sha256 of finished chunks, and is updated whenever a chunk
+# is finished, so chunks can be loaded while the export is running. "complete" is set at the end.
+#
+class ChunkedCsvSink:
+    block_size = 1024 * 1024
+    suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path, compression=None, max_rows=None, max_bytes=None, max_pending=2):
+        self.path = path
+        self.compression = compression
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.manifest_path = path + '.manifest.json'
+        self.header = None
+
+        self.chunks = []
+        self.pending = collections.deque()
+        self.chunk_count = 0
+        self.writer = None
+        self.entry = None
+        self.written_bytes = 0
+        self.buffer = None
+        self.csv_writer = None
+
+    def _getChunkPath(self, index):
+        path = self.path
+        if self.max_rows or self.max_bytes:
+            root, ext = os.path.splitext(path)
+            path = root + '.%05d' % index + ext
+        suffix = self.suffixes.get(self.compression, '')
+        if not path.endswith(suffix):
+            path = path + suffix
+        return path
+
+    def _writeManifest(self, complete):
+        saveCheckpoint(self.manifest_path, {'compression': self.compression,
+                                            'complete': complete,
+                                            'chunks': self.chunks})
+
+    def _openChunk(self):
+        while len(self.pending) >= self.max_pending:
+            self._finishOldest()
+        path = self._getChunkPath(self.chunk_count)
+        self.chunk_count += 1
+        self.writer = ChunkFileWriter(path, self.compression)
+        self.entry = {'file': os.path.basename(path), 'rows': 0, 'first_activity_id': None, 'last_activity_id': None}
+        self.written_bytes = 0
+        self.buffer = cStringIO.StringIO()
+        self.csv_writer = csv.writer(self.buffer, delimiter = ',')
+        self.csv_writer.writerow(self.header)
+
+    def _flushBuffer(self):
+        data = self.buffer.getvalue()
+        if data:
+            self.writer.write(data)
+            self.written_bytes += len(data)
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+    def _closeChunk(self):
+        self._flushBuffer()
+        self.writer.finish()
+        self.pending.append((self.writer, self.entry))
+        self.writer = None
+
+    def _finishOldest(self):
+        writer, entry = self.pending.popleft()
+        writer.join()
+        entry ['bytes'] = writer.size
+        entry ['sha256'] = writer.sha256
+        self.chunks.append(entry)
+        self._writeManifest(False)
+
+    def writeHeader(self, header):
+        self.header = header
+
+    def writeRows(self, rows):
+        for row in rows:
+            if self.writer is None:
+                self._openChunk()
+            self.csv_writer.writerow(row)
+            entry = self.entry
+            entry ['rows'] += 1
+            if entry ['first_activity_id'] is None or row [0] < entry ['first_activity_id']:
+                entry ['first_activity_id'] = row [0]
+            if entry ['last_activity_id'] is None or row [0] > entry ['last_activity_id']:
+                entry ['last_activity_id'] = row [0]
+
+            if self.buffer.tell() >= self.block_size:
+                self._flushBuffer()
+            if (self.max_rows and entry ['rows'] >= self.max_rows) or \
+               (self.max_bytes and self.written_bytes + self.buffer.tell() >= self.max_bytes):
+                self._closeChunk()
+
+        # add chunks finished in background into manifest
+        while self.pending and self.pending [0][0].isFinished():
+            self._finishOldest()
+
+    def flush(self):
+        if self.writer is not None:
+            self._flushBuffer()
+
+    def close(self):
+        if self.chunk_count == 0:
+            # no activities, but output has the header
+            self._openChunk()
+        if self.writer is not None:
+            self._closeChunk()
+        while self.pending:
+            self._finishOldest()
+        self._writeManifest(True)
+
+
+# -------
+# Writing rows into Parquet files with typed columns
+#
+#    path: output file, or root directory of partitions if partition_by is given
+#    partition_by: list of 'date' and 'type'. files are written into Hive style directories
+#                  such as activity_date=2015-04-09/activity_type_id=12/part-00000.parquet
+#    row_group_size: number of rows buffered before they are written as a row group
+#
+# ids are int64, Activity Date is timestamp and names of activity type, mail and page are
+# dictionary encoded. rows are buffered for each partition and written row group by row group,
+# so memory does not grow with the size of export. activities come in order of date, so files
+# of earlier dates are closed when a later date appears.
+#
+class ParquetSink:
+    int_columns = ["Activity Id", "Activity Type Id", "Lead Id"]
+    date_columns = ["Activity Date"]
+    dictionary_columns = ["Activity Type Name", "Mail", "Link in Mail", "Web Page", "Link on Page"]
+
+    def __init__(self, path, partition_by=None, row_group_size=100000):
+        self.path = path
+        self.partition_by = partition_by or []
+        self.row_group_size = row_group_size
+        self.header = None
+        self.schema = None
+        # partition key -> [ParquetWriter or None, buffered rows]
+        self.partitions = {}
+        self.current_date = None
+        self.file_count = 0
+
+    def writeHeader(self, header):
+        self.header = header
+        fields = []
+        for name in header:
+            if name in self.int_columns:
+                column_type = pyarrow.int64()
+            elif name in self.date_columns:
+                column_type = pyarrow.timestamp('s')
+            else:
+                column_type = pyarrow.string()
+            fields.append(pyarrow.field(name, column_type))
+        self.schema = pyarrow.schema(fields)
+
+    def _getPartitionKey(self, row):
+        key = []
+        for partition in self.partition_by:
+            if partition == 'date':
+                key.append('activity_date=' + row [1][:10])
+            else:
+                key.append('activity_type_id=' + str(row [2]))
+        return tuple(key)
+
+    def _openWriter(self, key):
+        if key:
+            directory = os.path.join(self.path, *key)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'part-%05d.parquet' % self.file_count)
+        else:
+            path = self.path
+        self.file_count += 1
+        use_dictionary = [name for name in self.header if name in self.dictionary_columns]
+        return pyarrow.parquet.ParquetWriter(path, self.schema, use_dictionary=use_dictionary)
+
+    # write buffered rows of partition as a row group
+    def _writeRowGroup(self, key):
+        partition = self.partitions [key]
+        rows = partition [1]
+        if not rows:
+            return
+        if partition [0] is None:
+            partition [0] = self._openWriter(key)
+
+        arrays = []
+        for index, column in enumerate(zip(*rows)):
+            name = self.header [index]
+            if name in self.int_columns:
+                arrays.append(pyarrow.array([int(value) for value in column], type=pyarrow.int64()))
+            elif name in self.date_columns:
+                arrays.append(pyarrow.array(numpy.array(column, dtype='datetime64[s]'), type=pyarrow.timestamp('s')))
+            else:
+                arrays.append(pyarrow.array([None if value is None else str(value) for value in column], type=pyarrow.string()))
+        partition [0].write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        partition [1] = []
+
+    def _closePartition(self, key):
+        self._writeRowGroup(key)
+        writer = self.partitions.pop(key) [0]
+        if writer is not None:
+            writer.close()
+
+    def writeRows(self, rows):
+        width = len(self.header)
+        for row in rows:
+            if len(row) < width:
+                row = row + [None] * (width - len(row))
+            key = self._getPartitionKey(row)
+            if 'date' in self.partition_by and row [1][:10] != self.current_date:
+                # earlier dates never appear again
+                for other_key in self.partitions.keys():
+                    if other_key != key:
+                        self._closePartition(other_key)
+                self.current_date = row [1][:10]
+
+            partition = self.partitions.get(key)
+            if partition is None:
+                partition = [None, []]
+                self.partitions [key] = partition
+            partition [1].append(row)
+            if len(partition [1]) >= self.row_group_size:
+                self._writeRowGroup(key)
+
+    def flush(self):
+        for key in self.partitions.keys():
+            self._writeRowGroup(key)
+
+    def close(self):
+        for key in self.partitions.keys():
+            self._closePartition(key)
+        if not self.partition_by and self.file_count == 0:
+            # no activities, but output file is created with schema
+            self._openWriter(()).close()
+
+
+# -------
+# Archiving raw pages of activities into compressed NDJSON segment files
+#
+#    directory: directory of the archive. it must not have an archive already
+#    metadata: dict saved in manifest, such as instance and activity_type_ids
+#    compression: 'gzip', 'zstd' or None
+#    segment_pages: number of pages in a segment file
+#
+# Each line of a segment is {"nextPageToken": token or null, "result": [activities]}, as the page
+# was returned by Get Lead Activities (after dropping activities out of since .. until). Segments
+# are compressed in background by ChunkFileWriter. manifest.json lists pages, activities, range of
+# activity date, size and sha256 of each finished segment. "complete" is set by close().
+#
+class PageArchive:
+    suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+    manifest_name = 'manifest.json'
+
+    def __init__(self, directory, metadata, compression='gzip', segment_pages=1000):
+        self.directory = directory
+        self.metadata = metadata
+        self.compression = compression
+        self.segment_pages = segment_pages
+        self.manifest_path = os.path.join(directory, self.manifest_name)
+        if os.path.exists(self.manifest_path):
+            raise ValueError(directory + " has an archive already")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = []
+        self.writer = None
+        self.entry = None
+        self.closed = False
+
+    def _writeManifest(self, complete):
+        manifest = dict(self.metadata)
+        manifest.update({'compression': self.compression, 'complete': complete, 'segments': self.segments})
+        saveCheckpoint(self.manifest_path, manifest)
+
+    def _closeSegment(self):
+        self.writer.finish()
+        self.writer.join()
+        self.entry ['bytes'] = self.writer.size
+        self.entry ['sha256'] = self.writer.sha256
+        self.segments.append(self.entry)
+        self.writer = None
+        self._writeManifest(False)
+
+    # add activities of a page. next_token is nextPageToken of the page, or None if not known
+    def addPage(self, results, next_token):
+        if not results:
+            return
+        if self.writer is None:
+            name = 'segment.%05d.ndjson' % len(self.segments) + self.suffixes.get(self.compression, '')
+            self.writer = ChunkFileWriter(os.path.join(self.directory, name), self.compression)
+            self.entry = {'file': name, 'pages': 0, 'activities': 0, 'first_activity_date': results [0]['activityDate']}
+        self.writer.write(json.dumps({'nextPageToken': next_token, 'result': results}, separators=(',', ':')) + '\n')
+        entry = self.entry
+        entry ['pages'] += 1
+        entry ['activities'] += len(results)
+        entry ['last_activity_date'] = results [-1]['activityDate']
+        entry ['last_token'] = next_token
+        if entry ['pages'] >= self.segment_pages:
+            self._closeSegment()
+
+    # finish the current segment and write manifest. complete is False after errors
+    def close(self, complete=True):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not None:
+            self._closeSegment()
+        self._writeManifest(complete)
+
+
+# yields results passing through, archiving each page into archive (PageArchive)
+def iterArchivedResults(results, archive):
+    for raw_data_result, next_token in results:
+        if raw_data_result is not None:
+            archive.addPage(raw_data_result, next_token)
+        yield raw_data_result, next_token
+
+
+# return manifest of archive written by PageArchive. ValueError is raised if it is not found
+def loadArchiveManifest(directory):
+    path = os.path.join(directory, PageArchive.manifest_name)
+    if not os.path.exists(path):
+        raise ValueError(directory + " has no archive")
+    return loadCheckpoint(path)
+
+
+# -------
+# Yields pages (list of activities) of a segment file of PageArchive
+#
+#    path: segment file
+#    compression: 'gzip', 'zstd' or None, given by manifest
+#    json_decoder: function decoding a line. default is json.loads
+#
+def iterArchiveSegment(path, compression, json_decoder=None):
+    if json_decoder is None:
+        json_decoder = json.loads
+    if compression == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'zstd':
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        decompressor = None
+    rest = ''
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            lines = (rest + data).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield json_decoder(line) ['result']
+    if rest:
+        yield json_decoder(rest) ['result']
+
+
+# -------
+# Compact set of activity ids, persisted between runs to drop activities exported before
+#
+#    path: file where the index is loaded from and saved into. None keeps it in memory
+#
+# Like a roaring bitmap, ids are grouped by their upper bits into containers of 65536 ids.
+# A container is a sorted array of 16 bit integers while it has up to 4096 ids, and a bitmap
+# of 8 KB after that, so an id takes at most 2 bytes. Ids which are not integers, such as
+# marketoGUID of Bulk Extract, are kept in a plain set.
+#
+class ActivityIdIndex:
+    magic = 'MKTOIDX1'
+    max_array = 4096
+    bitmap_size = 8192
+
+    def __init__(self, path=None):
+        self.path = path
+        self.containers = {}
+        self.others = set()
+        self.count = 0
+        self.duplicates = 0
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        return self.count + len(self.others)
+
+    def __contains__(self, id):
+        if not isinstance(id, (int, long)) or id < 0:
+            return id in self.others
+        container = self.containers.get(id >> 16)
+        if container is None:
+            return False
+        low = id & 0xffff
+        if isinstance(container, bytearray):
+            return (container [low >> 3] & (1 << (low & 7))) != 0
+        index = bisect.bisect_left(container, low)
+        return index < len(container) and container [index] == low
+
+    # add id. return False if it has been added already
+    def add(self, id):
+        if not isinstance(id, (int, long)) or id < 0:
+            if id in self.others:
+                return False
+            self.others.add(id)
+            return True
+
+        high = id >> 16
+        low = id & 0xffff
+        container = self.containers.get(high)
+        if container is None:
+            self.containers [high] = array.array('H', [low])
+        elif isinstance(container, bytearray):
+            mask = 1 << (low & 7)
+            if container [low >> 3] & mask:
+                return False
+            container [low >> 3] |= mask
+        else:
+            # ids mostly come in ascending order, so they are appended
+            if container and container [-1] < low:
+                index = len(container)
+            else:
+                index = bisect.bisect_left(container, low)
+                if index < len(container) and container [index] == low:
+                    return False
+            if len(container) < self.max_array:
+                container.insert(index, low)
+            else:
+                bitmap = bytearray(self.bitmap_size)
+                for value in container:
+                    bitmap [value >> 3] |= 1 << (value & 7)
+                bitmap [low >> 3] |= 1 << (low & 7)
+                self.containers [high] = bitmap
+        self.count += 1
+        return True
+
+    # return rows (ActivityRecords or csv rows) whose activity ids have not been added, and add them
+    def filterRows(self, rows):
+        new_rows = [row for row in rows if self.add(row [0])]
+        self.duplicates += len(rows) - len(new_rows)
+        return new_rows
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError(self.path + " is not an activity id index")
+            containers, others = struct.unpack('<QQ', f.read(16))
+            for i in range(containers):
+                high, kind, size = struct.unpack('<QBI', f.read(13))
+                if kind == 0:
+                    container = array.array('H')
+                    container.fromstring(f.read(size * 2))
+                    if sys.byteorder == 'big':
+                        container.byteswap()
+                    self.count += len(container)
+                else:
+                    container = bytearray(f.read(self.bitmap_size))
+                    self.count += size
+                self.containers [high] = container
+            if others:
+                self.others = set(json.loads(f.read(others)))
+
+    # write index into path. it is replaced by rename, so it is never left half written
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            others = ''
+            if self.others:
+                others = json.dumps(sorted(self.others))
+            f.write(self.magic)
+            f.write(struct.pack('<QQ', len(self.containers), len(others)))
+            for high in sorted(self.containers):
+                container = self.containers [high]
+                if isinstance(container, bytearray):
+                    size = sum(bin(byte).count('1') for byte in container)
+                    f.write(struct.pack('<QBI', high, 1, size))
+                    f.write(str(container))
+                else:
+                    f.write(struct.pack('<QBI', high, 0, len(container)))
+                    if sys.byteorder == 'big':
+                        container = array.array('H', container)
+                        container.byteswap()
+                    f.write(container.tostring())
+            f.write(others)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+
+# -------
+# External merge sort of activities by activity date and id, in bounded memory
+#
+#    max_activities: number of activities sorted in memory. more activities are spilled into
+#                    sorted run files, which are merged by iterSorted()
+#    spill_dir: directory of run files. default is the temporary directory
+#
+# Activities are results of Get Lead Activities, so activityDate is UTC and sorted as string.
+# Run files are removed by close().
+#
+class ActivitySorter:
+    chunk_size = 1000
+
+    def __init__(self, max_activities=100000, spill_dir=None):
+        self.max_activities = max_activities
+        self.spill_dir = spill_dir
+        self.buffer = []
+        self.runs = []
+
+    # add activities of a page
+    def add(self, activities):
+        for activity in activities:
+            self.buffer.append(((activity ['activityDate'], activity ['id']), activity))
+        if len(self.buffer) >= self.max_activities:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort()
+        run = tempfile.TemporaryFile(prefix='mktoSort', dir=self.spill_dir)
+        for start in range(0, len(self.buffer), self.chunk_size):
+            cPickle.dump(self.buffer [start:start + self.chunk_size], run, 2)
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+
+    def _iterRun(self, run):
+        while True:
+            try:
+                chunk = cPickle.load(run)
+            except EOFError:
+                return
+            for item in chunk:
+                yield item
+
+    # yields lists of up to page_size activities in order of activity date and id
+    def iterSorted(self, page_size=300):
+        self.buffer.sort()
+        if self.runs:
+            items = heapq.merge(iter(self.buffer), *[self._iterRun(run) for run in self.runs])
+        else:
+            items = iter(self.buffer)
+        page = []
+        for key, activity in items:
+            page.append(activity)
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+
+
+# -------
+# Yields (activities of a page, None) of results in order of activity date and id. All the
+# results are read into sorter before the first page is yielded
+#
+#    results: (activities of a page, next paging token) such as iterActivityResults() yields
+#    sorter: ActivitySorter
+#
+def iterSortedActivityResults(results, sorter):
+    try:
+        for raw_data_result, next_token in results:
+            if raw_data_result:
+                sorter.add(raw_data_result)
+        for activities in sorter.iterSorted():
+            yield activities, None
+    finally:
+        sorter.close()
+
+
+# -------
+# Paging Get Lead Activities from token
+#
+#    mktoClient: MarketoClient
+#    token: paging token returned by Get Paging Token
+#    activity_type_ids: comma separated activity type ids
+#    since/until: activityDate formatted as "2015-04-10T00:00:00Z". activities before since are
+#                 dropped, and paging is stopped at the first activity on or after until
+#    token_index: PagingTokenIndex where tokens of the start of days are added
+#
+# yields each page (raw data) of successful responses. errors are retried by MarketoClient,
+# and those which can not be retried are raised as MarketoError.
+#
+def iterActivityPages(mktoClient, token, activity_type_ids, since=None, until=None, debug=False, token_index=None):
+    moreResult=True
+    last_date = since
+    while moreResult:
+        raw_data = mktoClient.getLeadActivitiesRaw(token, activity_type_ids)
+        # page is formatted only when it is printed
+        if debug and mktoClient.isDebugPage():
+            print >> sys.stderr, "Activity: " + json.dumps(raw_data, indent=4)
+
+        if token_index is not None:
+            last_date = token_index.addPage(activity_type_ids, token, raw_data.get('result'), last_date)
+        token = raw_data ['nextPageToken']
+        moreResult = clipActivityPage(raw_data, since, until)
+        yield raw_data
+
+
+# drop activities of page out of since .. until, and return moreResult. it is False after
+# the first activity on or after until
+def clipActivityPage(raw_data, since, until):
+    moreResult = raw_data ['moreResult']
+    if (since or until) and raw_data.has_key('result'):
+        raw_data_result = []
+        for result in raw_data ['result']:
+            if since and result ['activityDate'] < since:
+                continue
+            if until and result ['activityDate'] >= until:
+                # reached the end of window, so we stop paging
+                moreResult = False
+                raw_data ['moreResult'] = False
+                break
+            raw_data_result.append(result)
+        raw_data ['result'] = raw_data_result
+    return moreResult
+
+
+# -------
+# Paging Get Lead Changes from token. Same as iterActivityPages, but "Change Data Value"
+# activities are filtered by the server to those of fields
+#
+#    mktoClient: MarketoClient
+#    token: paging token returned by Get Paging Token
+#    fields: comma separated REST API field names
+#    since/until: same as iterActivityPages
+#
+def iterLeadChangePages(mktoClient, token, fields, since=None, until=None, debug=False):
+    moreResult=True
+    while moreResult:
+        raw_data = mktoClient.getLeadChangesRaw(token, fields)
+        if debug and mktoClient.isDebugPage():
+            print >> sys.stderr, "Lead Changes: " + json.dumps(raw_data, indent=4)
+
+        token = raw_data ['nextPageToken']
+        moreResult = clipActivityPage(raw_data, since, until)
+        yield raw_data
+
+
+# -------
+# Return "Change Data Value" activities of a result of Get Lead Changes, in the form of
+# Get Lead Activities, so they are converted by ActivityTransformer
+#
+#    result: an activity of Get Lead Changes, having changed fields in "fields"
+#    lead_change_fields: {REST API field name: 'UI' field name} of tracking fields
+#
+def convertLeadChange(result, lead_change_fields):
+    activities = []
+    if result ['activityTypeId'] != 13:
+        # other activities changing fields such as New Lead are fetched by Get Lead Activities
+        return activities
+    for field in result.get('fields', []):
+        name = lead_change_fields.get(field ['name'])
+        if name is None:
+            continue
+        attributes = [{'name': 'New Value', 'value': field.get('newValue')},
+                      {'name': 'Old Value', 'value': field.get('oldValue')}]
+        attributes.extend(result.get('attributes', []))
+        activities.append({'id': result ['id'],
+                           'leadId': result ['leadId'],
+                           'activityDate': result ['activityDate'],
+                           'activityTypeId': 13,
+                           'primaryAttributeValueId': field.get('id'),
+                           'primaryAttributeValue': name,
+                           'attributes': attributes})
+    return activities
+
+
+# -------
+# Yields activities of pages from token, merging Get Lead Activities of other activity types and
+# "Change Data Value" activities of tracking fields from Get Lead Changes
+#
+#    mktoClient: MarketoClient
+#    token: paging token returned by Get Paging Token, used for both of them
+#    activity_type_ids: comma separated activity type ids. 13 is fetched by Get Lead Changes
+#    lead_change_fields: {REST API field name: 'UI' field name} of tracking fields
+#    since/until: same as iterActivityPages
+#    page_size: max number of activities of each page yielded
+#
+# Get Lead Activities returns "Change Data Value" of all the fields, which are mostly dropped
+# by ActivityTransformer. Get Lead Changes drops them on the server instead. Both are in order of
+# activity date and id, and pages of each are fetched only when the merge reaches their end.
+#
+def iterMergedActivityPages(mktoClient, token, activity_type_ids, lead_change_fields, since=None, until=None, page_size=300, debug=False):
+    other_type_ids = ','.join(id for id in activity_type_ids.split(',') if id.strip() != '13')
+    fields = ','.join(sorted(lead_change_fields.keys()))
+
+    def iterActivities():
+        for raw_data in iterActivityPages(mktoClient, token, other_type_ids, since, until, debug):
+            for result in raw_data.get('result', []):
+                yield (result ['activityDate'], result ['id']), result
+
+    def iterChanges():
+        for raw_data in iterLeadChangePages(mktoClient, token, fields, since, until, debug):
+            for result in raw_data.get('result', []):
+                for activity in convertLeadChange(result, lead_change_fields):
+                    yield (activity ['activityDate'], activity ['id']), activity
+
+    results = []
+    for key, result in heapq.merge(iterActivities(), iterChanges()):
+        results.append(result)
+        if len(results) >= page_size:
+            yield results
+            results = []
+    if results:
+        yield results
+
+
+# -------
+# Running iterable in a background thread, so the next items are prepared while
+# the caller is working on the current one
+#
+#    iterable: iterable consumed by the background thread
+#    size: max number of items buffered. the thread is blocked while the queue is full
+#
+# exceptions raised by iterable are raised again by the caller after all the items
+# produced before them.
+#
+class BackgroundIterator:
+    def __init__(self, iterable, size):
+        self.iterable = iterable
+        self.queue = Queue.Queue(size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # put item into queue without blocking forever after close() is called
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            for item in self.iterable:
+                self._put(('item', item))
+                if self.stopped.is_set():
+                    return
+            self._put(('done', None))
+        except BaseException:
+            self._put(('error', sys.exc_info()))
+
+    def __iter__(self):
+        try:
+            # after close(), the consumer stops too. it may be the thread of another BackgroundIterator
+            while not self.stopped.is_set():
+                try:
+                    # wait with timeout, so KeyboardInterrupt is not blocked
+                    kind, value = self.queue.get(True, 0.5)
+                except Queue.Empty:
+                    continue
+                if kind == 'item':
+                    yield value
+                elif kind == 'done':
+                    return
+                else:
+                    raise value [0], value [1], value [2]
+        finally:
+            self.close()
+
+    # stop the thread. it is given a few seconds to finish the current item, so it is
+    # not left running while the interpreter shuts down
+    def close(self):
+        self.stopped.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join(5.0)
+
+    def isRunning(self):
+        return self.thread.is_alive()
+
+
+# write checkpoint into path. it is written into temporary file at first and renamed,
+# so checkpoint is never left half written even if we are killed
+def saveCheckpoint(path, checkpoint):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def loadCheckpoint(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# -------
+# Log of lead state saved with checkpoints, so a checkpoint does not dump all the leads
+#
+#    checkpoint_path: checkpoint file. log is written into <checkpoint_path>.leads.<seq>
+#    store: LeadStateStore of the export
+#
+# A log starts with a snapshot of all the leads, and each checkpoint appends only the leads
+# changed since the last one. When the appended changes grow larger than the snapshot, a new
+# log is started with a snapshot. The checkpoint records the log and its size, so rows
+# appended after the checkpoint are dropped by load(). Logs older than the one of the saved
+# checkpoint are removed by removeOldLogs().
+#
+class LeadStateLog:
+    def __init__(self, checkpoint_path, store):
+        self.checkpoint_path = checkpoint_path
+        self.store = store
+        self.file = None
+        self.seq = 0
+        self.size = 0
+        # bytes of the snapshot at the start of the log, and changes appended after it
+        self.snapshot_size = 0
+        self.changes_size = 0
+        store.trackChanges()
+
+    def _logPath(self, seq):
+        return self.checkpoint_path + '.leads.' + str(seq)
+
+    # seq of existing logs of the checkpoint
+    def _listLogs(self):
+        directory = os.path.dirname(self.checkpoint_path) or '.'
+        prefix = os.path.basename(self.checkpoint_path) + '.leads.'
+        seqs = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name [len(prefix):].isdigit():
+                seqs.append(int(name [len(prefix):]))
+        return seqs
+
+    # restore lead state from log written until a checkpoint, and continue appending to it
+    #    name: lead_state_file of checkpoint
+    #    size: lead_state_size of checkpoint
+    def load(self, name, size):
+        self.seq = int(name.rsplit('.', 1) [1])
+        self.file = open(os.path.join(os.path.dirname(self.checkpoint_path), name), 'r+b')
+        self.store.loadSnapshot(self.file, size)
+        self.file.seek(size)
+        self.file.truncate()
+        self.size = size
+        self.snapshot_size = size
+        self.changes_size = 0
+        self.store.trackChanges()
+
+    # append lead state into log and return it for checkpoint: {'lead_state_file', 'lead_state_size'}
+    def take(self):
+        if self.file is None or self.changes_size > self.snapshot_size:
+            if self.file is not None:
+                self.file.close()
+            self.seq = max(self._listLogs() + [self.seq]) + 1
+            self.file = open(self._logPath(self.seq), 'wb')
+            self.size = self.snapshot_size = self.store.writeSnapshot(self.file)
+            self.changes_size = 0
+        else:
+            size = self.store.writeChanges(self.file)
+            self.size += size
+            self.changes_size += size
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {'lead_state_file': os.path.basename(self._logPath(self.seq)),
+                'lead_state_size': self.size}
+
+    # remove logs before the one of the saved checkpoint. logs after it may be appended by
+    # take() for the next checkpoint
+    def removeOldLogs(self, lead_state):
+        seq = int(lead_state ['lead_state_file'].rsplit('.', 1) [1])
+        for old_seq in self._listLogs():
+            if old_seq < seq:
+                os.remove(self._logPath(old_seq))
+
+    # remove all logs, such as before starting a new export with the checkpoint
+    def removeAllLogs(self):
+        for seq in self._listLogs():
+            os.remove(self._logPath(seq))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# -------
+# Index of paging tokens at the start of each day (UTC), collected while paging activities
+#
+#    path: JSON file where the index is loaded from and saved into
+#    instance: Marketo Instance URL. index of another instance is rejected by ValueError
+#    list_id: ListId filtering leads. index of another list is rejected by ValueError
+#
+# The token of a day is the one of the page having the first activity on the day, so all the
+# activities before the token are before the day. It is reused by later runs starting on that
+# day instead of calling Get Paging Token, and activities before since are dropped by
+# iterActivityPages. Pages filtered by other activity types may skip activities of the type
+# of this page, so tokens are kept for each activity_type_ids.
+#
+class PagingTokenIndex:
+    def __init__(self, path, instance, list_id=None):
+        self.path = path
+        self.instance = instance
+        self.list_id = list_id
+        self.tokens = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            index = loadCheckpoint(path)
+            if index.get('instance') != instance or index.get('list_id') != list_id:
+                raise ValueError(path + " is an index of another instance or list")
+            self.tokens = index.get('tokens', {})
+
+    def __len__(self):
+        return sum(len(days) for days in self.tokens.itervalues())
+
+    # return token of the day of since, or None if it is not known
+    def lookup(self, since, activity_type_ids):
+        day = parseDate(since).strftime('%Y-%m-%d')
+        with self.lock:
+            token = self.tokens.get(activity_type_ids, {}).get(day)
+            if token is not None:
+                self.hits += 1
+            return token
+
+    # add token returned by Get Paging Token. only tokens of the start of a day are kept
+    def add(self, since, activity_type_ids, token):
+        date = parseDate(since)
+        if date.time() == datetime.min.time():
+            with self.lock:
+                self.tokens.setdefault(activity_type_ids, {}) [date.strftime('%Y-%m-%d')] = token
+
+    # add token of a page to the days started in the page, and return activityDate of the last
+    # activity. last_date is activityDate of the last activity before the page, or None if it
+    # is not known
+    def addPage(self, activity_type_ids, token, results, last_date):
+        if not results:
+            return last_date
+        page_last_date = results [-1]['activityDate']
+        if last_date is not None:
+            day = parseDate(last_date [:10]) + timedelta(days=1)
+            with self.lock:
+                days = self.tokens.setdefault(activity_type_ids, {})
+                while formatDate(day) <= page_last_date:
+                    days [day.strftime('%Y-%m-%d')] = token
+                    day += timedelta(days=1)
+        return page_last_date
+
+    def save(self):
+        with self.lock:
+            index = {'instance': self.instance, 'list_id': self.list_id, 'tokens': self.tokens}
+            saveCheckpoint(self.path, index)
+
+
+# return paging token of since, looked up in token_index (PagingTokenIndex) at first
+def lookupPagingToken(mktoClient, since, activity_type_ids, token_index=None):
+    if token_index is None:
+        return mktoClient.getPagingToken(since)
+    token = token_index.lookup(since, activity_type_ids)
+    if token is None:
+        token = mktoClient.getPagingToken(since)
+        token_index.add(since, activity_type_ids, token)
+    return token
+
+
+# -------
+# Writing ExportMetrics periodically from a background thread
+#
+#    metrics: ExportMetrics
+#    interval: seconds between reports
+#    stats_file: file such as sys.stderr, where a JSON stats line is written on each report
+#    prometheus_file: path of Prometheus textfile, replaced on each report
+#
+# close() writes the last report and stops the thread. It can be called more than once.
+#
+class MetricsReporter:
+    def __init__(self, metrics, interval, stats_file=None, prometheus_file=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.stats_file = stats_file
+        self.prometheus_file = prometheus_file
+        self.stopped = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def report(self):
+        if self.stats_file is not None:
+            self.stats_file.write(json.dumps(self.metrics.getSnapshot(), sort_keys=True) + '\n')
+            self.stats_file.flush()
+        if self.prometheus_file:
+            # textfile collector may read it at any time, so it is replaced by rename
+            tmp_path = self.prometheus_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.metrics.formatPrometheus())
+            os.rename(tmp_path, self.prometheus_file)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.report()
+            except (IOError, OSError), e:
+                print >> sys.stderr, "Failed to write metrics: ", e
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.report()
+
+
+# -------
+# Sampling profiler of all threads, used by --profile
+#
+#    interval: seconds between samples
+#
+# Stacks of all the other threads are sampled by sys._current_frames(), so unlike cProfile,
+# threads fetching, transforming and compressing pages are included, and the overhead does not
+# grow with the number of function calls. Samples are wall clock time, so threads waiting for
+# responses or queues are counted too.
+#
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.thread_samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self):
+        own_ident = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(os.path.basename(code.co_filename) + ':' + code.co_name + ':' + str(code.co_firstlineno))
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                self.stacks [stack] = self.stacks.get(stack, 0) + 1
+                self.thread_samples += 1
+            self.samples += 1
+
+    # write stacks as "outer;inner count" lines, read by flamegraph.pl or speedscope
+    def writeCollapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write(';'.join(stack) + ' ' + str(count) + '\n')
+
+    # list of (function, samples on top of stack, samples in stack) with the most samples on top
+    def getTopFunctions(self, count=20):
+        own_samples = {}
+        total_samples = {}
+        for stack, samples in self.stacks.iteritems():
+            own_samples [stack [-1]] = own_samples.get(stack [-1], 0) + samples
+            for function in set(stack):
+                total_samples [function] = total_samples.get(function, 0) + samples
+        functions = sorted(own_samples, key=lambda function: own_samples [function], reverse=True) [:count]
+        return [(function, own_samples [function], total_samples [function]) for function in functions]
+
+
+# convert row of bulk activity export file into the form of Get Lead Activities result
+#
+# csv columns: marketoGUID, leadId, activityDate, activityTypeId, campaignId,
+#              primaryAttributeValueId, primaryAttributeValue, attributes
+# attributes is a json object such as {"New Value": "10", "Old Value": "5"}
+#
+def convertExportedActivity(header, row):
+    values = dict(zip(header, [value.decode('utf-8') for value in row]))
+    result = {}
+
+    activity_id = values.get('marketoGUID', values.get('id'))
+    if activity_id.isdigit():
+        activity_id = int(activity_id)
+    result ['id'] = activity_id
+    result ['leadId'] = int(values ['leadId'])
+    result ['activityDate'] = values ['activityDate']
+    result ['activityTypeId'] = int(values ['activityTypeId'])
+    if values.get('primaryAttributeValueId'):
+        result ['primaryAttributeValueId'] = int(values ['primaryAttributeValueId'])
+    if values.has_key('primaryAttributeValue'):
+        result ['primaryAttributeValue'] = values ['primaryAttributeValue']
+
+    attributes = []
+    if values.get('attributes'):
+        for name, value in json.loads(values ['attributes']).iteritems():
+            attributes.append({'name': name, 'value': value})
+    result ['attributes'] = attributes
+    return result
+
+
+# -------
+# Exporting activities by Bulk Extract
+#
+#    mktoClient: MarketoClient
+#    windows: list of (since, until) returned by splitTimeWindows. one export job is created for each window
+#    activity_type_ids: comma separated activity type ids
+#    page_size: number of activities yielded at once
+#    poll_interval/max_poll_interval: status of job is polled with exponential backoff
+#    sort_buffer: number of activities of a job sorted in memory by ActivitySorter
+#
+# yields list of activities in the same form as Get Lead Activities result. The job of next window
+# is enqueued before the file of current job is read, so Marketo prepares it in the meantime.
+# Rows of the file are not guaranteed to be ordered, so activities of each job are sorted by
+# activity date and id (in temporary files beyond sort_buffer) before they are yielded.
+#
+def iterBulkActivityPages(mktoClient, windows, activity_type_ids, page_size=300, poll_interval=5.0, max_poll_interval=60.0, debug=False,
+                          sort_buffer=100000):
+    def enqueueJob(window):
+        since, until = window
+        raw_data = mktoClient.createActivityExportJobRaw(since, until, activity_type_ids)
+        export_id = raw_data ['result'][0]['exportId']
+        mktoClient.enqueueActivityExportJobRaw(export_id)
+        if debug:
+            print >> sys.stderr, "Export job " + export_id + " has been enqueued for " + since + " - " + until
+        return export_id
+
+    next_export_id = None
+    for index, window in enumerate(windows):
+        since, until = window
+        if next_export_id is None:
+            export_id = enqueueJob(window)
+        else:
+            export_id = next_export_id
+
+        # poll status of job with backoff
+        wait = poll_interval
+        while True:
+            raw_data = mktoClient.getActivityExportJobStatusRaw(export_id)
+            status = raw_data ['result'][0]['status']
+            if debug:
+                print >> sys.stderr, "Export job " + export_id + ": " + status
+            if status == 'Completed':
+                break
+            if status in ('Failed', 'Cancelled'):
+                raise MarketoError(status, "Export job " + export_id + " has been " + status.lower())
+            time.sleep(wait)
+            wait = min(wait * 2, max_poll_interval)
+
+        # let Marketo work on the next job while we read this file
+        next_export_id = None
+        if index + 1 < len(windows):
+            next_export_id = enqueueJob(windows [index + 1])
+
+        export_file = mktoClient.openActivityExportFile(export_id)
+        sorter = ActivitySorter(sort_buffer)
+        try:
+            try:
+                reader = csv.reader(export_file)
+                header = None
+                page = []
+                for row in reader:
+                    if header is None:
+                        header = row
+                        continue
+                    result = convertExportedActivity(header, row)
+                    # createdAt filter includes both ends, so we drop activities of next window
+                    if result ['activityDate'] < since or result ['activityDate'] >= until:
+                        continue
+                    page.append(result)
+                    if len(page) >= page_size:
+                        sorter.add(page)
+                        page = []
+                sorter.add(page)
+            finally:
+                export_file.close()
+            for page in sorter.iterSorted(page_size):
+                yield page
+        finally:
+            sorter.close()
+
+
+# parse date such as "2015-04-10" or "2015-04-10T09:00:00" as UTC
+def parseDate(date):
+    for date_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return datetime.strptime(date, date_format)
+        except ValueError:
+            pass
+    raise ValueError("Unknown date format: " + date)
+
+# format date for sinceDatetime and comparing with activityDate
+def formatDate(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+# split since .. until into time windows of shard_by ("day", "week" or timedelta)
+def splitTimeWindows(since, until, shard_by):
+    if isinstance(shard_by, timedelta):
+        step = shard_by
+    elif shard_by == 'week':
+        step = timedelta(days=7)
+    else:
+        step = timedelta(days=1)
+
+    windows = []
+    start = since
+    while start < until:
+        end = min(start + step, until)
+        windows.append((formatDate(start), formatDate(end)))
+        start = end
+    return windows
+
+
+# -------
+# Worker threads shared by exports of several instances
+#
+#    workers: number of threads
+#
+# Tasks are queued for each owner (such as the export of an instance). A free worker takes the
+# next task of the owner with the fewest running tasks, and owners with the same number take
+# turns, so one large export can not take all the workers while others are waiting.
+#
+class FairWorkerPool:
+    def __init__(self, workers):
+        self.condition = threading.Condition()
+        self.tasks = collections.OrderedDict()
+        self.running = {}
+        self.closed = False
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    # run task() on a worker
+    def submit(self, owner, task):
+        with self.condition:
+            self.tasks.setdefault(owner, collections.deque()).append(task)
+            self.running.setdefault(owner, 0)
+            self.condition.notify()
+
+    # return (owner, task) to be run next, or None. called with condition held
+    def _takeTask(self):
+        owner = None
+        for candidate, tasks in self.tasks.iteritems():
+            if tasks and (owner is None or self.running [candidate] < self.running [owner]):
+                owner = candidate
+        if owner is None:
+            return None
+        # move owner to the end, so it waits for other owners next time
+        tasks = self.tasks.pop(owner)
+        self.tasks [owner] = tasks
+        self.running [owner] += 1
+        return owner, tasks.popleft()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
+                    item = self._takeTask()
+                    if item is not None:
+                        break
+                    self.condition.wait()
+            owner, task = item
+            try:
+                task()
+            except Exception, e:
+                print >> sys.stderr, "Error in worker: ", e
+            finally:
+                with self.condition:
+                    self.running [owner] -= 1
+
+    # stop workers after their running tasks. queued tasks are not run
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+# -------
+# Fetching time windows at the same time
+#
+#    mktoClient: MarketoClient shared by all workers
+#    windows: list of (since, until) returned by splitTimeWindows
+#    activity_type_ids: comma separated activity type ids
+#    workers: number of windows fetched at the same time
+#    prefetch: max number of pages buffered for each window
+#    pool: FairWorkerPool shared with other fetchers. if given, windows are fetched by the pool
+#          instead of workers threads of this fetcher
+#    lead_change_fields: {REST API field name: 'UI' field name}. if given, "Change Data Value"
+#                        activities are fetched by Get Lead Changes (see iterMergedActivityPages)
+#    token_index: PagingTokenIndex where paging tokens of windows are looked up and added. it is
+#                 not used with lead_change_fields
+#
+# Each window gets its own paging token. Windows are handed to workers in order and results
+# are yielded window by window, so activities come out ordered by activity date and id just
+# like a sequential run. A worker can not run ahead more than prefetch pages of the window
+# which is currently yielded, so memory usage is bounded.
+#
+class ShardedActivityFetcher:
+    def __init__(self, mktoClient, windows, activity_type_ids, workers, prefetch=4, debug=False, pool=None, lead_change_fields=None, token_index=None):
+        self.mktoClient = mktoClient
+        self.windows = windows
+        self.activity_type_ids = activity_type_ids
+        self.workers = workers
+        self.debug = debug
+        self.pool = pool
+        self.lead_change_fields = lead_change_fields
+        self.token_index = token_index
+
+        self.window_queue = Queue.Queue()
+        self.page_queues = []
+        for window in windows:
+            self.window_queue.put(len(self.page_queues))
+            self.page_queues.append(Queue.Queue(prefetch))
+        self.stopped = threading.Event()
+
+    # put item into page queue without blocking forever after stop() is called
+    def _put(self, page_queue, item):
+        while not self.stopped.is_set():
+            try:
+                page_queue.put(item, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def _work(self):
+        while not self.stopped.is_set():
+            try:
+                index = self.window_queue.get_nowait()
+            except Queue.Empty:
+                return
+            if not self._fetchWindow(index):
+                return
+
+    # fetch pages of a window into its page queue. return False if fetching should be stopped
+    def _fetchWindow(self, index):
+        if self.stopped.is_set():
+            return False
+        since, until = self.windows [index]
+        page_queue = self.page_queues [index]
+        try:
+            if self.lead_change_fields:
+                token = self.mktoClient.getPagingToken(since)
+                pages = iterMergedActivityPages(self.mktoClient, token, self.activity_type_ids, self.lead_change_fields, since, until, debug=self.debug)
+            else:
+                token = lookupPagingToken(self.mktoClient, since, self.activity_type_ids, self.token_index)
+                pages = (raw_data ['result'] for raw_data in iterActivityPages(self.mktoClient, token, self.activity_type_ids, since, until, self.debug, self.token_index)
+                         if raw_data.has_key('result'))
+            for results in pages:
+                self._put(page_queue, ('page', results))
+                if self.stopped.is_set():
+                    return False
+            self._put(page_queue, ('done', None))
+            return True
+        except Exception, e:
+            self._put(page_queue, ('error', e))
+            return False
+
+    def stop(self):
+        self.stopped.set()
+
+    # yields list of activities in order of windows
+    def iterResults(self):
+        threads = []
+        if self.pool is not None:
+            # windows are queued in order, so the window yielded next is always fetched first
+            for index in range(len(self.windows)):
+                self.pool.submit(self, functools.partial(self._fetchWindow, index))
+        else:
+            for i in range(min(self.workers, len(self.windows))):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for page_queue in self.page_queues:
+                while True:
+                    kind, value = page_queue.get()
+                    if kind == 'page':
+                        yield value
+                    elif kind == 'done':
+                        break
+                    else:
+                        raise value
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+
+# -------
+# Result of an operation running on EventLoop
+#
+# Coroutines are generators yielding Futures (or other coroutines). They are resumed with the
+# result of the Future, or the exception of it is raised at the yield.
+#
+class Future:
+    def __init__(self):
+        self.finished = False
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def setResult(self, value):
+        if self.finished:
+            return
+        self.finished = True
+        self.value = value
+        self._runCallbacks()
+
+    # exc_info: tuple returned by sys.exc_info(), or (type, value, None)
+    def setException(self, exc_info):
+        if self.finished:
+            return
+        self.finished = True
+        self.exc_info = exc_info
+        self._runCallbacks()
+
+    def addDoneCallback(self, callback):
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def _runCallbacks(self):
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def result(self):
+        if self.exc_info is not None:
+            raise self.exc_info [0], self.exc_info [1], self.exc_info [2]
+        return self.value
+
+
+# raised by coroutine to return value, since generators of Python 2 can not return a value
+class Return(Exception):
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+# -------
+# Running coroutine on EventLoop. Task is a Future of the value returned by the coroutine
+#
+class Task(Future):
+    def __init__(self, loop, coroutine):
+        Future.__init__(self)
+        self.loop = loop
+        self.coroutine = coroutine
+        loop.callSoon(self._step, None, None)
+
+    def _step(self, value, exc_info):
+        try:
+            if exc_info is not None:
+                yielded = self.coroutine.throw(exc_info [0], exc_info [1], exc_info [2])
+            else:
+                yielded = self.coroutine.send(value)
+        except Return, e:
+            self.setResult(e.value)
+            return
+        except StopIteration:
+            self.setResult(None)
+            return
+        except Exception:
+            self.setException(sys.exc_info())
+            return
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Task(self.loop, yielded)
+        yielded.addDoneCallback(self._wakeup)
+
+    # resumed by the loop, so long chains of finished futures do not grow the stack
+    def _wakeup(self, future):
+        if future.exc_info is not None:
+            self.loop.callSoon(self._step, None, future.exc_info)
+        else:
+            self.loop.callSoon(self._step, future.value, None)
+
+
+# -------
+# Event loop running coroutines and callbacks of sockets and timers on the current thread
+#
+# asyncio is not available in Python 2, so this is a small loop on select(). It is not thread
+# safe, everything using it must run on the thread calling runUntilComplete().
+#
+class EventLoop:
+    def __init__(self):
+        self.ready = collections.deque()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.readers = {}
+        self.writers = {}
+
+    def callSoon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    # return timer which can be cancelled by cancelTimer()
+    def callLater(self, delay, callback, *args):
+        timer = [time.time() + delay, next(self.sequence), callback, args, False]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancelTimer(self, timer):
+        timer [4] = True
+
+    # Future resolved after seconds
+    def sleep(self, seconds):
+        future = Future()
+        self.callLater(seconds, future.setResult, None)
+        return future
+
+    # Future resolved when fd is readable (or writable). socket.timeout is raised after timeout
+    def waitFd(self, fd, writable, timeout=None):
+        future = Future()
+        handlers = self.writers if writable else self.readers
+        timer = None
+        def ready():
+            handlers.pop(fd, None)
+            if timer is not None:
+                self.cancelTimer(timer)
+            future.setResult(None)
+        def expired():
+            handlers.pop(fd, None)
+            future.setException((socket.timeout, socket.timeout('timed out'), None))
+        if timeout:
+            timer = self.callLater(timeout, expired)
+        handlers [fd] = ready
+        return future
+
+    def spawn(self, coroutine):
+        return Task(self, coroutine)
+
+    def _runOnce(self):
+        timeout = None
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers [0][0] - time.time())
+
+        if self.readers or self.writers:
+            try:
+                readable, writable, exceptional = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+            except select.error, e:
+                if e.args [0] != errno.EINTR:
+                    raise
+                readable, writable = [], []
+            for fd in readable:
+                callback = self.readers.get(fd)
+                if callback is not None:
+                    callback()
+            for fd in writable:
+                callback = self.writers.get(fd)
+                if callback is not None:
+                    callback()
+        elif timeout is None:
+            raise RuntimeError("EventLoop has nothing to wait for")
+        elif timeout > 0:
+            time.sleep(timeout)
+
+        now = time.time()
+        while self.timers and self.timers [0][0] <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer [4]:
+                self.ready.append((timer [2], timer [3]))
+
+        for i in range(len(self.ready)):
+            callback, args = self.ready.popleft()
+            callback(*args)
+
+    # run coroutine (or Future) until it is finished, and return its result
+    def runUntilComplete(self, coroutine):
+        future = coroutine
+        if isinstance(coroutine, types.GeneratorType):
+            future = self.spawn(coroutine)
+        while not future.done():
+            self._runOnce()
+        return future.result()
+
+
+# -------
+# Non-blocking HTTP/1.1 connection used by AsyncConnectionPool
+#
+#    loop: EventLoop
+#    host/port: server address
+#    secure: use https
+#    timeout: seconds of waiting for the server. None means no timeout
+#
+# Responses of Content-Length, chunked and until-close bodies are read, and gzip bodies
+# are decoded. The connection can be reused while reusable is True.
+#
+class AsyncHttpConnection:
+    recv_size = 65536
+
+    def __init__(self, loop, host, port, secure, timeout=None):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ''
+        self.reusable = True
+
+    def _wait(self, writable):
+        return self.loop.waitFd(self.sock.fileno(), writable, self.timeout)
+
+    def connect(self):
+        family, socktype, proto, canonname, address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM) [0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(False)
+        error = self.sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(error, os.strerror(error))
+        if error:
+            yield self._wait(True)
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if self.secure:
+            context = ssl.create_default_context()
+            self.sock = context.wrap_socket(self.sock, server_hostname=self.host, do_handshake_on_connect=False)
+            while True:
+                try:
+                    self.sock.do_handshake()
+                    break
+                except ssl.SSLWantReadError:
+                    yield self._wait(False)
+                except ssl.SSLWantWriteError:
+                    yield self._wait(True)
+
+    def close(self):
+        self.reusable = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _sendAll(self, data):
+        while data:
+            try:
+                sent = self.sock.send(data)
+            except ssl.SSLWantWriteError:
+                yield self._wait(True)
+                continue
+            except ssl.SSLWantReadError:
+                yield self._wait(False)
+                continue
+            except socket.error, e:
+                if e.args [0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                yield self._wait(True)
+                continue
+            data = data [sent:]
+
+    # read more data into buffer. return False at the end of stream
+    def _fill(self):
+        while True:
+            try:
+                data = self.sock.recv(self.recv_size)
+                break
+            except ssl.SSLWantReadError:
+                yield self._wait(False)
+            except ssl.SSLWantWriteError:
+                yield self._wait(True)
+            except socket.error, e:
+                if e.args [0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                yield self._wait(False)
+        self.buffer += data
+        raise Return(len(data) > 0)
+
+    def _readUntil(self, marker):
+        start = 0
+        while True:
+            index = self.buffer.find(marker, start)
+            if index >= 0:
+                break
+            start = max(len(self.buffer) - len(marker) + 1, 0)
+            more = yield self._fill()
+            if not more:
+                raise httplib.IncompleteRead(self.buffer)
+        data = self.buffer [:index]
+        self.buffer = self.buffer [index + len(marker):]
+        raise Return(data)
+
+    def _readBytes(self, size):
+        while len(self.buffer) < size:
+            more = yield self._fill()
+            if not more:
+                raise httplib.IncompleteRead(self.buffer, size - len(self.buffer))
+        data = self.buffer [:size]
+        self.buffer = self.buffer [size:]
+        raise Return(data)
+
+    # send request and return (status, reason, headers, body). names of headers are lower case
+    def request(self, method, path, headers, body=''):
+        lines = [method + ' ' + path + ' HTTP/1.1', 'Host: ' + self.host]
+        for name, value in headers.iteritems():
+            lines.append(name + ': ' + value)
+        if body or method == 'POST':
+            lines.append('Content-Length: ' + str(len(body)))
+        yield self._sendAll('\r\n'.join(lines) + '\r\n\r\n' + (body or ''))
+
+        head = yield self._readUntil('\r\n\r\n')
+        head_lines = head.split('\r\n')
+        status_line = head_lines [0].split(' ', 2)
+        if len(status_line) < 2 or not status_line [0].startswith('HTTP/'):
+            raise httplib.BadStatusLine(head_lines [0])
+        version, status = status_line [0], int(status_line [1])
+        reason = status_line [2] if len(status_line) > 2 else ''
+        response_headers = {}
+        for line in head_lines [1:]:
+            name, separator, value = line.partition(':')
+            response_headers [name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size_line = yield self._readUntil('\r\n')
+                size = int(size_line.split(';') [0], 16)
+                if size == 0:
+                    # no trailers are expected
+                    yield self._readUntil('\r\n')
+                    break
+                chunk = yield self._readBytes(size + 2)
+                chunks.append(chunk [:-2])
+            content = ''.join(chunks)
+        elif response_headers.has_key('content-length'):
+            content = yield self._readBytes(int(response_headers ['content-length']))
+        else:
+            while (yield self._fill()):
+                pass
+            content = self.buffer
+            self.buffer = ''
+            self.reusable = False
+
+        connection = response_headers.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+            self.reusable = False
+        if response_headers.get('content-encoding', '').lower() == 'gzip':
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        raise Return((status, reason, response_headers, content))
+
+
+# -------
+# Pool of keep-alive non-blocking connections of EventLoop
+#
+#    loop: EventLoop
+#    size: max number of idle connections kept for each server
+#    timeout: seconds of waiting for the server. None means no timeout
+#
+# An idle connection may have been closed by the server. If a reused connection fails,
+# the request is sent again on a new connection.
+#
+class AsyncConnectionPool:
+    def __init__(self, loop, size=10, timeout=None):
+        self.loop = loop
+        self.size = size
+        self.timeout = timeout
+        self.idle = {}
+        self.opened = 0
+
+    # coroutine returning (status, reason, headers, body)
+    def request(self, url, method='GET', body='', headers=None):
+        parsed = urlparse.urlsplit(url)
+        secure = parsed.scheme == 'https'
+        port = parsed.port or (443 if secure else 80)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = path + '?' + parsed.query
+        key = (parsed.hostname, port, secure)
+        idle = self.idle.setdefault(key, [])
+
+        while True:
+            reused = bool(idle)
+            if reused:
+                connection = idle.pop()
+            else:
+                connection = AsyncHttpConnection(self.loop, parsed.hostname, port, secure, self.timeout)
+                self.opened += 1
+                try:
+                    yield connection.connect()
+                except:
+                    connection.close()
+                    raise
+            try:
+                response = yield connection.request(method, path, headers or {}, body)
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+            if connection.reusable and len(idle) < self.size:
+                idle.append(connection)
+            else:
+                connection.close()
+            raise Return(response)
+
+    def close(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle = {}
+
+
+# -------
+# Coroutine version of MarketoClient running on EventLoop
+#
+#    loop: EventLoop
+#    mkto_instance, grant_type, client_id, client_secret, list_id: same as MarketoClient
+#    rate_limiter: RateLimiter. it may be shared with MarketoClient of other threads
+#    pool: AsyncConnectionPool, default pool is used if None
+#    json_decoder, retry_policy, circuit_breaker, metrics: same as MarketoClient
+#
+# Methods are coroutines such as "data = yield client.getLeadActivitiesRaw(token, ids)". Any
+# number of requests can be in flight on the loop. They share one access token, refreshed once
+# when it expires, and wait for rate_limiter without blocking the loop.
+#
+class AsyncMarketoClient:
+    def __init__(self, loop, mkto_instance, grant_type, client_id, client_secret, list_id, rate_limiter=None, pool=None, json_decoder=None,
+                 retry_policy=None, circuit_breaker=None, metrics=None):
+        self.loop = loop
+        self.endpoint_url = mkto_instance
+        self.token_params = [('grant_type', grant_type), ('client_id', client_id), ('client_secret', client_secret)]
+        self.list_id = list_id
+        self.request_headers = {'Accept': 'application/json',
+                                'Accept-Encoding': 'gzip',
+                                'Content-Type': 'application/json; charset=UTF-8'
+                                }
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.pool = pool or AsyncConnectionPool(loop)
+        self.json_decoder = json_decoder or json.loads
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.metrics = metrics or ExportMetrics()
+
+        self.access_token = None
+        self.token_expires_at = 0
+        self.token_refresh = None
+        self.token_refreshes = 0
+        self.retry_stats = {}
+        # True after the first response of the instance
+        self.connected = False
+
+    def _acquire(self):
+        while True:
+            wait = self.rate_limiter.tryAcquire()
+            if wait == 0:
+                return
+            yield self.loop.sleep(wait)
+
+    def _getAccessToken(self):
+        if self.access_token is None or time.time() >= self.token_expires_at - 1.0:
+            yield self._refreshAccessToken(self.access_token)
+        raise Return(self.access_token)
+
+    # refresh access token unless it has been replaced. requests waiting for the same token
+    # share the refresh in flight
+    def _refreshAccessToken(self, stale_token):
+        if self.token_refresh is not None:
+            yield self.token_refresh
+            return
+        if self.access_token != stale_token:
+            return
+        self.token_refresh = Future()
+        try:
+            while True:
+                data = yield self._request('/identity/oauth/token', self.token_params, authenticate=False)
+                access_token = data ['access_token']
+                expires_in = data ['expires_in']
+                # Marketo returns the same token until it expires
+                if stale_token is None or access_token != stale_token or expires_in >= 2:
+                    break
+                yield self.loop.sleep(expires_in + 1.0)
+            self.access_token = access_token
+            self.token_expires_at = time.time() + expires_in
+            if stale_token is not None:
+                self.token_refreshes += 1
+            self.token_refresh.setResult(None)
+        except Exception:
+            self.token_refresh.setException(sys.exc_info())
+            raise
+        finally:
+            self.token_refresh = None
+
+    # coroutine returning decoded json of successful response. errors are retried in the
+    # same way as MarketoClient
+    def _request(self, path, params=(), method='GET', body='', authenticate=True):
+        attempts = {}
+        while True:
+            paused = self.circuit_breaker.open_until - time.time()
+            if paused > 0:
+                self._recordRetry('circuit breaker', paused)
+                self.metrics.addTime('retry_wait', paused)
+                yield self.loop.sleep(paused)
+
+            query = []
+            access_token = None
+            if authenticate:
+                wait_start = time.time()
+                access_token = yield self._getAccessToken()
+                self.metrics.addTime('token_wait', time.time() - wait_start)
+                query.append(('access_token', access_token))
+            url = self.endpoint_url + path + '?' + encodeQuery(query + list(params))
+
+            wait_start = time.time()
+            yield self._acquire()
+            request_start = time.time()
+            response = None
+            try:
+                response = yield self.pool.request(url, method, body, self.request_headers)
+            except socket.timeout, e:
+                code, message = 'timeout', str(e)
+            except (socket.error, httplib.HTTPException), e:
+                code, message = 'connection', str(e) or e.__class__.__name__
+            finally:
+                self.rate_limiter.release()
+            request_end = time.time()
+
+            if response is not None:
+                self.connected = True
+                status, reason, headers, content = response
+                code, message = checkRestResponse(status, reason, content, self.json_decoder)
+            self.metrics.observeRequest(path, request_end - request_start, code, request_start - wait_start, time.time() - request_end)
+            if code is None:
+                self.circuit_breaker.recordSuccess()
+                raise Return(message)
+
+            if code == 'connection' and not self.connected:
+                raise MarketoError(code, message)
+            kind, wait = self.retry_policy.nextRetry(code, message, attempts)
+            if kind == 'token':
+                wait_start = time.time()
+                yield self._refreshAccessToken(access_token)
+                self.metrics.addTime('token_wait', time.time() - wait_start)
+            else:
+                if self.circuit_breaker.recordFailure():
+                    print >> sys.stderr, "Too many errors. Requests are paused for " + str(int(self.circuit_breaker.open_until - time.time())) + " sec..."
+                yield self.loop.sleep(wait)
+                self.metrics.addTime('retry_wait', wait)
+            self._recordRetry(code, wait)
+
+    def _recordRetry(self, code, wait):
+        stats = self.retry_stats.setdefault(code, {'retries': 0, 'seconds': 0.0})
+        stats ['retries'] += 1
+        stats ['seconds'] += wait
+
+    # number of retries and seconds waited for each error code
+    def getRetryStats(self):
+        return dict((code, dict(stats)) for code, stats in self.retry_stats.iteritems())
+
+    def close(self):
+        self.pool.close()
+
+    # get Paging Token, since may be formatted as "2015-04-10"
+    def getPagingToken(self, since):
+        data = yield self._request('/rest/v1/activities/pagingtoken.json', [('sinceDatetime', since)])
+        raise Return(data ['nextPageToken'])
+
+    # get lead activities
+    def getLeadActivitiesRaw(self, token, activity_type_ids):
+        data = yield self._request('/rest/v1/activities.json', [('nextPageToken', token), ('activityTypeIds', activity_type_ids), ('listId', self.list_id or None)])
+        raise Return(data)
+
+    # get leads by filter
+    def getLeadsRaw(self, filter_type, filter_values, fields):
+        data = yield self._request('/rest/v1/leads.json', [('filterType', filter_type), ('filterValues', filter_values), ('fields', fields)])
+        raise Return(data)
+
+    # get lead changes
+    def getLeadChangesRaw(self, token, fields):
+        data = yield self._request('/rest/v1/activities/leadchanges.json', [('nextPageToken', token), ('fields', fields), ('listId', self.list_id or None)])
+        raise Return(data)
+
+    # get activity Types
+    def getActivityTypesRaw(self):
+        data = yield self._request('/rest/v1/activities/types.json')
+        raise Return(data)
+
+
+# -------
+# Fetching time windows at the same time on one thread with AsyncMarketoClient
+#
+#    createClient: function returning AsyncMarketoClient for EventLoop given as argument
+#    windows, activity_type_ids, prefetch, token_index: same as ShardedActivityFetcher
+#    streams: number of windows paged at the same time
+#
+# Same as ShardedActivityFetcher, but all windows are paged by coroutines on a background
+# thread running EventLoop, so each stream costs a socket and a few pages of buffer instead
+# of a thread. Results are yielded in order of windows.
+#
+class AsyncActivityFetcher:
+    poll_interval = 0.02
+
+    def __init__(self, createClient, windows, activity_type_ids, streams, prefetch=4, token_index=None):
+        self.createClient = createClient
+        self.windows = windows
+        self.activity_type_ids = activity_type_ids
+        self.streams = streams
+        self.token_index = token_index
+        self.page_queues = [Queue.Queue(prefetch) for window in windows]
+        self.next_window = 0
+        self.stopped = threading.Event()
+        self.error = None
+        self.loop = None
+        self.client = None
+        self.thread = None
+
+    # page queue is read by another thread, so it is polled while it is full
+    def _put(self, page_queue, item):
+        while not self.stopped.is_set():
+            try:
+                page_queue.put_nowait(item)
+                return
+            except Queue.Full:
+                yield self.loop.sleep(self.poll_interval)
+
+    # coroutine paging windows one after another
+    def _stream(self):
+        while not self.stopped.is_set() and self.next_window < len(self.windows):
+            index = self.next_window
+            self.next_window += 1
+            since, until = self.windows [index]
+            page_queue = self.page_queues [index]
+            try:
+                token = None
+                if self.token_index is not None:
+                    token = self.token_index.lookup(since, self.activity_type_ids)
+                if token is None:
+                    token = yield self.client.getPagingToken(since)
+                    if self.token_index is not None:
+                        self.token_index.add(since, self.activity_type_ids, token)
+                moreResult = True
+                last_date = since
+                while moreResult and not self.stopped.is_set():
+                    raw_data = yield self.client.getLeadActivitiesRaw(token, self.activity_type_ids)
+                    if self.token_index is not None:
+                        last_date = self.token_index.addPage(self.activity_type_ids, token, raw_data.get('result'), last_date)
+                    token = raw_data ['nextPageToken']
+                    moreResult = clipActivityPage(raw_data, since, until)
+                    if raw_data.has_key('result'):
+                        yield self._put(page_queue, ('page', raw_data ['result']))
+                yield self._put(page_queue, ('done', None))
+            except Exception, e:
+                # other streams stop without finishing their windows, so iterResults() raises the first error
+                if self.error is None:
+                    self.error = e
+                yield self._put(page_queue, ('error', e))
+                self.stopped.set()
+                return
+
+    def _main(self):
+        tasks = [self.loop.spawn(self._stream()) for i in range(min(self.streams, len(self.windows)))]
+        for task in tasks:
+            yield task
+
+    def _run(self):
+        self.loop = EventLoop()
+        try:
+            self.client = self.createClient(self.loop)
+            self.loop.runUntilComplete(self._main())
+        except Exception, e:
+            if self.error is None:
+                self.error = e
+        finally:
+            if self.client is not None:
+                self.client.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    # retries and seconds waited by the client, after iterResults() is finished
+    def getRetryStats(self):
+        if self.client is None:
+            return {}
+        return self.client.getRetryStats()
+
+    # yields list of activities in order of windows
+    def iterResults(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        try:
+            for page_queue in self.page_queues:
+                while True:
+                    try:
+                        kind, value = page_queue.get(True, 0.5)
+                    except Queue.Empty:
+                        if not self.thread.is_alive() and page_queue.empty():
+                            raise self.error or RuntimeError("fetcher has been stopped")
+                        continue
+                    if kind == 'page':
+                        yield value
+                    elif kind == 'done':
+                        break
+                    else:
+                        raise value
+        finally:
+            self.stop()
+            self.thread.join()
+
+
+# -------
+# Yields (activities of a page, next paging token) of activities from since until until
+#
+#    mktoClient: MarketoClient
+#    since: Since Date time such as "2015-04-01". ignored if token is given
+#    until: Until Date time (exclusive). None means until now, which is not accepted with workers
+#    activity_type_ids: comma separated activity type ids
+#    workers: number of time windows fetched at the same time by ShardedActivityFetcher.
+#             next paging token is None if it is more than 1. ValueError is raised if until is None
+#    shard_by: size of time windows used by workers, day or week
+#    token: paging token to continue from, such as the one saved in checkpoint
+#    lead_change_fields: {REST API field name: 'UI' field name}. if given, "Change Data Value"
+#                        activities are fetched by Get Lead Changes, and next paging token is None
+#    token_index: PagingTokenIndex where paging tokens are looked up and added
+#    follow_interval: keep polling new activities every follow_interval seconds after the last
+#                     page. (None, next paging token) is yielded each time all activities until
+#                     now have been fetched. not accepted with workers and lead_change_fields
+#    page_hook: function called with each page (raw data) of Get Lead Activities before it is
+#               yielded, such as for checking it. not called with workers and lead_change_fields
+#
+def iterActivityResults(mktoClient, since, until, activity_type_ids, workers=1, shard_by='day', token=None, debug=False, lead_change_fields=None,
+                        token_index=None, follow_interval=None, page_hook=None):
+    if follow_interval is not None and (workers > 1 or lead_change_fields):
+        raise ValueError("follow_interval can not be used with workers and lead_change_fields")
+    if workers > 1:
+        if not until:
+            raise ValueError("until is required with workers")
+        windows = splitTimeWindows(parseDate(since), parseDate(until), shard_by)
+        fetcher = ShardedActivityFetcher(mktoClient, windows, activity_type_ids, workers, debug=debug, lead_change_fields=lead_change_fields,
+                                         token_index=token_index)
+        for results in fetcher.iterResults():
+            yield results, None
+        return
+
+    if until:
+        until = formatDate(parseDate(until))
+    if lead_change_fields:
+        if token is None:
+            token = mktoClient.getPagingToken(since)
+        for results in iterMergedActivityPages(mktoClient, token, activity_type_ids, lead_change_fields, until=until, debug=debug):
+            yield results, None
+        return
+    # activities before since are dropped when token is taken from token index
+    if token is None:
+        token = lookupPagingToken(mktoClient, since, activity_type_ids, token_index)
+        since = formatDate(parseDate(since))
+    else:
+        since = None
+    while True:
+        for raw_data in iterActivityPages(mktoClient, token, activity_type_ids, since, until, debug, token_index):
+            if page_hook is not None:
+                page_hook(raw_data)
+            token = raw_data ['nextPageToken']
+            yield raw_data.get('result', []), token
+
+        if follow_interval is None:
+            return
+        # since is known to be before token only in the first round
+        since = None
+
+        # all activities until now have been fetched. nextPageToken of the last page returns
+        # activities created after it
+        yield None, token
+        time.sleep(follow_interval)
+
+
+# -------
+# Yields (ActivityRecords of a page, next paging token) converted from results
+#
+#    transformer: ActivityTransformer
+#    results: (activities of a page, next paging token) such as iterActivityResults() yields.
+#             activities of None are passed through as records of None
+#    seeder: LeadValueSeeder looking up values of leads before their activities are converted
+#    metrics: ExportMetrics where seconds of seeding and transforming, and rows are counted
+#
+def iterRecordPages(transformer, results, seeder=None, metrics=None):
+    for raw_data_result, next_token in results:
+        if raw_data_result is None:
+            yield None, next_token
+            continue
+        start = time.time()
+        if seeder is not None:
+            seeder.seedActivities(raw_data_result)
+            if metrics is not None:
+                metrics.addTime('seed', time.time() - start)
+                start = time.time()
+        records = transformer.transformPage(raw_data_result)
+        if metrics is not None:
+            metrics.addTime('transform', time.time() - start)
+            metrics.addRows(records)
+        yield records, next_token
+
+
+# -------
+# Loop of a process of PartitionedTransformer
+#
+#    createTransformer: function returning ActivityTransformer of this process
+#    reader: connection where pages of activities are received
+#    writer: connection where rows are sent
+#
+# Each message is a list of activities serialized by marshal, and is answered by (error, rows)
+# with a row (tuple) or None for each activity. An empty message stops the loop.
+#
+def runTransformProcess(createTransformer, reader, writer):
+    transformer = createTransformer()
+    try:
+        while True:
+            data = reader.recv_bytes()
+            if not data:
+                break
+            rows = [tuple(row) if row is not None else None for row in transformer.transformResults(marshal.loads(data))]
+            writer.send_bytes(marshal.dumps((None, rows), 2))
+    except EOFError:
+        pass
+    except Exception:
+        writer.send_bytes(marshal.dumps((traceback.format_exc(), None), 2))
+    finally:
+        transformer.close()
+
+
+# -------
+# Transforming pages of activities by several processes, partitioned by Lead Id
+#
+#    createTransformer: function returning ActivityTransformer, called in each process. it must
+#                       have its own LeadStateStore
+#    processes: number of processes
+#    max_pending: max number of pages sent to processes and not yet yielded
+#
+# Activities of a lead are always sent to the same process, so each process carries forward
+# latest field values of its own leads, just like a single ActivityTransformer. Activities and
+# rows are sent through pipes as one marshal message for each page and process. Pages are sent
+# by a background thread, and rows are put back in order of activities, so rows are the same as
+# iterRecordPages(). Processes are forked when it is created, and stopped by close().
+#
+class PartitionedTransformer:
+    def __init__(self, createTransformer, processes, max_pending=8):
+        self.processes = []
+        self.pending = Queue.Queue(max_pending)
+        self.stopped = threading.Event()
+        self.thread = None
+        for i in range(processes):
+            reader, to_process = multiprocessing.Pipe(False)
+            from_process, writer = multiprocessing.Pipe(False)
+            process = multiprocessing.Process(target=runTransformProcess, args=(createTransformer, reader, writer))
+            process.daemon = True
+            process.start()
+            # ends of the process are used only by the process
+            reader.close()
+            writer.close()
+            self.processes.append((process, to_process, from_process))
+
+    # put item into pending queue without blocking forever after close() is called
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.pending.put(item, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    # send activities of each page to processes, and tell the order of activities by pending queue
+    def _send(self, results):
+        try:
+            count = len(self.processes)
+            for raw_data_result, next_token in results:
+                if self.stopped.is_set():
+                    return
+                if raw_data_result is None:
+                    self._put(('page', None, next_token))
+                    continue
+                partitions = [[] for i in range(count)]
+                order = []
+                for result in raw_data_result:
+                    partition = result ['leadId'] % count
+                    partitions [partition].append(result)
+                    order.append(partition)
+                for (process, to_process, from_process), activities in zip(self.processes, partitions):
+                    to_process.send_bytes(marshal.dumps(activities, 2))
+                self._put(('page', order, next_token))
+            self._put(('done', None, None))
+        except BaseException:
+            self._put(('error', sys.exc_info(), None))
+
+    def _get(self):
+        while True:
+            try:
+                # wait with timeout, so KeyboardInterrupt is not blocked
+                return self.pending.get(True, 0.5)
+            except Queue.Empty:
+                pass
+
+    # same as iterRecordPages(), but rows are tuples. results can be read only once
+    def iterRecordPages(self, results, metrics=None):
+        self.thread = threading.Thread(target=self._send, args=(results,))
+        self.thread.daemon = True
+        self.thread.start()
+        while True:
+            kind, order, next_token = self._get()
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                raise order [0], order [1], order [2]
+            if order is None:
+                yield None, next_token
+                continue
+
+            start = time.time()
+            partitions = []
+            for process, to_process, from_process in self.processes:
+                error, rows = marshal.loads(from_process.recv_bytes())
+                if error is not None:
+                    raise RuntimeError("transform process failed: " + error)
+                partitions.append(iter(rows))
+            records = []
+            for partition in order:
+                row = next(partitions [partition])
+                if row is not None:
+                    records.append(row)
+            if metrics is not None:
+                metrics.addTime('transform', time.time() - start)
+                metrics.addRows(records)
+            yield records, next_token
+
+    # stop processes. they are given a few seconds to finish
+    def close(self):
+        self.stopped.set()
+        for process, to_process, from_process in self.processes:
+            try:
+                to_process.send_bytes('')
+            except (IOError, OSError):
+                pass
+        for process, to_process, from_process in self.processes:
+            process.join(5.0)
+            if process.is_alive():
+                process.terminate()
+            to_process.close()
+            from_process.close()
+        self.processes = []
+
+
+# -------
+# Yields ActivityRecords of activities from since until until, without writing them
+#
+#    mktoClient: MarketoClient
+#    transformer: ActivityTransformer selecting activity types, tracking fields and time zone.
+#                 latest values of tracking fields are carried forward as records are yielded
+#    since, until, workers, shard_by, token, lead_change_fields, token_index, follow_interval:
+#        same as iterActivityResults. with token, such as the one saved by the command line
+#        tool, paging continues from there
+#    seeder: same as iterRecordPages
+#
+# Pages are fetched lazily while records are consumed, and activities are converted one by
+# one, so memory usage does not grow with the number of activities. With follow_interval,
+# it never ends and waits for new activities. Example:
+#
+#    transformer = ActivityTransformer(["Lead Score", "Behavior Score"], True, False, None)
+#    header = transformer.getHeader()
+#    for record in iterActivities(mktoClient, transformer, "2015-04-01", "2015-05-01"):
+#        print record.leadId, record.asDict(header) ["Behavior Score"]
+#
+def iterActivities(mktoClient, transformer, since, until=None, workers=1, shard_by='day', seeder=None, debug=False, lead_change_fields=None,
+                   token=None, token_index=None, follow_interval=None):
+    activity_type_ids = transformer.getActivityTypeIds()
+    for raw_data_result, next_token in iterActivityResults(mktoClient, since, until, activity_type_ids, workers, shard_by, token, debug,
+                                                           lead_change_fields, token_index, follow_interval):
+        if raw_data_result is None:
+            continue
+        if seeder is not None:
+            seeder.seedActivities(raw_data_result)
+        for record in transformer.iterRecords(raw_data_result):
+            yield record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract Lead Activities via Marketo API')
+    parser.add_argument(
+        '-i', '--instance',
+        type = str,
+        dest = 'mkto_instance',
+        required = True,
+        help = 'Marketo REST API Instance URL such as https://123-XYZ-456.mktorest.com'
+	)
+    parser.add_argument(
+        '-d', '--id',
+        type = str,
+        dest = 'mkto_client_id',
+        required = True,
+        help = 'Marketo LaunchPoint Client Id: eg. 3d96eaef-f611-42a0-967f-00aeeee7e0ea'
+	)
+    parser.add_argument(
+        '-s', '--secret',
+        type = str,
+        dest = 'mkto_client_secret',
+        required = True,
+        help = 'Marketo LaunchPoint Client Secret: eg. i8s6RRq1LhPlMyATEKfLWl1255bwzrF'
+	)
+    parser.add_argument(
+        '-l', '--listid',
+        type = str,
+        dest = 'mkto_list_id',
+        required = False,
+        help = 'List Id: eg. 443 (please extract it from URL on Marketo)'
+	)
+    parser.add_argument(
+        '-o', '--output',
+        type = str,
+        dest = 'output_file',
+        required = False,
+        help = 'Output file name'
+	)
+    parser.add_argument(
+        '-c', '--since',
+        type = str,
+        dest = 'mkto_date',
+        required = False,
+        help = 'sinceDate time for calling Get Paging Token: eg. 2015-01-31'
+	)
+    parser.add_argument(
+        '-u', '--until',
+        type = str,
+        dest = 'mkto_until_date',
+        required = False,
+        help = 'Until Date time (exclusive) for stopping export: eg. 2015-02-28'
+	)
+    parser.add_argument(
+        '-g', '--debug',
+        action='store_true',
+        dest = 'debug',
+        default = False,
+        required = False,
+        help = 'Pring debugging information'
+	)
+    parser.add_argument(
+        '-j', '--not-use-jst',
+        action='store_true',
+        dest = 'not_jst',
+        default = False,
+        required = False,
+        help = 'Change TimeZone for Activity Date field. Default is JST.'
+	)
+    parser.add_argument(
+        '-f', '--change-data-fields',
+        type = str,
+        dest = 'change_data_fields',
+        required = False,
+        help = 'Specify comma separated "UI" fields name such as "Behavior Score" for extracting from "Data Value Changed" activities. default fields: "Lead Score"'
+	)
+    parser.add_argument(
+        '-m', '--add-mail-activity',
+        action = 'store_true',
+        dest = 'mail_activity',
+        default = False,
+        required = False,
+        help = 'Adding mail open/click activity. It might be a cause of slowdown.'
+	)
+    parser.add_argument(
+        '-w', '--add-webvisit-activity',
+        action = 'store_true',
+        dest = 'web_activity',
+        default = False,
+        required = False,
+        help = 'Adding Web Visit activity. It might be a cause of slowdown.'
+	)
+    parser.add_argument(
+        '--workers',
+        type = int,
+        dest = 'workers',
+        default = 1,
+        required = False,
+        help = 'Number of time windows fetched at the same time. requires --until. default: 1'
+	)
+    parser.add_argument(
+        '--shard-by',
+        type = str,
+        dest = 'shard_by',
+        choices = ['day', 'week'],
+        default = 'day',
+        required = False,
+        help = 'Size of time windows used by --workers. default: day'
+	)
+    parser.add_argument(
+        '--async',
+        action = 'store_true',
+        dest = 'async_fetch',
+        default = False,
+        required = False,
+        help = 'Fetch time windows of --workers by non-blocking requests on one thread'
+	)
+    parser.add_argument(
+        '--max-calls',
+        type = int,
+        dest = 'max_calls',
+        default = 100,
+        required = False,
+        help = 'Max number of API calls in 20 seconds. default: 100'
+	)
+    parser.add_argument(
+        '--max-concurrent',
+        type = int,
+        dest = 'max_concurrent',
+        default = 10,
+        required = False,
+        help = 'Max number of API calls at the same time. default: 10'
+	)
+    parser.add_argument(
+        '--daily-quota',
+        type = int,
+        dest = 'daily_quota',
+        required = False,
+        help = 'Max number of API calls used by this export. default: unlimited'
+	)
+    parser.add_argument(
+        '--max-retries',
+        type = int,
+        dest = 'max_retries',
+        default = 8,
+        required = False,
+        help = 'Max number of retries of transient errors such as 604, 5xx and timeouts. default: 8'
+	)
+    parser.add_argument(
+        '--timeout',
+        type = float,
+        dest = 'timeout',
+        default = 300,
+        required = False,
+        help = 'Seconds until a request without response is retried. default: 300'
+	)
+    parser.add_argument(
+        '--breaker-threshold',
+        type = int,
+        dest = 'breaker_threshold',
+        default = 5,
+        required = False,
+        help = 'Number of errors in a row which pause all requests. default: 5'
+	)
+    parser.add_argument(
+        '--breaker-cooldown',
+        type = float,
+        dest = 'breaker_cooldown',
+        default = 30,
+        required = False,
+        help = 'Seconds all requests are paused by --breaker-threshold errors. It doubles up to 300 while errors continue. default: 30'
+	)
+    parser.add_argument(
+        '--checkpoint',
+        type = str,
+        dest = 'checkpoint_file',
+        required = False,
+        help = 'Checkpoint file name for resuming export with --resume'
+	)
+    parser.add_argument(
+        '--checkpoint-interval',
+        type = int,
+        dest = 'checkpoint_interval',
+        default = 1000,
+        required = False,
+        help = 'Number of pages between checkpoints. default: 1000'
+	)
+    parser.add_argument(
+        '--checkpoint-seconds',
+        type = float,
+        dest = 'checkpoint_seconds',
+        default = 300,
+        required = False,
+        help = 'Seconds between checkpoints, whichever of --checkpoint-interval comes first. default: 300'
+	)
+    parser.add_argument(
+        '--resume',
+        type = str,
+        dest = 'resume_file',
+        required = False,
+        help = 'Resume export from checkpoint file written by --checkpoint'
+	)
+    parser.add_argument(
+        '--sync-state',
+        type = str,
+        dest = 'sync_state_file',
+        required = False,
+        help = 'State file for incremental sync. Only new activities since the last run are appended to output'
+	)
+    parser.add_argument(
+        '--follow',
+        action = 'store_true',
+        dest = 'follow',
+        default = False,
+        required = False,
+        help = 'Keep polling new activities every --follow-interval seconds'
+	)
+    parser.add_argument(
+        '--follow-interval',
+        type = float,
+        dest = 'follow_interval',
+        default = 300.0,
+        required = False,
+        help = 'Seconds between polling with --follow. default: 300'
+	)
+    parser.add_argument(
+        '--prefetch',
+        type = int,
+        dest = 'prefetch',
+        default = 2,
+        required = False,
+        help = 'Number of pages fetched and transformed ahead of writing. 0 disables it. default: 2'
+	)
+    parser.add_argument(
+        '--transform-processes',
+        type = int,
+        dest = 'transform_processes',
+        default = 1,
+        required = False,
+        help = 'Number of processes transforming activities, partitioned by Lead Id. default: 1'
+	)
+    parser.add_argument(
+        '--bulk',
+        action = 'store_true',
+        dest = 'bulk',
+        default = False,
+        required = False,
+        help = 'Export activities by Bulk Extract jobs instead of paging Get Lead Activities'
+	)
+    parser.add_argument(
+        '--bulk-window-days',
+        type = int,
+        dest = 'bulk_window_days',
+        default = 31,
+        required = False,
+        help = 'Number of days exported by one Bulk Extract job. default: 31'
+	)
+    parser.add_argument(
+        '--bulk-poll-interval',
+        type = float,
+        dest = 'bulk_poll_interval',
+        default = 5.0,
+        required = False,
+        help = 'First interval of polling Bulk Extract job status. default: 5'
+	)
+    parser.add_argument(
+        '--lead-state-memory',
+        type = int,
+        dest = 'lead_state_memory',
+        default = 1024,
+        required = False,
+        help = 'Megabytes of memory for latest field values of leads. More leads are kept in a temporary SQLite file. 0 means unlimited. default: 1024'
+	)
+    parser.add_argument(
+        '--seed-lead-values',
+        action = 'store_true',
+        dest = 'seed_lead_values',
+        default = False,
+        help = 'Fill fields of leads appearing without New Lead activity with their current values, looked up by 300 leads in a call.'
+	)
+    parser.add_argument(
+        '--lead-changes',
+        action = 'store_true',
+        dest = 'lead_changes',
+        default = False,
+        help = 'Fetch Change Data Value activities of --change-data-field fields only, by Get Lead Changes'
+	)
+    parser.add_argument(
+        '--dedup-index',
+        type = str,
+        dest = 'dedup_index_file',
+        required = False,
+        help = 'File of activity ids written so far. Activities in it are not written again, and written activities are added to it'
+	)
+    parser.add_argument(
+        '--sort',
+        action = 'store_true',
+        dest = 'sort',
+        default = False,
+        help = 'Write activities in order of Activity Date and id. Activities beyond --sort-buffer are sorted in temporary files'
+	)
+    parser.add_argument(
+        '--sort-buffer',
+        type = int,
+        dest = 'sort_buffer',
+        default = 100000,
+        required = False,
+        help = 'Number of activities sorted in memory by --sort and each job of --bulk. default: 100000'
+	)
+    parser.add_argument(
+        '--token-index',
+        type = str,
+        dest = 'token_index_file',
+        required = False,
+        help = 'File of paging tokens at the start of each day, added while paging. Exports starting on a day in it skip Get Paging Token'
+	)
+    parser.add_argument(
+        '--archive',
+        type = str,
+        dest = 'archive_dir',
+        required = False,
+        help = 'Directory where raw pages of activities are archived as compressed NDJSON, which can be transformed again by mktoReplayActivities.py'
+	)
+    parser.add_argument(
+        '--archive-compress',
+        type = str,
+        dest = 'archive_compress',
+        choices = ['gzip', 'zstd'],
+        default = 'gzip',
+        required = False,
+        help = 'Compression of --archive. zstd requires zstandard. default: gzip'
+	)
+    parser.add_argument(
+        '--activity-types',
+        type = str,
+        dest = 'activity_type_ids',
+        required = False,
+        help = 'Comma separated ids of other activity types to be exported, such as 2,6. Their primary attribute and attributes are added as columns'
+	)
+    parser.add_argument(
+        '--activity-types-cache',
+        type = str,
+        dest = 'activity_types_cache',
+        default = os.path.join(os.path.expanduser('~'), '.mktoActivityTypes.json'),
+        required = False,
+        help = 'File caching result of Get Activity Types. default: ~/.mktoActivityTypes.json'
+	)
+    parser.add_argument(
+        '--activity-types-ttl',
+        type = int,
+        dest = 'activity_types_ttl',
+        default = 86400,
+        required = False,
+        help = 'Seconds until cached activity types are fetched again. default: 86400'
+	)
+    parser.add_argument(
+        '--tz',
+        type = str,
+        dest = 'timezone',
+        default = 'Asia/Tokyo',
+        required = False,
+        help = 'TimeZone of Activity Date field such as America/New_York. -j keeps UTC. default: Asia/Tokyo'
+	)
+    parser.add_argument(
+        '--columnar',
+        action = 'store_true',
+        dest = 'columnar',
+        default = False,
+        help = 'Convert Activity Date of each page at once with numpy. It requires numpy.'
+	)
+    parser.add_argument(
+        '--format',
+        type = str,
+        dest = 'output_format',
+        choices = ['csv', 'parquet'],
+        default = 'csv',
+        required = False,
+        help = 'Output format. parquet requires pyarrow and --output. default: csv'
+	)
+    parser.add_argument(
+        '--partition-by',
+        type = str,
+        dest = 'partition_by',
+        required = False,
+        help = 'Comma separated date and/or type. Parquet files are written into directories such as activity_date=2015-04-09/activity_type_id=12 under --output'
+	)
+    parser.add_argument(
+        '--row-group-size',
+        type = int,
+        dest = 'row_group_size',
+        default = 100000,
+        required = False,
+        help = 'Number of rows in a Parquet row group. default: 100000'
+	)
+    parser.add_argument(
+        '--compress',
+        type = str,
+        dest = 'compress',
+        choices = ['gzip', 'zstd'],
+        required = False,
+        help = 'Compress csv output on background threads. zstd requires zstandard.'
+	)
+    parser.add_argument(
+        '--rotate-rows',
+        type = int,
+        dest = 'rotate_rows',
+        default = 0,
+        required = False,
+        help = 'Number of rows in a chunk file of csv output. default: unlimited'
+	)
+    parser.add_argument(
+        '--rotate-size',
+        type = int,
+        dest = 'rotate_size',
+        default = 0,
+        required = False,
+        help = 'Megabytes of csv (before compression) in a chunk file. default: unlimited'
+	)
+    parser.add_argument(
+        '--compress-threads',
+        type = int,
+        dest = 'compress_threads',
+        default = 2,
+        required = False,
+        help = 'Number of chunk files compressed at the same time. default: 2'
+	)
+    parser.add_argument(
+        '--fast-json',
+        action = 'store_true',
+        dest = 'fast_json',
+        default = False,
+        help = 'Decode responses with ujson. It requires ujson.'
+	)
+    parser.add_argument(
+        '--debug-sample',
+        type = int,
+        dest = 'debug_sample',
+        default = 1,
+        required = False,
+        help = 'Print every <num>th page of activities with --debug. default: 1'
+	)
+    parser.add_argument(
+        '--stats-interval',
+        type = float,
+        dest = 'stats_interval',
+        default = 0,
+        required = False,
+        help = 'Print a JSON line of requests, latency, waits, stage times and rows/sec to stderr every <sec> and at the end. default: 0 (off)'
+	)
+    parser.add_argument(
+        '--prometheus-file',
+        type = str,
+        dest = 'prometheus_file',
+        required = False,
+        help = 'Write the same metrics as Prometheus textfile every --stats-interval (or 15) seconds and at the end'
+	)
+    parser.add_argument(
+        '--profile',
+        type = str,
+        dest = 'profile_file',
+        required = False,
+        help = 'Profile the run and write the results into <filename>'
+	)
+    parser.add_argument(
+        '--profiler',
+        type = str,
+        dest = 'profiler',
+        choices = ['sample', 'cprofile'],
+        default = 'sample',
+        required = False,
+        help = 'sample: sampling stacks of all threads, written as collapsed stacks. cprofile: cProfile of the main thread, written as pstats. default: sample'
+	)
+
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be 1 or more")
+    if args.async_fetch and args.workers < 2:
+        parser.error("--async requires --workers 2 or more")
+    # each window costs a call of Get Paging Token, so windows until now are not made by default
+    if args.workers > 1 and not args.mkto_until_date:
+        parser.error("--workers requires --until")
+    if args.max_calls < 1 or args.max_concurrent < 1:
+        parser.error("--max-calls and --max-concurrent must be 1 or more")
+    if args.prefetch < 0:
+        parser.error("--prefetch must be 0 or more")
+    if args.transform_processes < 1:
+        parser.error("--transform-processes must be 1 or more")
+
+    # checkpoint is written into --checkpoint, or overwriting --resume/--sync-state file
+    checkpoint_file = args.checkpoint_file or args.resume_file or args.sync_state_file
+    if checkpoint_file:
+        if not args.output_file:
+            parser.error("--checkpoint, --resume and --sync-state require --output")
+        if args.workers > 1:
+            parser.error("--checkpoint, --resume and --sync-state can not be used with --workers")
+        if args.checkpoint_interval < 1:
+            parser.error("--checkpoint-interval must be 1 or more")
+        if args.checkpoint_seconds <= 0:
+            parser.error("--checkpoint-seconds must be more than 0")
+    if args.sync_state_file or args.follow:
+        if args.mkto_until_date:
+            parser.error("--sync-state and --follow can not be used with --until")
+        if args.workers > 1:
+            parser.error("--follow can not be used with --workers")
+
+    if args.lead_state_memory < 0:
+        parser.error("--lead-state-memory must be 0 or more")
+    try:
+        pytz.timezone(args.timezone)
+    except pytz.UnknownTimeZoneError:
+        parser.error("unknown timezone " + args.timezone)
+    if args.columnar and numpy is None:
+        parser.error("--columnar requires numpy")
+    if args.output_format == 'parquet':
+        if pyarrow is None:
+            parser.error("--format parquet requires pyarrow")
+        if not args.output_file:
+            parser.error("--format parquet requires --output")
+        if checkpoint_file or args.follow:
+            parser.error("--format parquet can not be used with --checkpoint, --resume, --sync-state and --follow")
+        if args.row_group_size < 1:
+            parser.error("--row-group-size must be 1 or more")
+        if args.partition_by:
+            for partition in args.partition_by.split(','):
+                if partition not in ('date', 'type'):
+                    parser.error("--partition-by must be date and/or type")
+    elif args.partition_by:
+        parser.error("--partition-by requires --format parquet")
+    if args.fast_json and ujson is None:
+        parser.error("--fast-json requires ujson")
+    if args.debug_sample < 1:
+        parser.error("--debug-sample must be 1 or more")
+    if args.stats_interval < 0:
+        parser.error("--stats-interval must be 0 or more")
+    if args.max_retries < 0 or args.breaker_threshold < 1:
+        parser.error("--max-retries must be 0 or more, and --breaker-threshold must be 1 or more")
+    if args.compress or args.rotate_rows or args.rotate_size:
+        if args.output_format != 'csv':
+            parser.error("--compress, --rotate-rows and --rotate-size can be used only with csv")
+        if not args.output_file:
+            parser.error("--compress, --rotate-rows and --rotate-size require --output")
+        if checkpoint_file or args.follow:
+            parser.error("--compress, --rotate-rows and --rotate-size can not be used with --checkpoint, --resume, --sync-state and --follow")
+        if args.compress == 'zstd' and zstandard is None:
+            parser.error("--compress zstd requires zstandard")
+        if args.rotate_rows < 0 or args.rotate_size < 0 or args.compress_threads < 1:
+            parser.error("--rotate-rows and --rotate-size must be 0 or more, and --compress-threads must be 1 or more")
+    other_type_ids = []
+    if args.activity_type_ids:
+        try:
+            other_type_ids = [int(id) for id in args.activity_type_ids.split(',')]
+        except ValueError:
+            parser.error("--activity-types must be comma separated activity type ids")
+
+    if args.bulk:
+        if checkpoint_file or args.follow:
+            parser.error("--bulk can not be used with --checkpoint, --resume, --sync-state and --follow")
+        if args.workers > 1:
+            parser.error("--bulk can not be used with --workers")
+        if args.mkto_list_id:
+            parser.error("--bulk can not be used with --listid")
+        if args.bulk_window_days < 1 or args.bulk_window_days > 31:
+            parser.error("--bulk-window-days must be between 1 and 31")
+    if args.lead_changes:
+        if checkpoint_file or args.follow:
+            parser.error("--lead-changes can not be used with --checkpoint, --resume, --sync-state and --follow")
+        if args.bulk or args.async_fetch:
+            parser.error("--lead-changes can not be used with --bulk and --async")
+    if args.sort:
+        if checkpoint_file or args.follow:
+            parser.error("--sort can not be used with --checkpoint, --resume, --sync-state and --follow")
+    if args.sort_buffer < 1:
+        parser.error("--sort-buffer must be 1 or more")
+
+    if args.archive_dir:
+        if checkpoint_file or args.follow:
+            parser.error("--archive can not be used with --checkpoint, --resume, --sync-state and --follow")
+        if args.lead_changes:
+            parser.error("--archive can not be used with --lead-changes")
+        if args.archive_compress == 'zstd' and zstandard is None:
+            parser.error("--archive-compress zstd requires zstandard")
+        if os.path.exists(os.path.join(args.archive_dir, PageArchive.manifest_name)):
+            parser.error(args.archive_dir + " has an archive already")
+
+    if args.transform_processes > 1:
+        if checkpoint_file or args.follow:
+            parser.error("--transform-processes can not be used with --checkpoint, --resume, --sync-state and --follow")
+        if args.seed_lead_values:
+            parser.error("--transform-processes can not be used with --seed-lead-values")
+
+    # paging tokens of days seen by this and earlier runs
+    token_index = None
+    if args.token_index_file:
+        if args.bulk or args.lead_changes:
+            parser.error("--token-index can not be used with --bulk and --lead-changes")
+        try:
+            token_index = PagingTokenIndex(args.token_index_file, args.mkto_instance, args.mkto_list_id)
+        except (IOError, ValueError), e:
+            parser.error("can not load --token-index: " + str(e))
+
+    # activity ids written by this and earlier runs
+    dedup_index = None
+    if args.dedup_index_file:
+        try:
+            dedup_index = ActivityIdIndex(args.dedup_index_file)
+        except (IOError, ValueError, struct.error), e:
+            parser.error("can not load --dedup-index: " + str(e))
+
+    # incremental sync continues from the state of the last run, which is a checkpoint
+    # written at the end of the run
+    checkpoint = None
+    if args.resume_file:
+        checkpoint = loadCheckpoint(args.resume_file)
+    elif args.sync_state_file and os.path.exists(args.sync_state_file):
+        checkpoint = loadCheckpoint(args.sync_state_file)
+    elif not args.mkto_date:
+        parser.error("-c/--since is required")
+
+    # profile the whole run. results are written when the process exits, also by errors
+    if args.profile_file:
+        if args.profiler == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            def writeProfile():
+                profiler.disable()
+                profiler.dump_stats(args.profile_file)
+                print >> sys.stderr, "Profile of the main thread is written into " + args.profile_file
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+        else:
+            profiler = SamplingProfiler()
+            profiler.start()
+            def writeProfile():
+                profiler.stop()
+                profiler.writeCollapsed(args.profile_file)
+                print >> sys.stderr, "Profile of " + str(profiler.samples) + " samples is written into " + args.profile_file
+                # percentage of samples of all threads. waiting threads are included
+                print >> sys.stderr, "%8s %8s  %s" % ('Self', 'Total', 'Function')
+                thread_samples = float(max(profiler.thread_samples, 1))
+                for function, own_samples, total_samples in profiler.getTopFunctions():
+                    print >> sys.stderr, "%7.1f%% %7.1f%%  %s" % (100 * own_samples / thread_samples, 100 * total_samples / thread_samples, function)
+        atexit.register(writeProfile)
+
+    # requests, waits, stage times and rows, reported by --stats-interval and --prometheus-file
+    metrics = ExportMetrics()
+    if args.stats_interval or args.prometheus_file:
+        reporter = MetricsReporter(metrics, args.stats_interval or 15, sys.stderr if args.stats_interval else None, args.prometheus_file)
+        reporter.start()
+        atexit.register(reporter.close)
+
+    #
+    # initiate Marketo ReST API
+    rate_limiter = RateLimiter(args.max_calls, 20.0, args.max_concurrent, args.daily_quota)
+    # workers, and threads of prefetch, lead seeding and token refresh
+    transport = HttpTransport(args.workers + 3, args.timeout)
+    json_decoder = None
+    if args.fast_json:
+        json_decoder = ujson.loads
+    retry_policy = RetryPolicy(max_retries=args.max_retries)
+    circuit_breaker = CircuitBreaker(args.breaker_threshold, args.breaker_cooldown)
+    try:
+        mktoClient = MarketoClient(args.mkto_instance, 'client_credentials', args.mkto_client_id, args.mkto_client_secret, args.mkto_list_id, rate_limiter, transport, json_decoder,
+                                   retry_policy, circuit_breaker, metrics)
+    except MarketoError, e:
+        print >> sys.stderr, "Error:"
+        print >> sys.stderr, "REST API Error Code: ", e.code
+        print >> sys.stderr, "Message: ", e.message
+        sys.exit(1)
+
+    # enable debug information
+    if args.debug:
+        mktoClient.enableDebug(args.debug_sample)
+
+    # metadata of activity types given by --activity-types
+    activity_types = None
+    if other_type_ids:
+        try:
+            types_by_id = dict((activity_type ['id'], activity_type) for activity_type in loadActivityTypes(mktoClient, args.activity_types_cache, args.activity_types_ttl))
+        except MarketoError, e:
+            print >> sys.stderr, "Error:"
+            print >> sys.stderr, "REST API Error Code: ", e.code
+            print >> sys.stderr, "Message: ", e.message
+            mktoClient.close()
+            sys.exit(1)
+        activity_types = []
+        for activityTypeId in other_type_ids:
+            if not types_by_id.has_key(activityTypeId):
+                mktoClient.close()
+                parser.error("activity type " + str(activityTypeId) + " is not found by Get Activity Types")
+            activity_types.append(types_by_id [activityTypeId])
+
+    # initiate file handler, selecting file output or stdout according to command arguments
+    chunked_output = args.compress or args.rotate_rows or args.rotate_size
+    if args.output_format == 'parquet' or chunked_output:
+        fh = None
+    elif args.output_file:
+        if checkpoint:
+            # drop rows written after the checkpoint
+            fh = open(args.output_file, 'r+')
+            fh.seek(checkpoint ['output_offset'])
+            fh.truncate()
+        else:
+            fh = open(args.output_file, 'w')
+    else:
+        fh = sys.stdout
+
+
+    tracking_fields = ["Lead Score"]
+
+    if args.change_data_fields:
+        change_data_fields =  args.change_data_fields.split(",")
+        for field in change_data_fields:
+            tracking_fields.append(field)
+
+    lead_state_store = LeadStateStore(tracking_fields, args.lead_state_memory * 1024 * 1024)
+    # output sink selected by --format
+    if args.output_format == 'parquet':
+        partition_by = []
+        if args.partition_by:
+            partition_by = args.partition_by.split(',')
+        mywriter = ParquetSink(args.output_file, partition_by, args.row_group_size)
+    elif chunked_output:
+        mywriter = ChunkedCsvSink(args.output_file, args.compress, args.rotate_rows, args.rotate_size * 1024 * 1024, args.compress_threads)
+    else:
+        mywriter = CsvSink(fh)
+
+    timezone = None
+    if not args.not_jst:
+        timezone = pytz.timezone(args.timezone)
+    transformer = ActivityTransformer(tracking_fields, args.mail_activity, args.web_activity, timezone, lead_state_store, activity_types, args.columnar,
+                                      args.output_format != 'csv')
+    default_activity_id = transformer.getActivityTypeIds()
+
+    # checkpoint can be resumed only with the same settings
+    settings = {'instance': args.mkto_instance,
+                'list_id': args.mkto_list_id,
+                'activity_type_ids': default_activity_id,
+                'header': transformer.getHeader(),
+                'not_jst': args.not_jst,
+                'until': args.mkto_until_date}
+    # only added when they are used, so checkpoints written without them can be resumed
+    if args.seed_lead_values:
+        settings ['seed_lead_values'] = True
+    if args.timezone != 'Asia/Tokyo':
+        settings ['timezone'] = args.timezone
+    if checkpoint:
+        if json.dumps(checkpoint ['settings'], sort_keys=True) != json.dumps(settings, sort_keys=True):
+            parser.error("settings are different from checkpoint " + checkpoint_file)
+    # lead state is saved into log of changes next to the checkpoint
+    lead_state_log = None
+    if checkpoint_file:
+        lead_state_log = LeadStateLog(checkpoint_file, lead_state_store)
+    if checkpoint:
+        if checkpoint.has_key('lead_state_file'):
+            lead_state_log.load(checkpoint ['lead_state_file'], checkpoint ['lead_state_size'])
+        else:
+            # checkpoint of earlier versions has a snapshot of all the leads
+            transformer.setLeadState(checkpoint ['last_custom_fields'])
+    else:
+        if lead_state_log is not None:
+            lead_state_log.removeAllLogs()
+        # write header to fh
+        mywriter.writeHeader(transformer.getHeader())
+
+
+    # processes transforming activities with lead state of their own leads
+    partitioned_transformer = None
+    if args.transform_processes > 1:
+        def createPartitionTransformer():
+            return ActivityTransformer(tracking_fields, args.mail_activity, args.web_activity, timezone,
+                                       LeadStateStore(tracking_fields, args.lead_state_memory * 1024 * 1024 / args.transform_processes),
+                                       activity_types, args.columnar, args.output_format != 'csv')
+        # buffered output must not be written again by forked processes
+        if fh is not None:
+            fh.flush()
+        partitioned_transformer = PartitionedTransformer(createPartitionTransformer, args.transform_processes)
+
+    # raw pages are archived with metadata needed to transform them again
+    archive = None
+    if args.archive_dir:
+        archive = PageArchive(args.archive_dir, {'instance': args.mkto_instance,
+                                                 'list_id': args.mkto_list_id,
+                                                 'since': args.mkto_date,
+                                                 'until': args.mkto_until_date,
+                                                 'activity_type_ids': default_activity_id,
+                                                 'activity_types': activity_types or []},
+                              args.archive_compress)
+
+    # looking up current values of leads, created in try block below
+    seeder = None
+    async_fetcher = None
+    # {REST API field name: 'UI' field name} fetched by Get Lead Changes with --lead-changes
+    lead_change_fields = None
+    # threads of pipeline, stopped when writing fails. the first one is the transform stage
+    background_iterators = []
+
+    # write checkpoint of pages written so far. page_token is the next page to be fetched.
+    # lead_state must be the one taken by lead_state_log just after the last written page was transformed
+    page_token = None
+    in_page = False
+    def writeCheckpoint(lead_state):
+        if page_token is None:
+            return
+        fh.flush()
+        os.fsync(fh.fileno())
+        checkpoint_data = {'token': page_token,
+                           'output_offset': fh.tell(),
+                           'settings': settings}
+        checkpoint_data.update(lead_state)
+        saveCheckpoint(checkpoint_file, checkpoint_data)
+        lead_state_log.removeOldLogs(lead_state)
+        # saved after the checkpoint, so the index never has rows removed by --resume
+        if dedup_index is not None:
+            dedup_index.save()
+
+    # with checkpoint, dedup index is saved only by writeCheckpoint. paging tokens are valid
+    # whether their rows are written or not, so token index is saved also after errors
+    def saveIndexes():
+        if dedup_index is not None and not checkpoint_file:
+            dedup_index.save()
+        if token_index is not None:
+            token_index.save()
+
+    # number of pages transformed and written. transformer may run ahead of writing
+    page_counts = {'transformed': 0, 'written': 0}
+    # pages transformed and time at the last lead state taken for checkpoint
+    last_lead_state = {'pages': 0, 'time': time.time()}
+
+    def takeLeadState():
+        last_lead_state ['pages'] = page_counts ['transformed']
+        last_lead_state ['time'] = time.time()
+        return lead_state_log.take()
+
+    # transform stage: convert pages of (activities, next token) into (csv rows, next token, lead state).
+    # lead state is taken only for pages which should be checkpointed
+    def iterTransformedPages(results):
+        if partitioned_transformer is not None:
+            pages = partitioned_transformer.iterRecordPages(results, metrics)
+        else:
+            pages = iterRecordPages(transformer, results, seeder, metrics)
+        for csv_rows, next_token in pages:
+            if csv_rows is None:
+                # all activities have been fetched until now with --follow
+                page_counts ['transformed'] += 1
+                lead_state = None
+                if checkpoint_file:
+                    lead_state = takeLeadState()
+                yield [], next_token, lead_state
                 continue
 
-    if fh is not sys.stdout:
-        fh.close()
+            page_counts ['transformed'] += 1
+
+            lead_state = None
+            if checkpoint_file and (page_counts ['transformed'] - last_lead_state ['pages'] >= args.checkpoint_interval or
+                                    time.time() - last_lead_state ['time'] >= args.checkpoint_seconds):
+                lead_state = takeLeadState()
+            yield csv_rows, next_token, lead_state
+
+    # stop threads of pipeline. fetching is stopped first, so the transform stage does not wait for
+    # the next page, and it is not running after this unless it is stuck in a page
+    def closeBackgroundIterators():
+        for background_iterator in reversed(background_iterators):
+            background_iterator.close()
+
+    # checkpoint can be written after errors only if written pages are all pages transformed.
+    # the transform stage must have been stopped, or it may be changing lead state of the next page
+    def canWriteCheckpoint():
+        if background_iterators and background_iterators [0].isRunning():
+            return False
+        return checkpoint_file and not in_page and page_counts ['transformed'] == page_counts ['written']
+
+    try:
+        if args.seed_lead_values or args.lead_changes:
+            lead_api_fields = getLeadApiFields(mktoClient, tracking_fields)
+            missing_fields = [field for field in tracking_fields if not lead_api_fields.has_key(field)]
+        if args.seed_lead_values:
+            for field in missing_fields:
+                print >> sys.stderr, "Field '" + field + "' is not found by Describe Lead, so it is not seeded."
+            seeder = LeadValueSeeder(mktoClient, lead_state_store, lead_api_fields)
+        if args.lead_changes:
+            if missing_fields:
+                print >> sys.stderr, "Error:"
+                print >> sys.stderr, "Field '" + missing_fields [0] + "' is not found by Describe Lead, so it can not be fetched by Get Lead Changes."
+                mywriter.close()
+                transformer.close()
+                mktoClient.close()
+                sys.exit(1)
+            lead_change_fields = dict((api_name, field) for field, api_name in lead_api_fields.iteritems())
+
+        if args.bulk:
+            # bulk mode: split since .. until into windows of export jobs
+            since = parseDate(args.mkto_date)
+            if args.mkto_until_date:
+                until = parseDate(args.mkto_until_date)
+            else:
+                until = datetime.utcnow() + timedelta(seconds=1)
+            windows = splitTimeWindows(since, until, timedelta(days=args.bulk_window_days))
+            bulk_pages = iterBulkActivityPages(mktoClient, windows, default_activity_id, poll_interval=args.bulk_poll_interval, debug=args.debug,
+                                               sort_buffer=args.sort_buffer)
+            results = ((raw_data_result, None) for raw_data_result in bulk_pages)
+        elif args.async_fetch:
+            # windows of --workers are fetched by non-blocking requests on one thread
+            windows = splitTimeWindows(parseDate(args.mkto_date), parseDate(args.mkto_until_date), args.shard_by)
+            def createAsyncClient(loop):
+                return AsyncMarketoClient(loop, args.mkto_instance, 'client_credentials', args.mkto_client_id, args.mkto_client_secret, args.mkto_list_id,
+                                          rate_limiter, AsyncConnectionPool(loop, args.workers, args.timeout), json_decoder, retry_policy, circuit_breaker, metrics)
+            async_fetcher = AsyncActivityFetcher(createAsyncClient, windows, default_activity_id, args.workers, token_index=token_index)
+            results = ((raw_data_result, None) for raw_data_result in async_fetcher.iterResults())
+        else:
+            # sequential paging from --since or the checkpoint, time windows of --workers, or pages
+            # merged with Get Lead Changes. the next paging token is None unless it is sequential
+            token = None
+            if checkpoint:
+                token = str(checkpoint ['token'])
+
+            def checkActivities(raw_data):
+                #check if there is result field
+                if raw_data.has_key('result') == False and raw_data ['moreResult'] != True:
+                    print >> sys.stderr, "Error:"
+                    print >> sys.stderr, "There is no specific activities."
+                    mywriter.close()
+                    mktoClient.close()
+                    sys.exit(1)
+            page_hook = None
+            if not checkpoint and not args.follow:
+                page_hook = checkActivities
+
+            follow_interval = None
+            if args.follow:
+                follow_interval = args.follow_interval
+            results = iterActivityResults(mktoClient, args.mkto_date, args.mkto_until_date, default_activity_id, args.workers, args.shard_by, token,
+                                          args.debug, lead_change_fields, token_index, follow_interval, page_hook)
+
+        if archive is not None:
+            results = iterArchivedResults(results, archive)
+        if args.sort:
+            results = iterSortedActivityResults(results, ActivitySorter(args.sort_buffer))
+
+        # fetcher, transformer and writer (this thread) work at the same time.
+        # they are joined by bounded queues, so fetching can not run ahead too much
+        if args.prefetch > 0:
+            results = BackgroundIterator(results, args.prefetch)
+            transformed_pages = BackgroundIterator(iterTransformedPages(results), args.prefetch)
+            background_iterators.extend([transformed_pages, results])
+        else:
+            transformed_pages = iterTransformedPages(results)
+
+        for csv_rows, next_token, lead_state in transformed_pages:
+            # write rows into csv
+            in_page = True
+            write_start = time.time()
+            if dedup_index is not None:
+                csv_rows = dedup_index.filterRows(csv_rows)
+            mywriter.writeRows(csv_rows)
+            metrics.addTime('write', time.time() - write_start)
+            in_page = False
+
+            # next page to be fetched when we resume
+            page_token = next_token
+            page_counts ['written'] += 1
+            if lead_state is not None:
+                writeCheckpoint(lead_state)
+            elif args.follow:
+                mywriter.flush()
+
+        if checkpoint_file:
+            writeCheckpoint(takeLeadState())
+
+    except MarketoError, e:
+        closeBackgroundIterators()
+        if canWriteCheckpoint():
+            writeCheckpoint(takeLeadState())
+        saveIndexes()
+        print >> sys.stderr, "Error:"
+        print >> sys.stderr, "REST API Error Code: ", e.code
+        print >> sys.stderr, "Message: ", e.message
+        if mktoClient.retry_policy.classify(e.code) == 'quota':
+            print >> sys.stderr, "Daily quota has been used up. Resume the export after the quota is reset."
+        if mktoClient.getRetryStats():
+            print >> sys.stderr, "Retries: ", json.dumps(mktoClient.getRetryStats(), sort_keys=True)
+        if async_fetcher is not None and async_fetcher.getRetryStats():
+            print >> sys.stderr, "Async Retries: ", json.dumps(async_fetcher.getRetryStats(), sort_keys=True)
+        if archive is not None:
+            archive.close(False)
+        if partitioned_transformer is not None:
+            partitioned_transformer.close()
+        mywriter.close()
+        transformer.close()
+        if lead_state_log is not None:
+            lead_state_log.close()
+        mktoClient.close()
+        sys.exit(1)
+    except (KeyboardInterrupt, Exception):
+        # network errors and so on. save progress, so we can resume it later
+        closeBackgroundIterators()
+        if canWriteCheckpoint():
+            writeCheckpoint(takeLeadState())
+        saveIndexes()
+        if archive is not None:
+            archive.close(False)
+        if partitioned_transformer is not None:
+            partitioned_transformer.close()
+        transformer.close()
+        if lead_state_log is not None:
+            lead_state_log.close()
+        mktoClient.close()
+        raise
+
+    mywriter.close()
+    transformer.close()
+    if lead_state_log is not None:
+        lead_state_log.close()
+    if partitioned_transformer is not None:
+        partitioned_transformer.close()
+    saveIndexes()
+    if archive is not None:
+        archive.close()
+
+    mktoClient.close()
+    if args.debug:
+        print >> sys.stderr, "Access Token: ", json.dumps(mktoClient.getTokenStats())
+        print >> sys.stderr, "Retries: ", json.dumps(mktoClient.getRetryStats(), sort_keys=True)
+        if async_fetcher is not None:
+            print >> sys.stderr, "Async Retries: ", json.dumps(async_fetcher.getRetryStats(), sort_keys=True)
+        print >> sys.stderr, "Lead State: spilled into SQLite " + str(lead_state_store.spills) + " times"
+        if seeder is not None:
+            print >> sys.stderr, "Seeded Leads: " + str(seeder.seeded) + " leads by " + str(seeder.calls) + " calls"
+        if token_index is not None:
+            print >> sys.stderr, "Token Index: " + str(len(token_index)) + " days, " + str(token_index.hits) + " paging tokens found"
+        if dedup_index is not None:
+            print >> sys.stderr, "Dedup Index: " + str(len(dedup_index)) + " activities, " + str(dedup_index.duplicates) + " duplicates skipped"
 
     # testing methods
     # mktoClient.updateAccessToken()
@@ -696,6 +5215,3 @@ if __name__ == "__main__":
     # mktoClient.getLeadsRaw("id", "101095", "id")
     # raw_data = mktoClient.getActivityTypesRaw()
     # print >> sys.stderr, "Activity Types: " + json.dumps(raw_data, indent=4)
-
-
-
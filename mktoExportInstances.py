@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+mktoExportInstances.py: Exporting activities of several Marketo instances on a shared worker pool
+Usage: mktoExportInstances.py <options>
+
+Options:
+  -h                                this help
+  -c --config <filename>            JSON file listing instances to be exported
+  --workers <num>                   Number of time windows fetched at the same time by all instances. default: "workers" of config or 4
+  --summary <filename>              Write results of each instance as JSON, with requests, latency and time of each stage
+  -g --debug                        Pring debugging information
+
+Config:
+  {
+    "workers": 8,
+    "defaults": {"since": "2015-04-01", "until": "2016-01-01", "fields": "Behavior Score", "mail_activity": true},
+    "instances": [
+      {"name": "jp", "instance": "https://123-ABC-456.mktorest.com", "client_id": "...", "client_secret": "..."},
+      {"name": "us", "instance": "https://789-DEF-012.mktorest.com", "client_id": "...", "client_secret": "...",
+       "since": "2016-01-01", "until": "2016-07-01", "tz": "America/New_York", "output": "us.csv.gz", "compress": "gzip"}
+    ]
+  }
+
+  Keys of each instance (keys missing in an instance are taken from "defaults"):
+    name                 name of the instance used in summary. required
+    instance             Marketo Instance URL. required
+    client_id            Marketo LaunchPoint Client Id. required
+    client_secret        Marketo LaunchPoint Client Secret. required
+    since                Since Date time such as 2015-04-01. required
+    until                Until Date time (exclusive). required
+    fields               Comma separated 'UI' fields name or list of them, same as -f of mktoExportActivities.py
+    mail_activity        Adding mail open/click activity. default: false
+    web_activity         Adding Web Visit/Web Click Link activity. default: false
+    list_id              ListId to filter leads
+    lead_changes         Fetch Change Data Value activities of fields only, by Get Lead Changes. default: false
+    tz                   TimeZone of Activity Date field. null keeps UTC. default: Asia/Tokyo
+    shard_by             Size of time windows, day or week. default: day
+    max_calls            Max number of API calls of the instance in 20 seconds. default: 100
+    max_concurrent       Max number of API calls of the instance at the same time. default: 10
+    daily_quota          Max number of API calls used by the export of the instance. default: unlimited
+    lead_state_memory    Megabytes of memory for latest field values of leads. default: 1024
+    output               Output filename. default: <name>.csv
+    compress             Compress output with gzip or zstd
+
+Each instance has its own client and rate limiter, so limits of Marketo are kept for each
+instance. Time windows of all instances are fetched by one pool of --workers threads, and a
+free worker takes the next window of the instance with the fewest windows being fetched, so a
+large instance can not starve the others. Output of each instance is the same as
+mktoExportActivities.py with --workers.
+
+Example:
+  python mktoExportInstances.py -c instances.json --workers 8 --summary summary.json
+"""
+
+import sys, os
+import argparse
+import json
+import threading
+import time
+import pytz
+
+import mktoExportActivities as mkto
+
+
+# default values of keys of instances
+INSTANCE_DEFAULTS = {'fields': '',
+                     'mail_activity': False,
+                     'web_activity': False,
+                     'list_id': None,
+                     'lead_changes': False,
+                     'tz': 'Asia/Tokyo',
+                     'shard_by': 'day',
+                     'max_calls': 100,
+                     'max_concurrent': 10,
+                     'daily_quota': None,
+                     'lead_state_memory': 1024,
+                     'output': None,
+                     'compress': None}
+# until is required, because each time window until now would cost a call of Get Paging Token
+REQUIRED_KEYS = ('name', 'instance', 'client_id', 'client_secret', 'since', 'until')
+
+
+# -------
+# Return list of settings of instances in config file. ValueError is raised if it is invalid
+#
+#    path: JSON config file
+#
+def loadConfig(path):
+    with open(path, 'r') as f:
+        config = json.load(f)
+    defaults = config.get('defaults', {})
+    instances = []
+    names = set()
+    for entry in config.get('instances', []):
+        settings = dict(INSTANCE_DEFAULTS)
+        settings.update(defaults)
+        settings.update(entry)
+        for key in settings:
+            if key not in INSTANCE_DEFAULTS and key not in REQUIRED_KEYS:
+                raise ValueError("unknown key '" + key + "' in " + path)
+        for key in REQUIRED_KEYS:
+            if not settings.get(key):
+                raise ValueError("'" + key + "' is required for each instance in " + path)
+        if settings ['name'] in names:
+            raise ValueError("instance name '" + settings ['name'] + "' is not unique in " + path)
+        names.add(settings ['name'])
+        if settings ['shard_by'] not in ('day', 'week'):
+            raise ValueError("shard_by of " + settings ['name'] + " must be day or week")
+        if settings ['compress'] not in (None, 'gzip', 'zstd'):
+            raise ValueError("compress of " + settings ['name'] + " must be gzip or zstd")
+        if settings ['tz']:
+            pytz.timezone(settings ['tz'])
+        mkto.parseDate(settings ['since'])
+        mkto.parseDate(settings ['until'])
+        if not settings ['output']:
+            settings ['output'] = settings ['name'] + '.csv'
+        instances.append(settings)
+    if not instances:
+        raise ValueError("no instances in " + path)
+    return config.get('workers'), instances
+
+
+# -------
+# Export of an instance, running in its own thread
+#
+#    settings: settings of the instance returned by loadConfig
+#    pool: FairWorkerPool fetching time windows of all instances
+#    debug: print debugging information
+#
+# Pages are fetched by pool, and transformed and written by the thread of this export.
+# Results are returned by getSummary() after join().
+#
+class InstanceExport:
+    def __init__(self, settings, pool, debug=False):
+        self.settings = settings
+        self.pool = pool
+        self.debug = debug
+
+        self.status = 'waiting'
+        self.error = None
+        self.rows = 0
+        self.pages = 0
+        self.started_at = None
+        self.finished_at = None
+        self.mktoClient = None
+        self.metrics = mkto.ExportMetrics()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def join(self):
+        while self.thread.is_alive():
+            self.thread.join(0.5)
+
+    def run(self):
+        settings = self.settings
+        self.started_at = time.time()
+        self.status = 'running'
+        sink = None
+        transformer = None
+        try:
+            rate_limiter = mkto.RateLimiter(settings ['max_calls'], 20.0, settings ['max_concurrent'], settings ['daily_quota'])
+            # requests of this instance are sent by workers of pool
+            transport = mkto.HttpTransport(len(self.pool.threads) + 1)
+            self.mktoClient = mkto.MarketoClient(settings ['instance'], 'client_credentials', settings ['client_id'], settings ['client_secret'],
+                                                 settings ['list_id'], rate_limiter, transport, metrics=self.metrics)
+            if self.debug:
+                self.mktoClient.enableDebug()
+
+            tracking_fields = ["Lead Score"]
+            fields = settings ['fields']
+            if isinstance(fields, basestring):
+                fields = [field for field in fields.split(',') if field]
+            tracking_fields.extend(fields)
+            timezone = None
+            if settings ['tz']:
+                timezone = pytz.timezone(settings ['tz'])
+            lead_state = mkto.LeadStateStore(tracking_fields, settings ['lead_state_memory'] * 1024 * 1024 or None)
+            transformer = mkto.ActivityTransformer(tracking_fields, settings ['mail_activity'], settings ['web_activity'], timezone, lead_state)
+
+            if settings ['compress']:
+                sink = mkto.ChunkedCsvSink(settings ['output'], settings ['compress'])
+            else:
+                sink = mkto.CsvSink(open(settings ['output'], 'wb'))
+            sink.writeHeader(transformer.getHeader())
+
+            windows = mkto.splitTimeWindows(mkto.parseDate(settings ['since']), mkto.parseDate(settings ['until']), settings ['shard_by'])
+            lead_change_fields = None
+            if settings ['lead_changes']:
+                lead_api_fields = mkto.getLeadApiFields(self.mktoClient, tracking_fields)
+                for field in tracking_fields:
+                    if not lead_api_fields.has_key(field):
+                        raise ValueError("field '" + field + "' is not found by Describe Lead")
+                lead_change_fields = dict((api_name, field) for field, api_name in lead_api_fields.iteritems())
+            fetcher = mkto.ShardedActivityFetcher(self.mktoClient, windows, transformer.getActivityTypeIds(), None, debug=self.debug, pool=self.pool,
+                                                  lead_change_fields=lead_change_fields)
+            for rows, next_token in mkto.iterRecordPages(transformer, ((results, None) for results in fetcher.iterResults()), metrics=self.metrics):
+                write_start = time.time()
+                sink.writeRows(rows)
+                self.metrics.addTime('write', time.time() - write_start)
+                self.rows += len(rows)
+                self.pages += 1
+            self.status = 'completed'
+        except mkto.MarketoError, e:
+            self.status = 'failed'
+            self.error = 'REST API Error Code: ' + str(e.code) + ': ' + e.message
+        except Exception, e:
+            self.status = 'failed'
+            self.error = e.__class__.__name__ + ': ' + str(e)
+        finally:
+            if sink is not None:
+                sink.close()
+            if transformer is not None:
+                transformer.close()
+            if self.mktoClient is not None:
+                self.mktoClient.close()
+            self.finished_at = time.time()
+
+    def getSummary(self):
+        seconds = (self.finished_at or time.time()) - (self.started_at or time.time())
+        summary = {'name': self.settings ['name'],
+                   'instance': self.settings ['instance'],
+                   'output': self.settings ['output'],
+                   'status': self.status,
+                   'rows': self.rows,
+                   'pages': self.pages,
+                   'seconds': seconds,
+                   'rows_per_sec': self.rows / seconds if seconds > 0 else 0.0,
+                   'requests': 0,
+                   'retries': {},
+                   'metrics': self.metrics.getSnapshot()}
+        if self.mktoClient is not None:
+            summary ['requests'] = self.mktoClient.rate_limiter.calls
+            summary ['retries'] = self.mktoClient.getRetryStats()
+        if self.error:
+            summary ['error'] = self.error
+        return summary
+
+
+def printSummary(summaries, elapsed):
+    print "%-16s %-10s %10s %8s %9s %10s" % ('Instance', 'Status', 'Rows', 'Requests', 'Seconds', 'Rows/sec')
+    for summary in summaries:
+        print "%-16s %-10s %10d %8d %9.1f %10.1f" % (summary ['name'] [:16], summary ['status'], summary ['rows'], summary ['requests'],
+                                                     summary ['seconds'], summary ['rows_per_sec'])
+        if summary.has_key('error'):
+            print "  " + summary ['error']
+    print "Total: %d rows of %d instances in %.1f sec" % (sum(summary ['rows'] for summary in summaries), len(summaries), elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export activities of several Marketo instances')
+    parser.add_argument(
+        '-c', '--config',
+        type = str,
+        dest = 'config',
+        required = True,
+        help = 'JSON file listing instances to be exported'
+	)
+    parser.add_argument(
+        '--workers',
+        type = int,
+        dest = 'workers',
+        required = False,
+        help = 'Number of time windows fetched at the same time by all instances. default: "workers" of config or 4'
+	)
+    parser.add_argument(
+        '--summary',
+        type = str,
+        dest = 'summary_file',
+        required = False,
+        help = 'Write results of each instance as JSON, with requests, latency and time of each stage'
+	)
+    parser.add_argument(
+        '-g', '--debug',
+        action = 'store_true',
+        dest = 'debug',
+        default = False,
+        help = 'Pring debugging information'
+	)
+    args = parser.parse_args()
+
+    try:
+        config_workers, instances = loadConfig(args.config)
+    except (IOError, ValueError, pytz.UnknownTimeZoneError), e:
+        parser.error(str(e))
+    workers = args.workers or config_workers or 4
+    if workers < 1:
+        parser.error("--workers must be 1 or more")
+    if [settings for settings in instances if settings ['compress'] == 'zstd'] and mkto.zstandard is None:
+        parser.error("compress zstd requires zstandard")
+
+    start = time.time()
+    pool = mkto.FairWorkerPool(workers)
+    exports = [InstanceExport(settings, pool, args.debug) for settings in instances]
+    for export in exports:
+        export.start()
+    for export in exports:
+        export.join()
+    pool.close()
+    elapsed = time.time() - start
+
+    summaries = [export.getSummary() for export in exports]
+    printSummary(summaries, elapsed)
+    if args.summary_file:
+        mkto.saveCheckpoint(args.summary_file, {'seconds': elapsed, 'workers': workers, 'instances': summaries})
+
+    if [summary for summary in summaries if summary ['status'] != 'completed']:
+        sys.exit(1)
@@ -0,0 +1,663 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+mktoMockServer.py: Local stand-in of Marketo REST API for testing and benchmarking mktoExportActivities.py
+Usage: mktoMockServer.py <options>
+
+Options:
+  -h                                this help
+  -p --port <port>                  Port number to listen. default: 8080
+  -n --activities <num>             Number of synthetic activities. default: 100000
+  --leads <num>                     Number of synthetic leads. default: 10000
+  --start <date>                    Activity Date of the first activity. default: 2015-04-01
+  --interval <sec>                  Seconds between activities. default: 60
+  --page-size <num>                 Max number of activities in a page. default: 300
+  --latency <sec>                   Latency added to each request. default: 0
+  --latency-jitter <sec>            Random latency added to each request. default: 0
+  --error-602-rate <rate>           Rate of requests rejected with 602. default: 0
+  --error-606-rate <rate>           Rate of requests rejected with 606. default: 0
+  --error-604-rate <rate>           Rate of requests rejected with 604 (request timed out). default: 0
+  --error-5xx-rate <rate>           Rate of requests failed with HTTP 503. default: 0
+  --outage-after <num>              Number of requests served before an outage. default: no outage
+  --outage-seconds <sec>            Seconds all requests fail with HTTP 503 after --outage-after requests. default: 60
+  --enforce-rate-limit              Reject requests over 100 calls in 20 seconds with 606
+  --token-ttl <sec>                 Lifetime of access token. default: 3600
+  --bulk-job-delay <sec>            Seconds until bulk export job is completed. default: 1
+  --bulk-shuffle                    Write rows of bulk export files in random order, which Marketo does not guarantee
+  --chunked                         Send responses with Transfer-Encoding: chunked instead of Content-Length
+  --seed <num>                      Seed of synthetic activities and injected errors. default: 0
+
+Example:
+  python mktoMockServer.py -p 8080 -n 1000000 --latency 0.2 --token-ttl 60
+  python mktoExportActivities.py -i http://localhost:8080 -d any -s any -c 2015-04-01
+
+Request counts and bytes sent are returned by http://localhost:8080/mock/stats.json
+"""
+
+import sys
+import argparse
+import csv
+import json
+import random
+import re
+import threading
+import time
+import urlparse
+import zlib
+import BaseHTTPServer
+import SocketServer
+import StringIO
+from datetime import datetime, timedelta
+
+
+# activity types generated by the server. Types are repeated according to their frequency
+ACTIVITY_TYPE_FREQUENCY = [12, 13, 13, 13, 10, 10, 11, 1, 1, 3, 2]
+
+# fields changed by "Change Data Value" activities: ('UI' name, REST API name)
+CHANGE_DATA_FIELDS = [('Lead Score', 'leadScore'),
+                      ('Behavior Score', 'behaviorScore'),
+                      ('Demographic Score', 'demographicScore'),
+                      ('Lead Status', 'leadStatus')]
+
+# fields returned by Describe Lead
+LEAD_FIELDS = [{'id': 1, 'displayName': 'Id', 'dataType': 'integer', 'rest': {'name': 'id', 'readOnly': True}}] + \
+    [{'id': 600 + index, 'displayName': name, 'dataType': 'string' if api_name == 'leadStatus' else 'integer',
+      'rest': {'name': api_name, 'readOnly': False}} for index, (name, api_name) in enumerate(CHANGE_DATA_FIELDS)]
+
+# metadata returned by Get Activity Types
+ACTIVITY_TYPES = [
+    {'id': 1, 'name': 'Visit Webpage', 'description': 'User visits a web page',
+     'primaryAttribute': {'name': 'Webpage ID', 'dataType': 'integer'},
+     'attributes': [{'name': 'Client IP Address', 'dataType': 'string'},
+                    {'name': 'Query Parameters', 'dataType': 'string'},
+                    {'name': 'Referrer URL', 'dataType': 'string'},
+                    {'name': 'User Agent', 'dataType': 'string'},
+                    {'name': 'Webpage URL', 'dataType': 'string'}]},
+    {'id': 2, 'name': 'Fill Out Form', 'description': 'User fills out and submits form on web page',
+     'primaryAttribute': {'name': 'Webform ID', 'dataType': 'integer'},
+     'attributes': [{'name': 'Client IP Address', 'dataType': 'string'},
+                    {'name': 'Form Fields', 'dataType': 'text'},
+                    {'name': 'Query Parameters', 'dataType': 'string'},
+                    {'name': 'Referrer URL', 'dataType': 'string'},
+                    {'name': 'User Agent', 'dataType': 'string'},
+                    {'name': 'Webpage ID', 'dataType': 'integer'}]},
+    {'id': 3, 'name': 'Click Link', 'description': 'User clicks link on a page',
+     'primaryAttribute': {'name': 'Link ID', 'dataType': 'integer'},
+     'attributes': [{'name': 'Client IP Address', 'dataType': 'string'},
+                    {'name': 'Query Parameters', 'dataType': 'string'},
+                    {'name': 'Referrer URL', 'dataType': 'string'},
+                    {'name': 'User Agent', 'dataType': 'string'},
+                    {'name': 'Webpage ID', 'dataType': 'integer'}]},
+    {'id': 10, 'name': 'Open Email', 'description': 'User opens Marketo Email',
+     'primaryAttribute': {'name': 'Mailing ID', 'dataType': 'integer'},
+     'attributes': [{'name': 'Device', 'dataType': 'string'},
+                    {'name': 'Is Mobile Device', 'dataType': 'boolean'},
+                    {'name': 'Platform', 'dataType': 'string'},
+                    {'name': 'User Agent', 'dataType': 'string'}]},
+    {'id': 11, 'name': 'Click Email', 'description': 'User clicks on a link in a Marketo Email',
+     'primaryAttribute': {'name': 'Mailing ID', 'dataType': 'integer'},
+     'attributes': [{'name': 'Device', 'dataType': 'string'},
+                    {'name': 'Is Mobile Device', 'dataType': 'boolean'},
+                    {'name': 'Link', 'dataType': 'string'},
+                    {'name': 'Platform', 'dataType': 'string'},
+                    {'name': 'User Agent', 'dataType': 'string'}]},
+    {'id': 12, 'name': 'New Lead', 'description': 'New person/record is added to the lead database',
+     'primaryAttribute': {'name': 'Lead ID', 'dataType': 'integer'},
+     'attributes': [{'name': 'Created Date', 'dataType': 'date'},
+                    {'name': 'Form Name', 'dataType': 'string'},
+                    {'name': 'Source Type', 'dataType': 'string'}]},
+    {'id': 13, 'name': 'Change Data Value', 'description': 'Changed attribute value for a person/record',
+     'primaryAttribute': {'name': 'Attribute Name', 'dataType': 'integer'},
+     'attributes': [{'name': 'New Value', 'dataType': 'string'},
+                    {'name': 'Old Value', 'dataType': 'string'},
+                    {'name': 'Reason', 'dataType': 'string'},
+                    {'name': 'Source', 'dataType': 'string'}]},
+]
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_2) AppleWebKit/600.3.18 (KHTML, like Gecko)'
+
+
+# -------
+# Synthetic activities generated from their index, so any number of activities can be
+# served without keeping them in memory. Activity Date of index i is start + i * interval.
+#
+#    activities: number of activities
+#    leads: number of leads
+#    start: datetime of the first activity
+#    interval: seconds between activities
+#    seed: seed for the values of activities
+#
+class SyntheticActivities:
+    first_id = 100000
+
+    def __init__(self, activities, leads, start, interval, seed):
+        self.activities = activities
+        self.leads = leads
+        self.start = start
+        self.interval = interval
+        self.seed = seed
+
+    # cheap integer hash, so every value of activity is derived from its index
+    def _hash(self, index):
+        h = (index * 2654435761 + self.seed * 97 + 12345) & 0xffffffff
+        h ^= h >> 15
+        return (h * 2246822519) & 0xffffffff
+
+    def activityTypeId(self, index):
+        return ACTIVITY_TYPE_FREQUENCY [self._hash(index) % len(ACTIVITY_TYPE_FREQUENCY)]
+
+    def activityDate(self, index):
+        return (self.start + timedelta(seconds=index * self.interval)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    # index of the first activity on or after date
+    def indexOf(self, date):
+        seconds = (date - self.start).total_seconds()
+        if seconds <= 0:
+            return 0
+        index = int(seconds) // self.interval
+        if index * self.interval < seconds:
+            index += 1
+        return min(index, self.activities)
+
+    # field changed by "Change Data Value" activity: ('UI' name, REST API name)
+    def changedField(self, index):
+        return CHANGE_DATA_FIELDS [(self._hash(index) >> 4) % len(CHANGE_DATA_FIELDS)]
+
+    def get(self, index):
+        h = self._hash(index)
+        activityTypeId = self.activityTypeId(index)
+        leadId = 1 + (h >> 8) % self.leads
+        activity = {'id': self.first_id + index,
+                    'leadId': leadId,
+                    'activityDate': self.activityDate(index),
+                    'activityTypeId': activityTypeId}
+
+        if activityTypeId == 12:
+            activity ['primaryAttributeValueId'] = leadId
+            activity ['attributes'] = [{'name': 'Created Date', 'value': self.activityDate(index)[:10]},
+                                       {'name': 'Form Name', 'value': 'Mock_Program.Mock_Form'},
+                                       {'name': 'Source Type', 'value': 'Web form fillout'}]
+        elif activityTypeId == 13:
+            field = self.changedField(index)
+            activity ['primaryAttributeValueId'] = 600 + CHANGE_DATA_FIELDS.index(field)
+            activity ['primaryAttributeValue'] = field [0]
+            activity ['attributes'] = [{'name': 'New Value', 'value': str((h >> 12) % 100)},
+                                       {'name': 'Old Value', 'value': str((h >> 20) % 100)},
+                                       {'name': 'Reason', 'value': 'Form fill-out, URL: http://mock.example.com/lp/form.html'},
+                                       {'name': 'Source', 'value': 'Web form fillout'}]
+        elif activityTypeId in (10, 11):
+            mailing = (h >> 12) % 20
+            activity ['primaryAttributeValueId'] = mailing
+            activity ['primaryAttributeValue'] = u'Mock_Program.%02d_Mail_メール' % mailing
+            attributes = [{'name': 'Device', 'value': 'unknown'},
+                          {'name': 'Is Mobile Device', 'value': False},
+                          {'name': 'Platform', 'value': 'unknown'},
+                          {'name': 'User Agent', 'value': USER_AGENT}]
+            if activityTypeId == 11:
+                attributes.insert(2, {'name': 'Link', 'value': 'http://mock.example.com/mail/%d.html' % ((h >> 16) % 50)})
+            activity ['attributes'] = attributes
+        else:
+            page = (h >> 12) % 30
+            activity ['primaryAttributeValueId'] = page
+            if activityTypeId == 3:
+                activity ['primaryAttributeValue'] = 'mock.example.com/lp/%d/download.pdf' % page
+            else:
+                activity ['primaryAttributeValue'] = 'mock.example.com/page/%d.html' % page
+            activity ['attributes'] = [{'name': 'Client IP Address', 'value': '192.0.2.%d' % ((h >> 20) % 250)},
+                                       {'name': 'Query Parameters', 'value': 'utm_source=mock&n=%d' % ((h >> 4) % 10)},
+                                       {'name': 'Referrer URL', 'value': ''},
+                                       {'name': 'User Agent', 'value': USER_AGENT}]
+            if activityTypeId == 2:
+                activity ['attributes'].append({'name': 'Form Fields', 'value': '{"Email": "lead%d@example.com"}' % leadId})
+        return activity
+
+    # value of lead field returned by Get Multiple Leads by Filter Type
+    def leadValue(self, leadId, field):
+        if field == 'id':
+            return leadId
+        h = self._hash(leadId * 31 + len(field))
+        if field == 'leadStatus':
+            return ['Open', 'Contacted', 'Qualified'][h % 3]
+        return h % 100
+
+
+# -------
+# Request handler of Marketo REST API endpoints called by MarketoClient
+#
+class MockRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    # count connections, so reuse of keep-alive connections can be checked in stats
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.countConnection()
+
+    # body is compressed with gzip if the client accepts it, like Marketo does
+    def _send(self, content, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            content = compressor.compress(content) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        if self.server.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(content), self.server.chunk_size):
+                chunk = content [start:start + self.server.chunk_size]
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        self.server.countBytes(len(content))
+
+    def _sendStatus(self, status):
+        content = '<html><body>' + self.responses [status][0] + '</body></html>'
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _sendJson(self, data):
+        self._send(json.dumps(data))
+
+    def _sendError(self, code, message):
+        self._sendJson({'requestId': 'mock', 'success': False, 'errors': [{'code': code, 'message': message}]})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        params = dict((key, values [0]) for key, values in urlparse.parse_qs(url.query).iteritems())
+        body = ''
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+
+        server.count(url.path)
+
+        if url.path == '/mock/stats.json':
+            return self._sendJson(server.getStats())
+
+        server.sleep()
+
+        # failures of the instance or proxies in front of it
+        status = server.checkOutage()
+        if status:
+            return self._sendStatus(status)
+
+        if url.path == '/identity/oauth/token':
+            access_token, expires_in = server.getAccessToken()
+            return self._sendJson({'access_token': access_token, 'token_type': 'bearer',
+                                   'expires_in': expires_in, 'scope': 'mock@example.com'})
+
+        # errors injected before the request is handled
+        error = server.checkRequest(params.get('access_token'))
+        if error:
+            return self._sendError(error [0], error [1])
+
+        if url.path == '/rest/v1/activities/pagingtoken.json':
+            return self._sendJson(server.getPagingToken(params ['sinceDatetime']))
+        if url.path == '/rest/v1/activities.json':
+            return self._sendJson(server.getActivities(params ['nextPageToken'], params.get('activityTypeIds', '')))
+        if url.path == '/rest/v1/activities/leadchanges.json':
+            return self._sendJson(server.getLeadChanges(params ['nextPageToken'], params.get('fields', '')))
+        if url.path == '/rest/v1/activities/types.json':
+            return self._sendJson({'requestId': 'mock', 'success': True, 'result': ACTIVITY_TYPES})
+        if url.path == '/rest/v1/leads/describe.json':
+            return self._sendJson({'requestId': 'mock', 'success': True, 'result': LEAD_FIELDS})
+        if url.path == '/rest/v1/leads.json':
+            return self._sendJson(server.getLeads(params.get('filterType'), params.get('filterValues', ''), params.get('fields', '')))
+
+        match = re.match(r'^/bulk/v1/activities/export/(create|([\w-]+)/(enqueue|status|file))\.json$', url.path)
+        if match:
+            if match.group(1) == 'create':
+                return self._sendJson(server.createExportJob(json.loads(body)))
+            export_id, action = match.group(2), match.group(3)
+            if action == 'file':
+                content = server.getExportFile(export_id)
+                if content is None:
+                    return self._sendError('1004', 'Export job not found')
+                return self._send(content, 'text/csv')
+            return self._sendJson(server.updateExportJob(export_id, action))
+
+        self._sendError('404', 'Not found: ' + url.path)
+
+
+# -------
+# Local stand-in of Marketo REST API
+#
+#    port: port number to listen. 0 picks a free port
+#    activities: SyntheticActivities served by the server
+#
+# Other options are the same as command line options. The server can be started in
+# a thread with start(), and its url is returned by getInstanceUrl().
+#
+class MarketoMockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # bytes of each chunk of chunked responses
+    chunk_size = 4096
+
+    def __init__(self, port, activities, page_size=300, latency=0.0, latency_jitter=0.0,
+                 error_602_rate=0.0, error_606_rate=0.0, enforce_rate_limit=False,
+                 token_ttl=3600, bulk_job_delay=1.0, seed=0, verbose=False,
+                 error_604_rate=0.0, error_5xx_rate=0.0, outage_after=None, outage_seconds=60.0, bulk_shuffle=False, chunked=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), MockRequestHandler)
+        self.activities = activities
+        self.page_size = page_size
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_602_rate = error_602_rate
+        self.error_606_rate = error_606_rate
+        self.error_604_rate = error_604_rate
+        self.error_5xx_rate = error_5xx_rate
+        self.outage_after = outage_after
+        self.outage_seconds = outage_seconds
+        self.outage_until = None
+        self.served = 0
+        self.enforce_rate_limit = enforce_rate_limit
+        self.token_ttl = token_ttl
+        self.bulk_job_delay = bulk_job_delay
+        self.bulk_shuffle = bulk_shuffle
+        self.chunked = chunked
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.access_token = None
+        self.token_expires_at = 0
+        self.call_times = []
+        self.export_jobs = {}
+        self.stats = {'requests': {}, 'errors': {}, 'activities': 0, 'bytes': 0, 'connections': 0}
+        self.thread = None
+
+    def getInstanceUrl(self):
+        return 'http://127.0.0.1:' + str(self.server_address [1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, path):
+        with self.lock:
+            requests = self.stats ['requests']
+            requests [path] = requests.get(path, 0) + 1
+
+    def countConnection(self):
+        with self.lock:
+            self.stats ['connections'] += 1
+
+    def countBytes(self, size):
+        with self.lock:
+            self.stats ['bytes'] += size
+
+    def _countError(self, code):
+        self.stats ['errors'][code] = self.stats ['errors'].get(code, 0) + 1
+
+    def getStats(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def sleep(self):
+        latency = self.latency
+        if self.latency_jitter:
+            with self.lock:
+                latency += self.random.random() * self.latency_jitter
+        if latency > 0:
+            time.sleep(latency)
+
+    # Marketo returns the same token until it expires
+    def getAccessToken(self):
+        with self.lock:
+            now = time.time()
+            if self.access_token is None or now >= self.token_expires_at:
+                self.access_token = 'mock-%d-%d' % (int(now * 1000), self.random.randint(0, 1 << 30))
+                self.token_expires_at = now + self.token_ttl
+            return self.access_token, max(int(self.token_expires_at - now), 0)
+
+    # return HTTP status if the request should fail
+    def checkOutage(self):
+        with self.lock:
+            self.served += 1
+            now = time.time()
+            if self.outage_until is None and self.outage_after is not None and self.served > self.outage_after:
+                self.outage_until = now + self.outage_seconds
+            if (self.outage_until is not None and now < self.outage_until) or \
+               (self.error_5xx_rate and self.random.random() < self.error_5xx_rate):
+                self._countError('503')
+                return 503
+        return None
+
+    # return (code, message) if the request should be rejected
+    def checkRequest(self, access_token):
+        with self.lock:
+            now = time.time()
+            if access_token != self.access_token or now >= self.token_expires_at:
+                self._countError('602')
+                return ('602', 'Access token expired')
+            if self.enforce_rate_limit:
+                self.call_times = [call_time for call_time in self.call_times if call_time > now - 20.0]
+                if len(self.call_times) >= 100:
+                    self._countError('606')
+                    return ('606', "Max rate limit '100' exceeded with in '20' secs")
+                self.call_times.append(now)
+            if self.error_602_rate and self.random.random() < self.error_602_rate:
+                self._countError('602')
+                return ('602', 'Access token expired')
+            if self.error_606_rate and self.random.random() < self.error_606_rate:
+                self._countError('606')
+                return ('606', "Max rate limit '100' exceeded with in '20' secs")
+            if self.error_604_rate and self.random.random() < self.error_604_rate:
+                self._countError('604')
+                return ('604', 'Request time-out')
+        return None
+
+    def getPagingToken(self, since):
+        since = since.replace('Z', '')
+        for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+            try:
+                date = datetime.strptime(since, date_format)
+                break
+            except ValueError:
+                pass
+        else:
+            return {'requestId': 'mock', 'success': False, 'errors': [{'code': '1001', 'message': 'Invalid sinceDatetime: ' + since}]}
+        return {'requestId': 'mock', 'success': True, 'nextPageToken': self._token(self.activities.indexOf(date))}
+
+    def _token(self, index):
+        return 'MOCK%012d' % index
+
+    def _index(self, token):
+        return int(token [4:])
+
+    # collect up to page_size activities matched by accept from token
+    def _page(self, token, accept):
+        index = self._index(token)
+        result = []
+        # like Marketo, a page may have less activities than page_size
+        end = min(index + self.page_size * 10, self.activities.activities)
+        while index < end and len(result) < self.page_size:
+            activity = accept(index)
+            if activity is not None:
+                result.append(activity)
+            index += 1
+        with self.lock:
+            self.stats ['activities'] += len(result)
+        data = {'requestId': 'mock', 'success': True,
+                'nextPageToken': self._token(index),
+                'moreResult': index < self.activities.activities}
+        if result:
+            data ['result'] = result
+        return data
+
+    def getActivities(self, token, activity_type_ids):
+        activity_type_ids = set(int(id) for id in activity_type_ids.split(',') if id)
+        activities = self.activities
+        def accept(index):
+            if activities.activityTypeId(index) in activity_type_ids:
+                return activities.get(index)
+            return None
+        return self._page(token, accept)
+
+    def getLeadChanges(self, token, fields):
+        fields = set(fields.split(','))
+        activities = self.activities
+        def accept(index):
+            if activities.activityTypeId(index) != 13 or activities.changedField(index)[1] not in fields:
+                return None
+            activity = activities.get(index)
+            attributes = dict((attribute ['name'], attribute ['value']) for attribute in activity ['attributes'])
+            return {'id': activity ['id'],
+                    'leadId': activity ['leadId'],
+                    'activityDate': activity ['activityDate'],
+                    'activityTypeId': 13,
+                    'fields': [{'id': activity ['primaryAttributeValueId'],
+                                'name': activities.changedField(index)[1],
+                                'newValue': attributes ['New Value'],
+                                'oldValue': attributes ['Old Value']}],
+                    'attributes': [{'name': 'Reason', 'value': attributes ['Reason']},
+                                   {'name': 'Source', 'value': attributes ['Source']}]}
+        return self._page(token, accept)
+
+    def getLeads(self, filter_type, filter_values, fields):
+        if filter_type != 'id':
+            return {'requestId': 'mock', 'success': False, 'errors': [{'code': '1003', 'message': 'Only filterType id is supported'}]}
+        ids = [int(id) for id in filter_values.split(',') if id]
+        if len(ids) > 300:
+            return {'requestId': 'mock', 'success': False, 'errors': [{'code': '1003', 'message': 'Too many filterValues'}]}
+        fields = [field for field in fields.split(',') if field] or ['id']
+        result = []
+        for leadId in ids:
+            if leadId < 1 or leadId > self.activities.leads:
+                continue
+            lead = {'id': leadId}
+            for field in fields:
+                lead [field] = self.activities.leadValue(leadId, field)
+            result.append(lead)
+        return {'requestId': 'mock', 'success': True, 'result': result}
+
+    def createExportJob(self, request):
+        date_filter = request ['filter']['createdAt']
+        with self.lock:
+            export_id = 'mock-export-%d' % len(self.export_jobs)
+            self.export_jobs [export_id] = {'status': 'Created',
+                                            'startAt': date_filter ['startAt'],
+                                            'endAt': date_filter ['endAt'],
+                                            'activityTypeIds': set(request ['filter'].get('activityTypeIds', [])),
+                                            'queuedAt': None}
+        return {'requestId': 'mock', 'success': True, 'result': [{'exportId': export_id, 'status': 'Created', 'format': 'CSV'}]}
+
+    def updateExportJob(self, export_id, action):
+        with self.lock:
+            job = self.export_jobs.get(export_id)
+            if job is None:
+                return {'requestId': 'mock', 'success': False, 'errors': [{'code': '1004', 'message': 'Export job not found'}]}
+            if action == 'enqueue':
+                job ['status'] = 'Queued'
+                job ['queuedAt'] = time.time()
+            elif job ['queuedAt'] is not None:
+                if time.time() >= job ['queuedAt'] + self.bulk_job_delay:
+                    job ['status'] = 'Completed'
+                else:
+                    job ['status'] = 'Processing'
+            return {'requestId': 'mock', 'success': True, 'result': [{'exportId': export_id, 'status': job ['status'], 'format': 'CSV'}]}
+
+    def getExportFile(self, export_id):
+        with self.lock:
+            job = self.export_jobs.get(export_id)
+        if job is None or job ['status'] != 'Completed':
+            return None
+
+        def parse(date):
+            return datetime.strptime(date.replace('Z', '')[:19], '%Y-%m-%dT%H:%M:%S')
+        activities = self.activities
+        start = activities.indexOf(parse(job ['startAt']))
+        end = activities.indexOf(parse(job ['endAt']) + timedelta(seconds=1))
+
+        content = StringIO.StringIO()
+        writer = csv.writer(content)
+        writer.writerow(['marketoGUID', 'leadId', 'activityDate', 'activityTypeId', 'campaignId',
+                         'primaryAttributeValueId', 'primaryAttributeValue', 'attributes'])
+        indexes = [index for index in xrange(start, end) if activities.activityTypeId(index) in job ['activityTypeIds']]
+        if self.bulk_shuffle:
+            random.Random(export_id).shuffle(indexes)
+        for index in indexes:
+            activity = activities.get(index)
+            attributes = dict((attribute ['name'], attribute ['value']) for attribute in activity ['attributes'])
+            writer.writerow([activity ['id'], activity ['leadId'], activity ['activityDate'], activity ['activityTypeId'], '',
+                             activity.get('primaryAttributeValueId', ''),
+                             unicode(activity.get('primaryAttributeValue', '')).encode('utf-8'),
+                             json.dumps(attributes)])
+        return content.getvalue()
+
+
+# build MarketoMockServer from parsed command line options
+def createMockServer(args):
+    activities = SyntheticActivities(args.activities, args.leads, datetime.strptime(args.start, '%Y-%m-%d'), args.interval, args.seed)
+    return MarketoMockServer(args.port, activities, args.page_size, args.latency, args.latency_jitter,
+                             args.error_602_rate, args.error_606_rate, args.enforce_rate_limit,
+                             args.token_ttl, args.bulk_job_delay, args.seed, getattr(args, 'verbose', False),
+                             args.error_604_rate, args.error_5xx_rate, args.outage_after, args.outage_seconds, args.bulk_shuffle,
+                             args.chunked)
+
+# add options of the mock server into parser, shared with mktoBenchmark.py
+def addMockServerArguments(parser, port=8080):
+    parser.add_argument('-p', '--port', type = int, dest = 'port', default = port, help = 'Port number to listen. default: ' + str(port))
+    parser.add_argument('-n', '--activities', type = int, dest = 'activities', default = 100000, help = 'Number of synthetic activities. default: 100000')
+    parser.add_argument('--leads', type = int, dest = 'leads', default = 10000, help = 'Number of synthetic leads. default: 10000')
+    parser.add_argument('--start', type = str, dest = 'start', default = '2015-04-01', help = 'Activity Date of the first activity. default: 2015-04-01')
+    parser.add_argument('--interval', type = int, dest = 'interval', default = 60, help = 'Seconds between activities. default: 60')
+    parser.add_argument('--page-size', type = int, dest = 'page_size', default = 300, help = 'Max number of activities in a page. default: 300')
+    parser.add_argument('--latency', type = float, dest = 'latency', default = 0.0, help = 'Latency added to each request. default: 0')
+    parser.add_argument('--latency-jitter', type = float, dest = 'latency_jitter', default = 0.0, help = 'Random latency added to each request. default: 0')
+    parser.add_argument('--error-602-rate', type = float, dest = 'error_602_rate', default = 0.0, help = 'Rate of requests rejected with 602. default: 0')
+    parser.add_argument('--error-606-rate', type = float, dest = 'error_606_rate', default = 0.0, help = 'Rate of requests rejected with 606. default: 0')
+    parser.add_argument('--error-604-rate', type = float, dest = 'error_604_rate', default = 0.0, help = 'Rate of requests rejected with 604 (request timed out). default: 0')
+    parser.add_argument('--error-5xx-rate', type = float, dest = 'error_5xx_rate', default = 0.0, help = 'Rate of requests failed with HTTP 503. default: 0')
+    parser.add_argument('--outage-after', type = int, dest = 'outage_after', default = None, help = 'Number of requests served before an outage. default: no outage')
+    parser.add_argument('--outage-seconds', type = float, dest = 'outage_seconds', default = 60.0, help = 'Seconds all requests fail with HTTP 503 after --outage-after requests. default: 60')
+    parser.add_argument('--enforce-rate-limit', action = 'store_true', dest = 'enforce_rate_limit', default = False, help = 'Reject requests over 100 calls in 20 seconds with 606')
+    parser.add_argument('--token-ttl', type = int, dest = 'token_ttl', default = 3600, help = 'Lifetime of access token. default: 3600')
+    parser.add_argument('--bulk-job-delay', type = float, dest = 'bulk_job_delay', default = 1.0, help = 'Seconds until bulk export job is completed. default: 1')
+    parser.add_argument('--bulk-shuffle', action = 'store_true', dest = 'bulk_shuffle', default = False, help = 'Write rows of bulk export files in random order, which Marketo does not guarantee')
+    parser.add_argument('--chunked', action = 'store_true', dest = 'chunked', default = False, help = 'Send responses with Transfer-Encoding: chunked instead of Content-Length')
+    parser.add_argument('--seed', type = int, dest = 'seed', default = 0, help = 'Seed of synthetic activities and injected errors. default: 0')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in of Marketo REST API')
+    addMockServerArguments(parser)
+    parser.add_argument(
+        '-v', '--verbose',
+        action = 'store_true',
+        dest = 'verbose',
+        default = False,
+        help = 'Print each request'
+	)
+    args = parser.parse_args()
+
+    server = createMockServer(args)
+    print >> sys.stderr, "Marketo mock server is running on " + server.getInstanceUrl()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
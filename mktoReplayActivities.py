@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+mktoReplayActivities.py: Transforming activities archived by mktoExportActivities.py --archive again, without Marketo
+Usage: mktoReplayActivities.py <options>
+
+Options:
+  -h                                this help
+  -a --archive <directory>          Directory written by --archive of mktoExportActivities.py
+  -o --output <filename>            Output filename. default: stdout
+  -j --not-use-jst                  Change TimeZone for Activity Date field. Default is JST.
+  -f --change-data-field <fields>   Same as mktoExportActivities.py
+  -w --add-webvisit-activity        Same as mktoExportActivities.py
+  -m --add-mail-activity            Same as mktoExportActivities.py
+  --activity-types <ids>            Same as mktoExportActivities.py. They must be archived with --activity-types
+  --tz <timezone>                   Same as mktoExportActivities.py. default: Asia/Tokyo
+  --format <csv|parquet>            Output format. parquet requires pyarrow and --output. default: csv
+  --compress <gzip|zstd>            Compress csv output. zstd requires zstandard.
+  --processes <num>                 Number of processes transforming activities. default: number of CPUs
+  --lead-state-memory <MB>          Megabytes of memory for latest field values of leads, shared by processes. default: 1024
+  --fast-json                       Decode archived pages with ujson. It requires ujson.
+  -g --debug                        Pring debugging information
+
+Activities of the archive are transformed by --processes processes in two steps. At first,
+segments of the archive are decoded at the same time, and activities are split into a
+partition for each process by Lead Id. Then each process transforms its partition in order of
+the archive, with the latest field values of its own leads. Activities of a lead are always in
+the same partition, so field values are carried forward just like a single process. Rows of
+partitions are merged in order of the archive, so the output is the same as mktoExportActivities.py
+with the same options.
+
+Example:
+  python mktoExportActivities.py -i ... -d ... -s ... -c 2015-04-01 -m -w --archive archive/
+  python mktoReplayActivities.py -a archive/ -f 'Behavior Score' -m -w -o activities.csv --processes 8
+"""
+
+import sys, os, errno
+import argparse
+import multiprocessing
+import tempfile
+import shutil
+import heapq
+import cPickle
+import json
+import time
+import pytz
+
+import mktoExportActivities as mkto
+
+
+# activities and rows are pickled into partition files in lists of this size
+CHUNK_SIZE = 1000
+
+
+# -------
+# Settings of a replay, passed to worker processes
+#
+#    archive_dir: directory of the archive
+#    manifest: manifest of the archive returned by loadArchiveManifest
+#    temp_dir: directory of partition files
+#    processes: number of partitions
+#    tracking_fields, mail_activity, web_activity, timezone_name, activity_types, pad_missing:
+#        arguments of ActivityTransformer. timezone_name is None to keep UTC
+#    lead_state_memory: bytes of memory for lead state of a partition
+#    fast_json: decode pages with ujson
+#
+class ReplaySettings:
+    def __init__(self, archive_dir, manifest, temp_dir, processes, tracking_fields, mail_activity, web_activity, timezone_name,
+                 activity_types, pad_missing, lead_state_memory, fast_json):
+        self.archive_dir = archive_dir
+        self.manifest = manifest
+        self.temp_dir = temp_dir
+        self.processes = processes
+        self.tracking_fields = tracking_fields
+        self.mail_activity = mail_activity
+        self.web_activity = web_activity
+        self.timezone_name = timezone_name
+        self.activity_types = activity_types
+        self.pad_missing = pad_missing
+        self.lead_state_memory = lead_state_memory
+        self.fast_json = fast_json
+
+    def createTransformer(self):
+        timezone = None
+        if self.timezone_name:
+            timezone = pytz.timezone(self.timezone_name)
+        lead_state = mkto.LeadStateStore(self.tracking_fields, self.lead_state_memory)
+        return mkto.ActivityTransformer(self.tracking_fields, self.mail_activity, self.web_activity, timezone, lead_state, self.activity_types,
+                                        pad_missing=self.pad_missing)
+
+    def getPartitionPath(self, segment_index, partition):
+        return os.path.join(self.temp_dir, 'segment.%05d.part%03d' % (segment_index, partition))
+
+    def getRowsPath(self, partition):
+        return os.path.join(self.temp_dir, 'rows.part%03d' % partition)
+
+
+# return pickled chunks of a file one by one
+def iterChunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = cPickle.load(f)
+            except EOFError:
+                return
+            for item in chunk:
+                yield item
+
+
+# -------
+# Step 1 in a worker process: split activities of a segment into partitions by Lead Id
+#
+#    settings: ReplaySettings
+#    segment_index: index of segment in manifest
+#
+# Activities are written as (position in segment, activity) into a file of each partition.
+# Return number of activities.
+#
+def partitionSegment((settings, segment_index)):
+    segment = settings.manifest ['segments'][segment_index]
+    json_decoder = None
+    if settings.fast_json:
+        json_decoder = mkto.ujson.loads
+    partitions = [[] for partition in range(settings.processes)]
+    files = [open(settings.getPartitionPath(segment_index, partition), 'wb') for partition in range(settings.processes)]
+    position = 0
+    try:
+        for results in mkto.iterArchiveSegment(os.path.join(settings.archive_dir, segment ['file']), settings.manifest ['compression'], json_decoder):
+            for result in results:
+                partition = partitions [result ['leadId'] % settings.processes]
+                partition.append((position, result))
+                position += 1
+                if len(partition) >= CHUNK_SIZE:
+                    cPickle.dump(partition, files [result ['leadId'] % settings.processes], 2)
+                    del partition [:]
+        for partition, f in zip(partitions, files):
+            if partition:
+                cPickle.dump(partition, f, 2)
+    finally:
+        for f in files:
+            f.close()
+    return position
+
+
+# -------
+# Step 2 in a worker process: transform activities of a partition in order of the archive
+#
+#    settings: ReplaySettings
+#    partition: index of partition
+#
+# Rows are written as (segment index, position in segment, row) into a file of the partition,
+# and activity files of the partition are removed. Return number of rows.
+#
+def transformPartition((settings, partition)):
+    transformer = settings.createTransformer()
+    rows = []
+    count = 0
+    try:
+        with open(settings.getRowsPath(partition), 'wb') as f:
+            for segment_index in range(len(settings.manifest ['segments'])):
+                path = settings.getPartitionPath(segment_index, partition)
+                for position, result in iterChunks(path):
+                    row = transformer.transform(result)
+                    if row is None:
+                        continue
+                    rows.append((segment_index, position, tuple(row)))
+                    if len(rows) >= CHUNK_SIZE:
+                        cPickle.dump(rows, f, 2)
+                        count += len(rows)
+                        rows = []
+                os.remove(path)
+            if rows:
+                cPickle.dump(rows, f, 2)
+                count += len(rows)
+    finally:
+        transformer.close()
+    return count
+
+
+# yields rows of all partitions in order of the archive
+def iterMergedRows(settings):
+    for segment_index, position, row in heapq.merge(*[iterChunks(settings.getRowsPath(partition)) for partition in range(settings.processes)]):
+        yield row
+
+
+# transform archive in this process, without partitions
+def iterReplayRows(settings):
+    transformer = settings.createTransformer()
+    json_decoder = None
+    if settings.fast_json:
+        json_decoder = mkto.ujson.loads
+    try:
+        for segment in settings.manifest ['segments']:
+            for results in mkto.iterArchiveSegment(os.path.join(settings.archive_dir, segment ['file']), settings.manifest ['compression'], json_decoder):
+                for row in transformer.iterRecords(results):
+                    yield row
+    finally:
+        transformer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Transform activities archived by mktoExportActivities.py again')
+    parser.add_argument(
+        '-a', '--archive',
+        type = str,
+        dest = 'archive_dir',
+        required = True,
+        help = 'Directory written by --archive of mktoExportActivities.py'
+	)
+    parser.add_argument(
+        '-o', '--output',
+        type = str,
+        dest = 'output_file',
+        required = False,
+        help = 'Output filename. default: stdout'
+	)
+    parser.add_argument(
+        '-j', '--not-use-jst',
+        action = 'store_true',
+        dest = 'not_jst',
+        default = False,
+        help = 'Change TimeZone for Activity Date field. Default is JST.'
+	)
+    parser.add_argument(
+        '-f', '--change-data-field',
+        type = str,
+        dest = 'change_data_fields',
+        required = False,
+        help = 'Same as mktoExportActivities.py'
+	)
+    parser.add_argument(
+        '-w', '--add-webvisit-activity',
+        action = 'store_true',
+        dest = 'web_activity',
+        default = False,
+        help = 'Same as mktoExportActivities.py'
+	)
+    parser.add_argument(
+        '-m', '--add-mail-activity',
+        action = 'store_true',
+        dest = 'mail_activity',
+        default = False,
+        help = 'Same as mktoExportActivities.py'
+	)
+    parser.add_argument(
+        '--activity-types',
+        type = str,
+        dest = 'activity_type_ids',
+        required = False,
+        help = 'Same as mktoExportActivities.py. They must be archived with --activity-types'
+	)
+    parser.add_argument(
+        '--tz',
+        type = str,
+        dest = 'timezone',
+        default = 'Asia/Tokyo',
+        required = False,
+        help = 'Same as mktoExportActivities.py. default: Asia/Tokyo'
+	)
+    parser.add_argument(
+        '--format',
+        type = str,
+        dest = 'output_format',
+        choices = ['csv', 'parquet'],
+        default = 'csv',
+        required = False,
+        help = 'Output format. parquet requires pyarrow and --output. default: csv'
+	)
+    parser.add_argument(
+        '--compress',
+        type = str,
+        dest = 'compress',
+        choices = ['gzip', 'zstd'],
+        required = False,
+        help = 'Compress csv output. zstd requires zstandard.'
+	)
+    parser.add_argument(
+        '--processes',
+        type = int,
+        dest = 'processes',
+        required = False,
+        help = 'Number of processes transforming activities. default: number of CPUs'
+	)
+    parser.add_argument(
+        '--lead-state-memory',
+        type = int,
+        dest = 'lead_state_memory',
+        default = 1024,
+        required = False,
+        help = 'Megabytes of memory for latest field values of leads, shared by processes. default: 1024'
+	)
+    parser.add_argument(
+        '--fast-json',
+        action = 'store_true',
+        dest = 'fast_json',
+        default = False,
+        help = 'Decode archived pages with ujson. It requires ujson.'
+	)
+    parser.add_argument(
+        '-g', '--debug',
+        action = 'store_true',
+        dest = 'debug',
+        default = False,
+        help = 'Pring debugging information'
+	)
+    args = parser.parse_args()
+
+    try:
+        manifest = mkto.loadArchiveManifest(args.archive_dir)
+    except (IOError, ValueError), e:
+        parser.error(str(e))
+    if not manifest ['complete']:
+        print >> sys.stderr, "Archive " + args.archive_dir + " is not complete, so activities after the last segment are missing."
+
+    processes = args.processes or multiprocessing.cpu_count()
+    if processes < 1:
+        parser.error("--processes must be 1 or more")
+    if args.lead_state_memory < 0:
+        parser.error("--lead-state-memory must be 0 or more")
+    if args.output_format == 'parquet':
+        if mkto.pyarrow is None:
+            parser.error("--format parquet requires pyarrow")
+        if not args.output_file:
+            parser.error("--format parquet requires --output")
+    if args.compress:
+        if args.output_format != 'csv' or not args.output_file:
+            parser.error("--compress requires csv and --output")
+        if args.compress == 'zstd' and mkto.zstandard is None:
+            parser.error("--compress zstd requires zstandard")
+    if manifest ['compression'] == 'zstd' and mkto.zstandard is None:
+        parser.error("archive compressed by zstd requires zstandard")
+    if args.fast_json and mkto.ujson is None:
+        parser.error("--fast-json requires ujson")
+    timezone_name = None
+    if not args.not_jst:
+        try:
+            pytz.timezone(args.timezone)
+        except pytz.UnknownTimeZoneError:
+            parser.error("unknown timezone " + args.timezone)
+        timezone_name = args.timezone
+
+    # metadata of other activity types is saved in manifest
+    activity_types = []
+    if args.activity_type_ids:
+        types_by_id = dict((activity_type ['id'], activity_type) for activity_type in manifest ['activity_types'])
+        try:
+            other_type_ids = [int(id) for id in args.activity_type_ids.split(',')]
+        except ValueError:
+            parser.error("--activity-types must be comma separated activity type ids")
+        for activityTypeId in other_type_ids:
+            if not types_by_id.has_key(activityTypeId):
+                parser.error("activity type " + str(activityTypeId) + " is not archived")
+            activity_types.append(types_by_id [activityTypeId])
+
+    tracking_fields = ["Lead Score"]
+    if args.change_data_fields:
+        tracking_fields.extend(args.change_data_fields.split(","))
+
+    settings = ReplaySettings(args.archive_dir, manifest, None, processes, tracking_fields, args.mail_activity, args.web_activity, timezone_name,
+                              activity_types, args.output_format != 'csv', args.lead_state_memory * 1024 * 1024 / processes, args.fast_json)
+    transformer = settings.createTransformer()
+    archived_type_ids = manifest ['activity_type_ids'].split(',')
+    for activityTypeId in transformer.getActivityTypeIds().split(','):
+        if activityTypeId not in archived_type_ids:
+            parser.error("activity type " + activityTypeId + " is not archived. archived activity types are " + manifest ['activity_type_ids'])
+    header = transformer.getHeader()
+    transformer.close()
+
+    if args.output_format == 'parquet':
+        mywriter = mkto.ParquetSink(args.output_file, [])
+    elif args.compress:
+        mywriter = mkto.ChunkedCsvSink(args.output_file, args.compress)
+    elif args.output_file:
+        mywriter = mkto.CsvSink(open(args.output_file, 'w'))
+    else:
+        mywriter = mkto.CsvSink(sys.stdout)
+    mywriter.writeHeader(header)
+
+    start = time.time()
+    pool = None
+    try:
+        if processes == 1:
+            rows = iterReplayRows(settings)
+        else:
+            settings.temp_dir = tempfile.mkdtemp(prefix='mktoReplay')
+            pool = multiprocessing.Pool(processes)
+            segments = range(len(manifest ['segments']))
+            activities = sum(pool.map(partitionSegment, [(settings, segment_index) for segment_index in segments], 1))
+            if args.debug:
+                print >> sys.stderr, "Partitioned %d activities of %d segments in %.1f sec" % (activities, len(segments), time.time() - start)
+            pool.map(transformPartition, [(settings, partition) for partition in range(processes)], 1)
+            if args.debug:
+                print >> sys.stderr, "Transformed %d partitions in %.1f sec" % (processes, time.time() - start)
+            rows = iterMergedRows(settings)
+
+        count = 0
+        block = []
+        try:
+            for row in rows:
+                block.append(row)
+                if len(block) >= CHUNK_SIZE:
+                    mywriter.writeRows(block)
+                    count += len(block)
+                    block = []
+            mywriter.writeRows(block)
+            count += len(block)
+            mywriter.close()
+        except IOError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            # reader of output such as "| head" has exited, so the rest is not needed. stdout
+            # is pointed to devnull, so buffered rows are not flushed into the closed pipe at exit
+            if args.debug:
+                print >> sys.stderr, "Output is closed by the reader after %d rows" % count
+            if not args.output_file:
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if settings.temp_dir:
+            shutil.rmtree(settings.temp_dir, True)
+
+    if args.debug:
+        print >> sys.stderr, "Replayed %d rows in %.1f sec" % (count, time.time() - start)
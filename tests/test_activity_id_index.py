@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Tests of ActivityIdIndex of mktoExportActivities.py, compared with a set of the same ids
+
+Run from the top directory of the repository:
+  python -m unittest discover -s tests
+"""
+
+import sys, os
+import array
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mktoExportActivities as mkto
+
+
+class ActivityIdIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(0)
+        self.directory = tempfile.mkdtemp(prefix='mktoTest')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # ids of a dense group which becomes a bitmap, sparse groups of arrays, ids over 32 bits
+    # and marketoGUID of Bulk Extract
+    def createIds(self):
+        ids = set(self.random.sample(xrange(65536 * 3, 65536 * 4), 5000))
+        ids.update(self.random.randint(0, 65536 * 1000) for i in range(3000))
+        ids.update(self.random.randint(2 ** 32, 2 ** 40) for i in range(100))
+        ids.update(['1f2c3a4b-0001', '1f2c3a4b-0002', -1])
+        return ids
+
+    def assertSameIds(self, index, ids):
+        self.assertEqual(len(index), len(ids))
+        for id in ids:
+            self.assertTrue(id in index, id)
+        for i in range(10000):
+            id = self.random.randint(0, 65536 * 1000)
+            self.assertEqual(id in index, id in ids)
+        self.assertFalse('1f2c3a4b-0003' in index)
+
+    def testAdd(self):
+        index = mkto.ActivityIdIndex()
+        ids = self.createIds()
+        for id in ids:
+            self.assertTrue(index.add(id))
+        # added again
+        for id in list(ids) [:1000]:
+            self.assertFalse(index.add(id))
+        self.assertTrue(isinstance(index.containers [3], bytearray))
+        self.assertTrue(isinstance(index.containers [self.random.choice([high for high in index.containers if high != 3])], array.array))
+        self.assertSameIds(index, ids)
+
+    def testAscendingIds(self):
+        # arrays become a bitmap after max_array ids
+        index = mkto.ActivityIdIndex()
+        for id in range(0, 20000, 3):
+            index.add(id)
+        self.assertTrue(isinstance(index.containers [0], bytearray))
+        self.assertSameIds(index, set(range(0, 20000, 3)))
+
+    def testSaveAndLoad(self):
+        path = os.path.join(self.directory, 'index')
+        index = mkto.ActivityIdIndex(path)
+        ids = self.createIds()
+        for id in ids:
+            index.add(id)
+        index.save()
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        loaded = mkto.ActivityIdIndex(path)
+        self.assertEqual(sorted(loaded.containers), sorted(index.containers))
+        for high, container in index.containers.iteritems():
+            self.assertEqual(loaded.containers [high], container)
+        self.assertSameIds(loaded, ids)
+
+        # ids added after loading are saved too
+        loaded.add(65536 * 2000)
+        loaded.save()
+        ids.add(65536 * 2000)
+        self.assertSameIds(mkto.ActivityIdIndex(path), ids)
+
+    def testEmptyIndex(self):
+        path = os.path.join(self.directory, 'index')
+        mkto.ActivityIdIndex(path).save()
+        self.assertEqual(len(mkto.ActivityIdIndex(path)), 0)
+
+    def testNotIndex(self):
+        path = os.path.join(self.directory, 'output.csv')
+        with open(path, 'wb') as f:
+            f.write('marketoGUID,Lead ID\n')
+        self.assertRaises(ValueError, mkto.ActivityIdIndex, path)
+
+    def testFilterRows(self):
+        index = mkto.ActivityIdIndex()
+        rows = [[1, 'a'], [2, 'b'], [1, 'c'], [3, 'd']]
+        self.assertEqual(index.filterRows(rows), [[1, 'a'], [2, 'b'], [3, 'd']])
+        self.assertEqual(index.filterRows([[3, 'e'], [4, 'f']]), [[4, 'f']])
+        self.assertEqual(index.duplicates, 2)
+        self.assertEqual(len(index), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Tests of ActivitySorter of mktoExportActivities.py, compared with sorted() of the same activities
+
+Run from the top directory of the repository:
+  python -m unittest discover -s tests
+"""
+
+import sys, os
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mktoExportActivities as mkto
+
+
+class ActivitySorterTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(0)
+
+    # pages of activities out of order. some activities have the same activity date
+    def createPages(self, count, page_size=100):
+        activities = []
+        for id in self.random.sample(xrange(1, count * 10), count):
+            activities.append({'id': id, 'activityDate': '2015-04-%02dT%02d:00:00Z' % (self.random.randint(1, 30), self.random.randint(0, 23)),
+                               'leadId': self.random.randint(1, 1000)})
+        return [activities [start:start + page_size] for start in range(0, count, page_size)]
+
+    def sortActivities(self, pages):
+        return sorted((activity for page in pages for activity in page), key=lambda activity: (activity ['activityDate'], activity ['id']))
+
+    def testSpilledRuns(self):
+        pages = self.createPages(2500)
+        sorter = mkto.ActivitySorter(max_activities=300)
+        sorter.chunk_size = 50
+        for page in pages:
+            sorter.add(page)
+        self.assertTrue(len(sorter.runs) > 1)
+        sorted_pages = list(sorter.iterSorted(page_size=70))
+        sorter.close()
+        self.assertTrue(all(len(page) == 70 for page in sorted_pages [:-1]))
+        self.assertEqual([activity for page in sorted_pages for activity in page], self.sortActivities(pages))
+        self.assertEqual(sorter.runs, [])
+
+    def testInMemory(self):
+        pages = self.createPages(500)
+        sorter = mkto.ActivitySorter()
+        for page in pages:
+            sorter.add(page)
+        self.assertEqual(sorter.runs, [])
+        sorted_pages = list(sorter.iterSorted())
+        sorter.close()
+        self.assertEqual([len(page) for page in sorted_pages], [300, 200])
+        self.assertEqual([activity for page in sorted_pages for activity in page], self.sortActivities(pages))
+
+    def testIterSortedActivityResults(self):
+        pages = self.createPages(1000)
+        sorter = mkto.ActivitySorter(max_activities=200)
+        # empty pages are skipped, and next paging tokens are dropped
+        results = [(page, 'token') for page in pages] + [([], None)]
+        sorted_results = list(mkto.iterSortedActivityResults(iter(results), sorter))
+        self.assertTrue(all(next_token is None for activities, next_token in sorted_results))
+        self.assertEqual([activity for activities, next_token in sorted_results for activity in activities], self.sortActivities(pages))
+        # run files are closed
+        self.assertEqual(sorter.runs, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
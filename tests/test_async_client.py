@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Tests of AsyncMarketoClient and its http stack against mktoMockServer.py
+
+Run from the top directory of the repository:
+  python -m unittest discover -s tests
+"""
+
+import sys, os
+import json
+import socket
+import time
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mktoExportActivities as mkto
+import mktoMockServer
+
+
+# -------
+# AsyncConnectionPool recording urls of requests
+#
+class RecordingPool:
+    def __init__(self, pool):
+        self.pool = pool
+        self.urls = []
+
+    def request(self, url, method='GET', body='', headers=None):
+        self.urls.append(url)
+        return self.pool.request(url, method, body, headers)
+
+    def close(self):
+        self.pool.close()
+
+
+# -------
+# AsyncMarketoClient paging activities of a window in pages of one activity, dated at the
+# beginning of window. Get Lead Activities of failing_since raises MarketoError 607
+#
+class FakeAsyncClient:
+    pages = 50
+
+    def __init__(self, loop, failing_since):
+        self.loop = loop
+        self.failing_since = failing_since
+
+    def getPagingToken(self, since):
+        yield self.loop.sleep(0.01)
+        raise mkto.Return(since + '/0')
+
+    def getLeadActivitiesRaw(self, token, activity_type_ids):
+        yield self.loop.sleep(0.01)
+        since, page = token.split('/')
+        if since == self.failing_since:
+            raise mkto.MarketoError('607', 'Daily quota reached')
+        page = int(page)
+        raise mkto.Return({'result': [{'id': page, 'activityDate': since}], 'moreResult': page + 1 < self.pages,
+                           'nextPageToken': '%s/%d' % (since, page + 1)})
+
+    def getRetryStats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class AsyncActivityFetcherTest(unittest.TestCase):
+    windows = [('2015-04-01T00:00:00Z', '2015-04-02T00:00:00Z'),
+               ('2015-04-02T00:00:00Z', '2015-04-03T00:00:00Z'),
+               ('2015-04-03T00:00:00Z', '2015-04-04T00:00:00Z')]
+
+    def testErrorOfOtherWindow(self):
+        # the second window fails while the first one is paged
+        def createClient(loop):
+            return FakeAsyncClient(loop, self.windows [1][0])
+        fetcher = mkto.AsyncActivityFetcher(createClient, self.windows, '12,13', 2, prefetch=2)
+        pages = []
+        try:
+            for page in fetcher.iterResults():
+                pages.append(page)
+            self.fail("MarketoError is not raised")
+        except mkto.MarketoError, e:
+            self.assertEqual(e.code, '607')
+        self.assertTrue(len(pages) < FakeAsyncClient.pages)
+
+
+class AsyncMarketoClientTest(unittest.TestCase):
+    pages = 5
+
+    def setUp(self):
+        activities = mktoMockServer.SyntheticActivities(3000, 200, datetime(2015, 4, 1), 60, 0)
+        self.server = mktoMockServer.MarketoMockServer(0, activities, page_size=100)
+        self.server.start()
+        self.loop = mkto.EventLoop()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def createClient(self, pool, list_id=None):
+        # retries wait a moment, and errors in a row do not pause requests
+        return mkto.AsyncMarketoClient(self.loop, self.server.getInstanceUrl(), 'client_credentials', 'id', 'secret', list_id,
+                                       pool=pool, retry_policy=mkto.RetryPolicy(base_wait=0.01, max_wait=0.05),
+                                       circuit_breaker=mkto.CircuitBreaker(threshold=1000))
+
+    # ids of activities of the first pages, fetched by coroutines of client
+    def fetchIds(self, client):
+        token = yield client.getPagingToken('2015-04-01')
+        ids = []
+        for page in range(self.pages):
+            raw_data = yield client.getLeadActivitiesRaw(token, '12,13')
+            ids.extend(result ['id'] for result in raw_data.get('result', []))
+            token = raw_data ['nextPageToken']
+        raise mkto.Return(ids)
+
+    # ids of the same pages fetched by blocking MarketoClient
+    def fetchExpectedIds(self):
+        client = mkto.MarketoClient(self.server.getInstanceUrl(), 'client_credentials', 'id', 'secret', None)
+        try:
+            token = client.getPagingToken('2015-04-01')
+            ids = []
+            for page in range(self.pages):
+                raw_data = client.getLeadActivitiesRaw(token, '12,13')
+                ids.extend(result ['id'] for result in raw_data.get('result', []))
+                token = raw_data ['nextPageToken']
+            return ids
+        finally:
+            client.close()
+
+    def testGzipResponse(self):
+        pool = mkto.AsyncConnectionPool(self.loop)
+        url = self.server.getInstanceUrl() + '/identity/oauth/token?grant_type=client_credentials'
+        status, reason, headers, body = self.loop.runUntilComplete(pool.request(url, headers={'Accept-Encoding': 'gzip'}))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers.get('content-encoding'), 'gzip')
+        self.assertTrue(json.loads(body).has_key('access_token'))
+
+        status, reason, headers, body = self.loop.runUntilComplete(pool.request(url))
+        self.assertFalse(headers.has_key('content-encoding'))
+        self.assertTrue(json.loads(body).has_key('access_token'))
+        pool.close()
+
+    def testKeepAliveReuse(self):
+        pool = mkto.AsyncConnectionPool(self.loop)
+        client = self.createClient(pool)
+        ids = self.loop.runUntilComplete(self.fetchIds(client))
+        # token, paging token and pages are sent on one connection
+        self.assertEqual(pool.opened, 1)
+        self.assertEqual(self.server.getStats() ['connections'], 1)
+        client.close()
+        self.assertEqual(ids, self.fetchExpectedIds())
+
+    def testChunkedResponse(self):
+        self.server.chunked = True
+        self.server.chunk_size = 100
+        pool = mkto.AsyncConnectionPool(self.loop)
+        url = self.server.getInstanceUrl() + '/identity/oauth/token?grant_type=client_credentials'
+        status, reason, headers, body = self.loop.runUntilComplete(pool.request(url, headers={'Accept-Encoding': 'gzip'}))
+        self.assertEqual(headers.get('transfer-encoding'), 'chunked')
+        self.assertTrue(json.loads(body).has_key('access_token'))
+
+        client = self.createClient(pool)
+        ids = self.loop.runUntilComplete(self.fetchIds(client))
+        self.assertEqual(pool.opened, 1)
+        client.close()
+        self.assertEqual(ids, self.fetchExpectedIds())
+
+    def testRetryOf602And606(self):
+        self.server.error_602_rate = 0.3
+        self.server.error_606_rate = 0.4
+        client = self.createClient(mkto.AsyncConnectionPool(self.loop))
+        ids = self.loop.runUntilComplete(self.fetchIds(client))
+        retry_stats = client.getRetryStats()
+        client.close()
+        self.assertTrue(retry_stats.has_key('602'))
+        self.assertTrue(retry_stats.has_key('606'))
+
+        self.server.error_602_rate = 0.0
+        self.server.error_606_rate = 0.0
+        self.assertEqual(ids, self.fetchExpectedIds())
+
+    def testListId(self):
+        pool = RecordingPool(mkto.AsyncConnectionPool(self.loop))
+        client = self.createClient(pool, list_id=123)
+        def fetch():
+            token = yield client.getPagingToken('2015-04-01')
+            yield client.getLeadActivitiesRaw(token, '12,13')
+            yield client.getLeadChangesRaw(token, 'leadScore')
+        self.loop.runUntilComplete(fetch())
+        client.close()
+        urls = [url for url in pool.urls if '/activities.json' in url or '/leadchanges.json' in url]
+        self.assertEqual(len(urls), 2)
+        for url in urls:
+            self.assertTrue('listId=123' in url, url)
+
+    def testConnectionRefused(self):
+        # a port nobody listens on. it fails at once instead of being retried
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d' % sock.getsockname() [1]
+        sock.close()
+        start = time.time()
+        with self.assertRaises(mkto.MarketoError) as context:
+            mkto.MarketoClient(url, 'client_credentials', 'id', 'secret', None)
+        self.assertEqual(context.exception.code, 'connection')
+
+        client = mkto.AsyncMarketoClient(self.loop, url, 'client_credentials', 'id', 'secret', None)
+        with self.assertRaises(mkto.MarketoError) as context:
+            self.loop.runUntilComplete(client.getPagingToken('2015-04-01'))
+        client.close()
+        self.assertEqual(context.exception.code, 'connection')
+        self.assertTrue(time.time() - start < 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Regression tests of mktoExportActivities.py against mktoMockServer.py. Output of each way of
+fetching and transforming is compared with the sequential export.
+
+Run from the top directory of the repository:
+  python -m unittest discover -s tests
+"""
+
+import sys, os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mktoMockServer
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mktoExportActivities.py')
+
+
+class ExportRegressionTest(unittest.TestCase):
+    # about 14 days of activities of 1000 leads
+    export_args = ['-c', '2015-04-01', '--until', '2015-04-20', '-f', 'Behavior Score', '-m', '-w']
+
+    @classmethod
+    def setUpClass(cls):
+        activities = mktoMockServer.SyntheticActivities(20000, 1000, datetime(2015, 4, 1), 60, 0)
+        cls.server = mktoMockServer.MarketoMockServer(0, activities)
+        cls.server.start()
+        cls.directory = tempfile.mkdtemp(prefix='mktoTest')
+        cls.expected = cls.runExport('sequential.csv')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        shutil.rmtree(cls.directory)
+
+    # run the export with options and return its output. non-zero exit status is raised unless
+    # status is given, which is compared with it
+    @classmethod
+    def runExport(cls, name, options=(), status=0):
+        output = os.path.join(cls.directory, name)
+        command = [sys.executable, SCRIPT, '-i', cls.server.getInstanceUrl(), '-d', 'test', '-s', 'test', '-o', output]
+        command += cls.export_args + list(options)
+        with open(os.devnull, 'wb') as devnull:
+            returncode = subprocess.call(command, stderr=devnull)
+        if returncode != status:
+            raise AssertionError("exit status %d of %s" % (returncode, ' '.join(command)))
+        with open(output, 'rb') as f:
+            return f.read()
+
+    def assertSameOutput(self, content):
+        self.assertEqual(content.count('\n'), self.expected.count('\n'))
+        self.assertTrue(content == self.expected, "output is different from the sequential export")
+
+    def testSequentialHasRows(self):
+        self.assertTrue(self.expected.count('\n') > 10000)
+
+    def testWorkers(self):
+        self.assertSameOutput(self.runExport('workers.csv', ['--workers', '4']))
+
+    def testAsync(self):
+        self.assertSameOutput(self.runExport('async.csv', ['--workers', '4', '--async']))
+
+    def testTransformProcesses(self):
+        self.assertSameOutput(self.runExport('processes.csv', ['--transform-processes', '2']))
+
+    def testResume(self):
+        checkpoint = os.path.join(self.directory, 'checkpoint.json')
+        # the export stops at an outage of the mock server, and is resumed after it
+        self.server.outage_after = self.server.served + 20
+        self.server.outage_seconds = 1.0
+        self.server.outage_until = None
+        try:
+            partial = self.runExport('resume.csv', ['--checkpoint', checkpoint, '--checkpoint-interval', '3', '--max-retries', '0'], status=1)
+        finally:
+            self.server.outage_after = None
+        self.assertTrue(0 < partial.count('\n') < self.expected.count('\n'))
+        self.assertTrue(os.path.exists(checkpoint))
+
+        self.server.outage_until = None
+        self.assertSameOutput(self.runExport('resume.csv', ['--resume', checkpoint]))
+
+
+if __name__ == '__main__':
+    unittest.main()
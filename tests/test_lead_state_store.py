@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Tests of LeadStateStore of mktoExportActivities.py. Stores with small memory_limit, which
+spill leads into SQLite, are compared with a dict of the same leads.
+
+Run from the top directory of the repository:
+  python -m unittest discover -s tests
+"""
+
+import sys, os
+import base64
+import cStringIO
+import json
+import random
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mktoExportActivities as mkto
+
+
+class LeadStateStoreTest(unittest.TestCase):
+    # about 50 leads in each generation of memory
+    memory_limit = 20000
+    values = ['1', '25', 'MQL', '', u'スコア'.encode('utf-8')]
+
+    def setUp(self):
+        self.random = random.Random(0)
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+
+    def createStore(self, fields, memory_limit=None):
+        store = mkto.LeadStateStore(fields, memory_limit)
+        self.stores.append(store)
+        return store
+
+    # set random values into store and {leadId: values} of the same leads.
+    # most changes are on a few hundred leads, and others are on leads rarely seen
+    def update(self, store, expected, count):
+        for i in range(count):
+            leadId = self.random.choice([self.random.randint(1, 300), self.random.randint(1, 100000)])
+            if self.random.random() < 0.8:
+                field = self.random.choice(store.columns)
+                value = self.random.choice(self.values)
+                store.setValue(leadId, field, value)
+                expected.setdefault(leadId, [None] * len(store.columns)) [store.columns.index(field)] = value
+            else:
+                store.resetValues(leadId, '')
+                expected [leadId] = [''] * len(store.columns)
+
+    def assertSameLeads(self, store, expected):
+        self.assertEqual(len(store), len(expected))
+        self.assertEqual(dict((leadId, list(row)) for leadId, row in store.iterRows()), expected)
+
+    def testSameAsUnlimited(self):
+        store = self.createStore(['Behavior Score', 'Lead Status'], self.memory_limit)
+        unlimited = self.createStore(['Behavior Score', 'Lead Status'])
+        expected = {}
+        for i in range(20000):
+            leadId = self.random.choice([self.random.randint(1, 300), self.random.randint(1, 100000)])
+            operation = self.random.random()
+            if operation < 0.3:
+                value = self.random.choice(self.values)
+                store.setValue(leadId, 'Lead Status', value)
+                unlimited.setValue(leadId, 'Lead Status', value)
+                expected.setdefault(leadId, [None, None]) [1] = value
+            elif operation < 0.4:
+                store.resetValues(leadId, '')
+                unlimited.resetValues(leadId, '')
+                expected [leadId] = ['', '']
+            else:
+                self.assertEqual(list(store.getValues(leadId)), list(unlimited.getValues(leadId)))
+                self.assertEqual(store.hasLead(leadId), unlimited.hasLead(leadId))
+        self.assertTrue(store.spills > 0)
+        self.assertEqual(unlimited.spills, 0)
+        self.assertSameLeads(store, expected)
+        self.assertSameLeads(unlimited, expected)
+
+    def testUnknownLead(self):
+        store = self.createStore(['Behavior Score', 'Lead Status'], self.memory_limit)
+        self.assertFalse(store.hasLead(1))
+        self.assertEqual(store.getValues(1), [None, None])
+        # looking up does not add the lead
+        self.assertEqual(len(store), 0)
+
+    def testDuplicateFields(self):
+        store = self.createStore(['Behavior Score', 'Lead Status', 'Behavior Score'], self.memory_limit)
+        self.assertEqual(store.columns, ['Behavior Score', 'Lead Status'])
+        # leads out of range of update(), so the first one is spilled
+        store.setValue(200001, 'Behavior Score', '10')
+        store.setValue(200001, 'Lead Status', 'MQL')
+        self.update(store, {}, 2000)
+        store.setValue(200002, 'Behavior Score', '20')
+        self.assertEqual(list(store.getValues(200001)), ['10', 'MQL', '10'])
+        self.assertEqual(list(store.getValues(200002)), ['20', None, '20'])
+        self.assertTrue(store.spills > 0)
+
+    def testSpillFileIsRemoved(self):
+        store = self.createStore(['Behavior Score'], self.memory_limit)
+        self.update(store, {}, 2000)
+        path = store.spill_path
+        self.assertTrue(os.path.exists(path))
+        store.close()
+        self.assertFalse(os.path.exists(path))
+
+    def testSnapshot(self):
+        store = self.createStore(['Behavior Score', 'Lead Status'], self.memory_limit)
+        expected = {}
+        self.update(store, expected, 5000)
+        # leads are split into records of record_leads
+        store.record_leads = 100
+        snapshot = cStringIO.StringIO()
+        size = store.writeSnapshot(snapshot)
+        self.assertEqual(size, len(snapshot.getvalue()))
+
+        restored = self.createStore(['Behavior Score', 'Lead Status'], self.memory_limit)
+        snapshot.seek(0)
+        restored.loadSnapshot(snapshot)
+        self.assertSameLeads(restored, expected)
+        self.assertTrue(restored.spills > 0)
+
+        unlimited = self.createStore(['Behavior Score', 'Lead Status'])
+        unlimited.setSnapshot(restored.getSnapshot())
+        self.assertSameLeads(unlimited, expected)
+
+    def testChanges(self):
+        store = self.createStore(['Behavior Score', 'Lead Status'], self.memory_limit)
+        store.trackChanges()
+        expected = {}
+        log = cStringIO.StringIO()
+        size = 0
+        for i in range(5):
+            self.update(store, expected, 1000)
+            size += store.writeChanges(log)
+        # nothing has been changed since the last writeChanges()
+        self.assertEqual(store.writeChanges(log), 0)
+        # bytes after size, such as a record being written when we were killed, are not read
+        log.write('partial record')
+
+        restored = self.createStore(['Behavior Score', 'Lead Status'], self.memory_limit)
+        log.seek(0)
+        restored.loadSnapshot(log, size)
+        self.assertSameLeads(restored, expected)
+
+    def testOldSnapshot(self):
+        # {field: {leadId: value}} written by earlier versions
+        values = {'Behavior Score': {'1': '10', '2': '20'}, 'Lead Status': {'2': u'新規'}}
+        snapshot = base64.b64encode(zlib.compress(json.dumps(values)))
+        store = self.createStore(['Behavior Score', 'Lead Status'], self.memory_limit)
+        store.setSnapshot(snapshot)
+        self.assertSameLeads(store, {1: ['10', None], 2: ['20', u'新規'.encode('utf-8')]})
+
+
+if __name__ == '__main__':
+    unittest.main()